@@ -12,12 +12,16 @@ import os
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'campusbuggy.settings')
 
 from django.core.asgi import get_asgi_application
+
+# Set up Django before importing consumers, which import models
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
 import tracking.routing
 from tracking.consumers import TokenAuthMiddlewareStack
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     "websocket": TokenAuthMiddlewareStack(
         URLRouter(
             tracking.routing.websocket_urlpatterns
@@ -0,0 +1,246 @@
+"""
+Process-local metrics exposed in Prometheus text format on ``/metrics``.
+
+A deliberately small subset of the Prometheus client: labelled counters,
+gauges and fixed-bucket histograms, each guarded by a single lock, cheap
+enough to leave on in production. Apps declare their metrics at import time
+with ``counter()``, ``gauge()`` and ``histogram()``; values that already
+live elsewhere (queue depths, cache stats) are reported at scrape time by
+functions registered with ``collector()``.
+
+Every worker process keeps its own values, so scrape each worker (or put
+them behind a per-process port) and aggregate in Prometheus.
+
+The endpoint is closed unless configured: scrapers must connect from one
+of ``METRICS['ALLOWED_IPS']`` or send ``METRICS['TOKEN']`` as a bearer token.
+"""
+import bisect
+import hmac
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; spans sub-millisecond hot-path work to slow requests
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in items
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (not cumulative) counts, then sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = self.header()
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, [("le", _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collect):
+        self._collectors.append(collect)
+        return collect
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for name, kind, documentation, samples in collect():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(
+                        f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labels=()):
+    return registry.register(Counter(name, documentation, labels))
+
+
+def gauge(name, documentation, labels=()):
+    return registry.register(Gauge(name, documentation, labels))
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labels, buckets))
+
+
+def collector(collect):
+    """
+    Register ``collect()``, called on every scrape, which yields
+    ``(name, kind, documentation, [(labels dict, value), ...])``.
+    """
+    return registry.add_collector(collect)
+
+
+# ------------------ HTTP ------------------
+
+REQUEST_SECONDS = histogram(
+    "http_request_duration_seconds", "Time spent handling HTTP requests", ["view", "method"]
+)
+REQUESTS = counter("http_requests_total", "HTTP responses", ["view", "method", "status"])
+
+
+class RequestMetricsMiddleware:
+    """Request latency and status counts per resolved view."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = (match.view_name or match._func_path) if match else "<unmatched>"
+        REQUEST_SECONDS.observe(elapsed, view=view, method=request.method)
+        REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        return response
+
+
+def metrics_settings():
+    return getattr(settings, "METRICS", {})
+
+
+def scrape_allowed(request):
+    config = metrics_settings()
+    if request.META.get("REMOTE_ADDR") in config.get("ALLOWED_IPS", ()):
+        return True
+    token = config.get("TOKEN")
+    authorization = request.headers.get("Authorization", "")
+    return bool(token) and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+
+
+def metrics_view(request):
+    # Nothing configured means nobody may scrape, not everybody
+    if not scrape_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "campusbuggy.metrics.RequestMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     'whitenoise.middleware.WhiteNoiseMiddleware',
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -134,7 +135,7 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'users.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -143,6 +144,25 @@ REST_FRAMEWORK = {
 
 AUTH_USER_MODEL = 'users.User'
 
+# Token -> user lookups for REST and WebSocket auth (see users/authentication.py).
+# Set SHARED_CACHE to a CACHES alias (e.g. a Redis cache) to share entries
+# between workers.
+TOKEN_CACHE = {
+    'LOCAL_TTL': 30,            # seconds; bounds staleness in other workers
+    'MAX_ENTRIES': 10000,
+    'SHARED_CACHE': None,
+    'SHARED_TTL': 300,          # seconds
+}
+
+# Cached AvailableBuggiesView / AssignedBuggyView payloads (see
+# tracking/readcache.py), invalidated by Buggy signals once they commit and
+# warmed up on the first miss in each process.
+READ_CACHE = {
+    'LOCAL_TTL': 60,            # seconds; bounds staleness in other workers
+    'SHARED_CACHE': None,
+    'SHARED_TTL': 300,          # seconds
+}
+
 ASGI_APPLICATION = 'campusbuggy.asgi.application'
 
 CHANNEL_LAYERS = {
@@ -154,6 +174,133 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Location ingest (see tracking/ingest.py)
+TRACKING_INGEST = {
+    'FLUSH_INTERVAL': 1.0,      # seconds between write-behind flushes
+    'BATCH_SIZE': 500,          # flush early once this many pings are queued
+    'BUGGY_CHECK_TTL': 5.0,     # seconds a driver's buggy assignment check is reused
+    'CHECKPOINT_INTERVAL': 30,  # seconds between BuggyLocation checkpoints per buggy
+    'MAX_UPLOAD_FIXES': 1000,   # fixes per location_batch upload from a driver
+}
+
+# Threads running the tracking consumers' blocking database calls (see
+# tracking/executor.py); 0 uses the thread shared with other sync code.
+# Each thread holds its own database connection. None picks 1 on SQLite,
+# which allows a single writer at a time, and 4 otherwise.
+TRACKING_DB_EXECUTOR = {
+    'MAX_WORKERS': None,
+}
+
+# Which fixes are kept as Location history (see tracking/simplify.py)
+TRACKING_HISTORY = {
+    'MIN_DISTANCE': 15.0,       # metres; closer fixes are treated as jitter
+    'MAX_DEVIATION': 12.0,      # metres a fix may stray from the stored path
+    'MAX_HEADING_CHANGE': 45.0, # degrees of turn that mark a corner
+    'MAX_GAP': 300,             # seconds; store a fix at least this often
+    'MAX_WINDOW': 60,           # fixes checked per ping before forcing a store
+    # LocationHistoryView paging and streaming (see tracking/history.py)
+    'STREAM_CHUNK_SIZE': 2000,  # rows fetched per query when streaming
+    'PAGE_SIZE': 1000,          # default ?limit for cursor pages
+    'MAX_PAGE_SIZE': 10000,
+    # Monthly partitions and retention (see tracking/partitions.py).
+    # 'auto' uses native partitions on PostgreSQL, per-month tables elsewhere;
+    # run `manage.py history_partitions` and `manage.py prune_history` daily.
+    'PARTITIONING': 'auto',
+    'PARTITIONS_AHEAD': 2,      # months of partitions created in advance
+    'RETENTION_DAYS': 180,      # older history is rolled up per minute, then dropped
+}
+
+# Latest position of every running buggy (see tracking/live.py).
+# Use 'tracking.live.RedisLiveStore' with OPTIONS {'url': 'redis://...'}
+# when running more than one worker process: the ETags of polled endpoints
+# (tracking/conditional.py) are only bumped in the process that made a change.
+TRACKING_LIVE_STORE = {
+    'BACKEND': 'tracking.live.LocalLiveStore',
+    # Seconds a fleet snapshot sent on connect may be reused after the
+    # live state changed (see tracking/snapshot.py)
+    'SNAPSHOT_MAX_AGE': 1.0,
+}
+
+# Location updates are coalesced per buggy and broadcast once per tick
+# (see tracking/broadcast.py). 0 sends every update immediately.
+TRACKING_BROADCAST = {
+    'TICK_INTERVAL': 1.0,       # seconds
+    # Coordinate decimals on delta-mode sockets (see tracking/delta.py);
+    # 5 is ~1.1 m, smaller moves are not sent
+    'DELTA_PRECISION': 5,
+}
+
+# Trip segmentation of location history (see tracking/trips.py)
+TRACKING_TRIPS = {
+    'MAX_GAP': 600,             # seconds without history that end a trip
+}
+
+# Recent positions per buggy for the tails drawn on the map (see
+# tracking/trails.py). Use 'tracking.trails.RedisTrailStore' with OPTIONS
+# {'url': 'redis://...'} when running more than one worker process.
+TRACKING_TRAILS = {
+    'BACKEND': 'tracking.trails.LocalTrailStore',
+    'MAX_POINTS': 120,          # positions kept per buggy
+    'MIN_INTERVAL': 5.0,        # seconds between kept positions
+    'MAX_AGE': 600,             # seconds; older positions are dropped
+}
+
+# Snapping driver fixes to the campus roads entered as Routes (see
+# tracking/snapping.py); fixes further than MAX_DISTANCE are kept as sent
+TRACKING_ROUTES = {
+    'ENABLED': True,
+    'MAX_DISTANCE': 25.0,       # metres
+    'CELL_SIZE': 50.0,          # metres per spatial index cell
+    'HEADING_WEIGHT': 10.0,     # metres of penalty for a road across the direction of travel
+}
+
+# Arrival time estimates at campus stops (see tracking/eta.py)
+TRACKING_ETA = {
+    'ROUTE_FACTOR': 1.3,        # path length / straight-line distance
+    'MIN_SPEED': 1.0,           # m/s; buggies standing still still arrive
+    'TURN_PENALTY': 1.0,        # extra fraction of the ETA for a stop behind the buggy
+    'MAX_ETA': 1800,            # seconds; later arrivals are not reported
+    'PUSH_INTERVAL': 5.0,       # seconds between ETA pushes per buggy
+}
+
+# Per-day usage heatmaps for the transport office (see tracking/heatmap.py).
+# Changing BOUNDS or CELL_SIZE starts new heatmaps; run rebuild_heatmap to
+# re-bin older days.
+TRACKING_HEATMAP = {
+    'BOUNDS': (12.955, 77.578, 12.988, 77.611),    # south, west, north, east
+    'CELL_SIZE': 50.0,          # metres
+    'SAMPLE_INTERVAL': 10.0,    # seconds between samples between history points
+    'MAX_GAP': 600.0,           # seconds; buggies are not counted across longer gaps
+    'FLUSH_INTERVAL': 60.0,     # seconds between merges into HeatmapDay rows
+    'DEFAULT_DAYS': 7,
+    'MAX_DAYS': 366,
+}
+
+# "Buggies near me" grid index over live positions (see tracking/nearby.py)
+TRACKING_NEARBY = {
+    'CELL_SIZE': 250,           # metres
+    'DEFAULT_RADIUS': 1000,     # metres
+    'MAX_RADIUS': 5000,
+    'DEFAULT_LIMIT': 5,
+    'MAX_LIMIT': 50,
+    'REFRESH_INTERVAL': 5.0,    # seconds; resync from a shared live store
+}
+
+# Encoder for broadcast frames and tracking API responses
+# (see tracking/fastjson.py): 'auto' uses orjson when installed.
+TRACKING_JSON = {
+    'ENCODER': 'auto',
+}
+
+# Prometheus text metrics on /metrics (see campusbuggy/metrics.py), only
+# served to scrapers sending TOKEN as a bearer token. ALLOWED_IPS is opt-in:
+# behind the ngrok tunnel (or any reverse proxy) every request arrives from
+# loopback, so never list 127.0.0.1 there.
+METRICS = {
+    'ALLOWED_IPS': [],
+    'TOKEN': None,
+}
+
 CORS_ALLOWED_ORIGINS = [
     "https://700c-45-112-146-74.ngrok-free.app",
     "https://7b34-45-112-146-74.ngrok-free.app",
@@ -18,6 +18,8 @@ from django.contrib import admin
 from django.urls import path, include, re_path
 from rest_framework import permissions
 
+from .metrics import metrics_view
+
 # drf-yasg imports
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
@@ -41,6 +43,7 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path('api/user/', include('users.urls')),
     path('api/tracking/', include('tracking.urls')),
+    path('metrics', metrics_view, name='metrics'),
     # Swagger UI and ReDoc
     re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Buggy, BuggyLocation, Location
+from .models import (
+    Buggy, BuggyLocation, HeatmapDay, Location, LocationRollup, Route, RouteSegment, Stop, Trip,
+)
 
 @admin.register(Buggy)
 class BuggyAdmin(admin.ModelAdmin):
@@ -16,4 +18,38 @@ class BuggyLocationAdmin(admin.ModelAdmin):
 class LocationAdmin(admin.ModelAdmin):
     list_display = ('buggy', 'driver', 'latitude', 'longitude', 'timestamp')
     list_filter = ('buggy', 'timestamp')
-    search_fields = ('buggy__number_plate', 'driver__username')
\ No newline at end of file
+    search_fields = ('buggy__number_plate', 'driver__username')
+
+@admin.register(LocationRollup)
+class LocationRollupAdmin(admin.ModelAdmin):
+    list_display = ('buggy', 'minute', 'samples', 'latitude', 'longitude')
+    list_filter = ('buggy',)
+
+@admin.register(Trip)
+class TripAdmin(admin.ModelAdmin):
+    list_display = ('buggy', 'driver', 'started_at', 'ended_at', 'is_open', 'point_count', 'distance')
+    list_filter = ('buggy', 'is_open')
+    exclude = ('polyline', 'times')
+
+@admin.register(Stop)
+class StopAdmin(admin.ModelAdmin):
+    list_display = ('name', 'latitude', 'longitude', 'is_active')
+    list_filter = ('is_active',)
+    search_fields = ('name',)
+
+class RouteSegmentInline(admin.TabularInline):
+    model = RouteSegment
+    extra = 1
+
+@admin.register(Route)
+class RouteAdmin(admin.ModelAdmin):
+    list_display = ('name', 'is_active')
+    list_filter = ('is_active',)
+    search_fields = ('name',)
+    inlines = [RouteSegmentInline]
+
+@admin.register(HeatmapDay)
+class HeatmapDayAdmin(admin.ModelAdmin):
+    list_display = ('date', 'grid', 'total', 'outside', 'updated_at')
+    list_filter = ('grid',)
+    exclude = ('counts',)
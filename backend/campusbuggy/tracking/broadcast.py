@@ -0,0 +1,146 @@
+"""
+Coalescing broadcaster for location updates.
+
+Drivers may ping several times per second, but students gain nothing from
+seeing more than about one position per tick. ``LocationConsumer`` publishes
+every accepted update here; the ticker keeps only the latest update per buggy
+and, once per ``TICK_INTERVAL``, sends:
+
+* each changed buggy's latest ``location_update`` to that buggy's group, and
+* one ``location_batch`` frame with every changed buggy to ``ALL_BUGGIES_GROUP``.
+
+Outbound volume is therefore bounded by the tick rate, not by how chatty
+drivers are. A ``TICK_INTERVAL`` of 0 sends every update immediately.
+
+Frames are encoded here, once per tick and wire format (see tracking/wire.py),
+and travel through the channel layer ready to send, next to the update
+fields; consumers forward them without re-encoding per socket (delta-mode
+sockets build their own, see tracking/delta.py).
+"""
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .groups import ALL_BUGGIES_GROUP, buggy_group
+from .metrics import FANOUT, GROUP_SEND_SECONDS, group_size
+from .wire import encode_frames, update_fields
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastTicker:
+    def __init__(self, tick_interval=1.0):
+        self.tick_interval = tick_interval
+
+        self._pending = {}
+        self._loop = None
+        self._task = None
+
+        self.updates_published = 0
+        self.updates_sent = 0
+        self.frames_sent = 0
+        self.frames_saved = 0
+        self.ticks = 0
+        self.last_tick_lag = 0.0
+        self.max_tick_lag = 0.0
+
+    @classmethod
+    def from_settings(cls):
+        config = getattr(settings, "TRACKING_BROADCAST", {})
+        return cls(tick_interval=config.get("TICK_INTERVAL", 1.0))
+
+    def stats(self):
+        return {
+            "tick_interval": self.tick_interval,
+            "pending": len(self._pending),
+            "updates_published": self.updates_published,
+            "updates_sent": self.updates_sent,
+            "frames_sent": self.frames_sent,
+            "frames_saved": self.frames_saved,
+            "ticks": self.ticks,
+            "last_tick_lag": self.last_tick_lag,
+            "max_tick_lag": self.max_tick_lag,
+        }
+
+    async def publish(self, event):
+        self.updates_published += 1
+        if self.tick_interval <= 0:
+            await self.send({event["buggy_id"]: event})
+            return
+
+        if event["buggy_id"] in self._pending:
+            # Superseded before its tick, so it is never sent
+            self.frames_saved += 1
+        self._pending[event["buggy_id"]] = event
+        self._ensure_ticker()
+
+    def discard(self, buggy_ids):
+        """Forget pending updates of buggies that have just gone offline."""
+        for buggy_id in buggy_ids:
+            self._pending.pop(buggy_id, None)
+
+    def _ensure_ticker(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.tick_interval
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+
+            lag = loop.time() - next_tick
+            self.last_tick_lag = lag
+            self.max_tick_lag = max(self.max_tick_lag, lag)
+            # Skip missed ticks rather than bursting to catch up
+            next_tick = max(next_tick + self.tick_interval, loop.time())
+
+            await self.tick()
+
+    async def tick(self):
+        self.ticks += 1
+        pending, self._pending = self._pending, {}
+        if pending:
+            try:
+                await self.send(pending)
+            except Exception:
+                logger.exception("Failed to broadcast %d location updates", len(pending))
+
+    async def send(self, updates):
+        channel_layer = get_channel_layer()
+
+        fanout = group_size(ALL_BUGGIES_GROUP)
+        for buggy_id, event in updates.items():
+            group = buggy_group(buggy_id)
+            fanout += group_size(group)
+            with GROUP_SEND_SECONDS.time(group="buggy"):
+                await channel_layer.group_send(group, {
+                    "type": "location_update",
+                    **update_fields(event),
+                    **encode_frames(lambda codec: codec.location_update_frame(event)),
+                })
+
+        with GROUP_SEND_SECONDS.time(group="all"):
+            await channel_layer.group_send(ALL_BUGGIES_GROUP, {
+                "type": "location_batch",
+                "updates": [update_fields(event) for event in updates.values()],
+                **encode_frames(lambda codec: codec.location_batch_frame(updates.values())),
+            })
+        FANOUT.observe(fanout)
+
+        self.updates_sent += len(updates)
+        self.frames_sent += len(updates) + 1
+
+
+_ticker = None
+
+
+def get_broadcaster():
+    global _ticker
+    if _ticker is None:
+        _ticker = BroadcastTicker.from_settings()
+    return _ticker
@@ -0,0 +1,80 @@
+"""
+ETag / If-None-Match handling for polled fleet endpoints.
+
+Clients that can't keep a socket open poll ``live-location`` and
+``available-buggies``. Each response carries an ETag built from a live store
+state version (see ``LiveStore.etag``), so:
+
+* a poll with a matching ``If-None-Match`` gets a bodyless 304 without
+  touching the database or the serializers;
+* otherwise the JSON body is rendered once per version and reused by every
+  other client polling the same version, for at most ``READ_CACHE['LOCAL_TTL']``
+  seconds.
+
+Versions are bumped in the process that made the change. With
+``LocalLiveStore`` other worker processes never see the bump and keep
+answering 304 for their old version, so run the Redis live store whenever
+there is more than one process.
+"""
+import time
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import parse_etags
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .renderers import FastJSONRenderer
+
+
+class RenderedCache:
+    """The latest rendered body per endpoint, with the ETag it was built for."""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._bodies = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, key, etag):
+        cached = self._bodies.get(key)
+        if cached is not None and cached[0] == etag and cached[2] > time.monotonic():
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        return None
+
+    def set(self, key, etag, body):
+        self._bodies[key] = (etag, body, time.monotonic() + self.ttl)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "not_modified": self.not_modified}
+
+
+# Same bound on staleness as the buggy read models the bodies are built from
+rendered_cache = RenderedCache(ttl=getattr(settings, "READ_CACHE", {}).get("LOCAL_TTL", 60))
+
+
+def versioned_response(request, key, etag, build):
+    """
+    Respond with the data returned by ``build()`` for state version ``etag``,
+    or 304 if the client already has it.
+    """
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        rendered_cache.not_modified += 1
+        response = HttpResponseNotModified()
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    # Only the plain JSON rendering is shared; the browsable API renders per request
+    if not isinstance(request.accepted_renderer, JSONRenderer):
+        return Response(build(), headers=headers)
+
+    body = rendered_cache.get(key, etag)
+    if body is None:
+        body = FastJSONRenderer().render(build())
+        rendered_cache.set(key, etag, body)
+    return HttpResponse(body, content_type="application/json", headers=headers)
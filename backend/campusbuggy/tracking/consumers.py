@@ -1,13 +1,33 @@
-import json
+import logging
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from urllib.parse import parse_qs
-from datetime import timedelta
+from .broadcast import get_broadcaster
+from .delta import DeltaEncoder, delta_precision
+from .eta import astop_etas, aupdate_etas, get_eta_engine, publish_etas
+from .executor import db_helper
+from .groups import ALL_BUGGIES_GROUP, STOP_ETAS_GROUP, buggy_group, parse_buggy_ids
+from .ingest import Ping, get_ingest_buffer, ingest_setting, is_valid_fix, parse_fixes
+from .live import get_live_store, live_entry
+from .metrics import (
+    DELTA_UPDATES, OPEN_SOCKETS, PINGS, WS_MESSAGES, WS_RECEIVE_SECONDS,
+    group_joined, group_left, message_type_label,
+)
+from .nearby import anearby_buggies, get_nearby_index, parse_nearby_query
+from .snapping import asnap_pings
+from .snapshot import get_fleet_snapshot
+from .trails import encode_trails, get_trail_store, parse_trail_since
+from .wire import negotiate
+
+logger = logging.getLogger(__name__)
 
 class LocationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
+        # JSON text frames unless the client asked for a binary subprotocol
+        self.codec, subprotocol = negotiate(self.scope.get("subprotocols", []))
         
         if self.user.is_authenticated:
             if self.user.user_type == 'driver':
@@ -17,11 +37,14 @@ class LocationConsumer(AsyncWebsocketConsumer):
                     self.channel_name
                 )
             else:
-                self.group_name = "location_updates"
-                await self.channel_layer.group_add(
-                    self.group_name,
-                    self.channel_name
-                )
+                # Buggy groups are joined on "subscribe", not on connect
+                self.subscribed_buggies = set()
+                self.subscribed_all = False
+                # Per-buggy state of delta mode, None for full updates
+                self.delta = None
+                # Stops whose ETAs are pushed, and buggies last pushed for them
+                self.watched_stops = set()
+                self.eta_buggies = set()
 
                 self.student_group = f"student_{self.user.id}"
                 await self.channel_layer.group_add(
@@ -29,11 +52,20 @@ class LocationConsumer(AsyncWebsocketConsumer):
                     self.channel_name
                 )
                 
-            await self.accept()
+            await self.accept(subprotocol)
+            self.socket_counted = True
+            OPEN_SOCKETS.inc(user_type=self.user.user_type)
+
+            if self.user.user_type != 'driver':
+                # Current positions up front, so clients don't also poll live-location
+                await self.send_frame(await get_fleet_snapshot().aframe(self.codec))
         else:
             await self.close()
     
     async def disconnect(self, close_code):
+        if getattr(self, 'socket_counted', False):
+            OPEN_SOCKETS.dec(user_type=self.user.user_type)
+
         if hasattr(self, 'group_name'):
             await self.channel_layer.group_discard(
                 self.group_name,
@@ -45,120 +77,361 @@ class LocationConsumer(AsyncWebsocketConsumer):
                 self.student_group,
                 self.channel_name
             )
+            await self.update_subscription(set(), False)
+            await self.watch_stops(set())
         
         # Clear the buggy location when a driver disconnects
         if hasattr(self, 'user') and self.user.is_authenticated and self.user.user_type == 'driver':
-            await self.clear_driver_buggy_location()
+            get_ingest_buffer().discard_driver(self.user.id)
+            buggy_ids = await self.clear_driver_buggy_location()
+            get_broadcaster().discard(buggy_ids)
+            get_nearby_index().remove(buggy_ids)
+            await get_live_store().adelete(buggy_ids)
+            await get_trail_store().adelete(buggy_ids)
+            get_eta_engine().remove(buggy_ids)
+            for buggy_id in buggy_ids:
+                await publish_etas(buggy_id, [])
 
-    @database_sync_to_async
+    @db_helper("clear_driver_buggy_location")
     def clear_driver_buggy_location(self):
         from .models import Buggy, BuggyLocation
         
         try:
             # Find any buggies assigned to this driver
-            buggies = Buggy.objects.filter(assigned_driver=self.user)
+            buggy_ids = list(
+                Buggy.objects.filter(assigned_driver=self.user).values_list('id', flat=True)
+            )
             
             # Delete the BuggyLocation records for these buggies
-            BuggyLocation.objects.filter(buggy__in=buggies).delete()
+            BuggyLocation.objects.filter(buggy_id__in=buggy_ids).delete()
             
-            return True
-        except Exception as e:
-            print(f"Error clearing buggy location: {e}")
-            return False
+            return buggy_ids
+        except Exception:
+            logger.exception("Failed to clear the buggy locations of driver %s", self.user.id)
+            return []
     
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except ValueError as e:
+            WS_MESSAGES.inc(type=message_type_label(None))
+            await self.send_message({"type": "error", "error": str(e)})
+            return
         message_type = data.get('type', '')
+
+        label = message_type_label(message_type)
+        WS_MESSAGES.inc(type=label)
+        with WS_RECEIVE_SECONDS.time(type=label):
+            await self.handle_message(data, message_type)
+
+    async def handle_message(self, data, message_type):
         
         if self.user.user_type == 'driver' and message_type == 'location_update':
             buggy_id = data.get('buggy_id')
             latitude = data.get('latitude')
             longitude = data.get('longitude')
             direction = data.get('direction', None)
-            
-            if buggy_id and latitude is not None and longitude is not None:
-                success = await self.update_buggy_location(
+
+            if not buggy_id or not is_valid_fix(latitude, longitude, direction):
+                # Same checks as uploaded fixes; nothing invalid reaches the stores
+                PINGS.inc(result='rejected')
+                await self.send_message({
+                    "type": "error",
+                    "error": "location_update needs a buggy_id, a numeric latitude (-90 to 90) "
+                             "and longitude (-180 to 180), and a numeric direction if any"
+                })
+            else:
+                ping = await self.update_buggy_location(
                     buggy_id, latitude, longitude, direction
                 )
+                PINGS.inc(result='accepted' if ping else 'rejected')
                 
-                if success:
-                    await self.channel_layer.group_send(
-                        "location_updates",
-                        {
-                            "type": "location_update",
-                            "buggy_id": buggy_id,
-                            "latitude": latitude,
-                            "longitude": longitude,
-                            "direction": direction,
-                            "driver_name": self.user.username,
-                            "timestamp": timezone.now().isoformat()
-                        }
+                if ping:
+                    # Students see the fix as snapped to the road
+                    await self.publish_location(
+                        buggy_id, ping.latitude, ping.longitude, direction, ping.timestamp
                     )
+
+        elif self.user.user_type == 'driver' and message_type == 'location_batch':
+            # {"buggy_id", "fixes": [{"latitude", "longitude", "direction"?,
+            # "timestamp"}, ...]}: fixes recorded while offline
+            await self.upload_location_batch(data.get('buggy_id'), data.get('fixes'))
         
         elif self.user.user_type != 'driver' and message_type == 'subscribe':
-            buggy_ids = data.get('buggy_ids', [])
+            # {"buggy_ids": [...]} replaces the current subscription,
+            # {"all": true} opts into updates from every buggy and
+            # {"delta": true} into partial updates (see tracking/delta.py).
+            buggy_ids = parse_buggy_ids(data.get('buggy_ids', []))
+            subscribe_all = data.get('all') is True
             
-            if buggy_ids:
-                self.subscribed_buggies = set(buggy_ids)
+            if buggy_ids or subscribe_all:
+                await self.update_subscription(buggy_ids, subscribe_all)
+
+                if data.get('delta') is not True:
+                    self.delta = None
+                elif self.delta is None:
+                    self.delta = DeltaEncoder(delta_precision())
                 
-                await self.send(text_data=json.dumps({
+                await self.send_message({
                     "type": "subscription_confirmed",
-                    "buggy_ids": list(self.subscribed_buggies)
-                }))
+                    "buggy_ids": sorted(self.subscribed_buggies),
+                    "all": self.subscribed_all,
+                    "delta": self.delta is not None
+                })
+
+                snapshot = get_fleet_snapshot()
+                if self.subscribed_all:
+                    await self.send_frame(await snapshot.aframe(self.codec))
+                else:
+                    await self.send_frame(
+                        await snapshot.aframe_for(self.subscribed_buggies, self.codec)
+                    )
+
+        elif self.user.user_type != 'driver' and message_type == 'subscribe_etas':
+            # {"stop_ids": [...]} -> current ETAs at those stops, then
+            # "eta_update" pushes as buggies move; [] stops the pushes
+            stop_ids = parse_buggy_ids(data.get('stop_ids', []))
+            await self.watch_stops(stop_ids)
+            await self.send_message({
+                "type": "etas",
+                "stops": await astop_etas(stop_ids) if stop_ids else []
+            })
+
+        elif message_type == 'nearby':
+            # {"latitude", "longitude", "radius"?, "limit"?} -> closest running buggies
+            try:
+                query = parse_nearby_query(data)
+            except ValueError as e:
+                await self.send_message({"type": "error", "error": str(e)})
+                return
+
+            await self.send_message({
+                "type": "nearby_buggies",
+                "buggies": await anearby_buggies(*query)
+            })
+
+        elif message_type == 'trails':
+            # {"buggy_ids"?: [...], "since"?: "5m"} -> recent positions of
+            # every running buggy (or just those), as polyline trails
+            try:
+                since = parse_trail_since(data.get('since'))
+            except ValueError as e:
+                await self.send_message({"type": "error", "error": str(e)})
+                return
+
+            buggy_ids = parse_buggy_ids(data['buggy_ids']) if 'buggy_ids' in data else None
+            trails = await get_trail_store().aget(buggy_ids, since)
+            await self.send_message({
+                "type": "trails",
+                "trails": encode_trails(trails, 'polyline')
+            })
+
+    async def update_subscription(self, buggy_ids, subscribe_all):
+        # The all-buggies group already delivers every buggy, so per-buggy
+        # groups are dropped while it is joined to avoid duplicate frames.
+        wanted = set() if subscribe_all else buggy_ids
+
+        if self.delta is not None:
+            # Buggies subscribed again later start over with full state
+            if self.subscribed_all and not subscribe_all:
+                self.delta.reset()
+            else:
+                self.delta.forget(self.subscribed_buggies - wanted)
+
+        for buggy_id in self.subscribed_buggies - wanted:
+            await self.channel_layer.group_discard(buggy_group(buggy_id), self.channel_name)
+            group_left(buggy_group(buggy_id))
+        for buggy_id in wanted - self.subscribed_buggies:
+            await self.channel_layer.group_add(buggy_group(buggy_id), self.channel_name)
+            group_joined(buggy_group(buggy_id))
+
+        if subscribe_all and not self.subscribed_all:
+            await self.channel_layer.group_add(ALL_BUGGIES_GROUP, self.channel_name)
+            group_joined(ALL_BUGGIES_GROUP)
+        elif self.subscribed_all and not subscribe_all:
+            await self.channel_layer.group_discard(ALL_BUGGIES_GROUP, self.channel_name)
+            group_left(ALL_BUGGIES_GROUP)
+
+        self.subscribed_buggies = wanted
+        self.subscribed_all = subscribe_all
     
+    async def watch_stops(self, stop_ids):
+        if stop_ids and not self.watched_stops:
+            await self.channel_layer.group_add(STOP_ETAS_GROUP, self.channel_name)
+            group_joined(STOP_ETAS_GROUP)
+        elif self.watched_stops and not stop_ids:
+            await self.channel_layer.group_discard(STOP_ETAS_GROUP, self.channel_name)
+            group_left(STOP_ETAS_GROUP)
+        self.watched_stops = stop_ids
+        self.eta_buggies = set()
+
+    async def send_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def send_message(self, message):
+        await self.send_frame(self.codec.encode(message))
+
     async def location_update(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "location_update",
-            "buggy_id": event["buggy_id"],
-            "latitude": event["latitude"],
-            "longitude": event["longitude"],
-            "direction": event["direction"],
-            "driver_name": event["driver_name"],
-            "timestamp": event["timestamp"]
-        }))
+        if getattr(self, 'delta', None) is not None:
+            update = self.delta.update(event)
+            DELTA_UPDATES.inc(result='suppressed' if update is None else 'sent')
+            if update is not None:
+                await self.send_message({"type": "location_update", **update})
+            return
+
+        # The broadcaster encodes each frame once for every recipient
+        frame = event.get(self.codec.event_key)
+        if frame is None:
+            frame = self.codec.location_update_frame(event)
+        await self.send_frame(frame)
+
+    async def location_batch(self, event):
+        if getattr(self, 'delta', None) is not None:
+            updates = self.delta.updates(event["updates"])
+            DELTA_UPDATES.inc(len(updates), result='sent')
+            DELTA_UPDATES.inc(len(event["updates"]) - len(updates), result='suppressed')
+            if updates:
+                await self.send_message({"type": "location_batch", "updates": updates})
+            return
+
+        frame = event.get(self.codec.event_key)
+        if frame is None:
+            frame = self.codec.location_batch_frame(event["updates"])
+        await self.send_frame(frame)
     
-    @database_sync_to_async
-    def update_buggy_location(self, buggy_id, latitude, longitude, direction):
-        from .models import Buggy, BuggyLocation, Location  # moved inside
-        from django.utils import timezone
+    async def eta_update(self, event):
+        # The buggy's ETAs replace what it had for the watched stops, so a
+        # buggy that no longer reaches any of them is sent once with none
+        etas = [eta for eta in event["etas"] if eta["stop_id"] in self.watched_stops]
+        if etas:
+            self.eta_buggies.add(event["buggy_id"])
+        elif event["buggy_id"] in self.eta_buggies:
+            self.eta_buggies.discard(event["buggy_id"])
+        else:
+            return
+        await self.send_message({"type": "eta_update", "buggy_id": event["buggy_id"], "etas": etas})
 
-        try:
-            buggy = Buggy.objects.get(
-                id=buggy_id, 
-                assigned_driver=self.user,
-                is_running=True
-            )
-            
-            # Always update the live location
-            buggy_location, created = BuggyLocation.objects.update_or_create(
-                buggy=buggy,
-                defaults={
-                    'latitude': latitude,
-                    'longitude': longitude,
-                    'direction': direction
-                }
-            )
-            
-            # Check if we need to create a history entry
-            # Get the most recent Location entry for this buggy
-            five_minutes_ago = timezone.now() - timedelta(minutes=5)
-            recent_history = Location.objects.filter(
-                buggy=buggy,
-                timestamp__gte=five_minutes_ago
-            ).exists()
-            
-            # If no recent history (within last 5 minutes), create a new entry
-            if not recent_history:
-                Location.objects.create(
-                    buggy=buggy,
-                    driver=self.user,
-                    latitude=latitude,
-                    longitude=longitude
+    async def publish_location(self, buggy_id, latitude, longitude, direction, timestamp):
+        # Coalesced per buggy and sent on the next broadcast tick
+        await get_broadcaster().publish({
+            "type": "location_update",
+            "buggy_id": buggy_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "direction": direction,
+            "driver_name": self.user.username,
+            "timestamp": timestamp.isoformat()
+        })
+
+    async def set_live_location(self, buggy_id, number_plate, latitude, longitude, direction, timestamp,
+                                snap=None):
+        await get_live_store().aset(buggy_id, live_entry(
+            buggy_id, number_plate, latitude, longitude, direction,
+            self.user.username, timestamp, snap,
+        ))
+        get_nearby_index().update(buggy_id, latitude, longitude)
+        await get_trail_store().aappend(
+            buggy_id, latitude, longitude, round(timestamp.timestamp() * 1000)
+        )
+        await aupdate_etas(buggy_id, latitude, longitude, direction, timestamp)
+
+    async def upload_location_batch(self, buggy_id, fixes):
+        max_fixes = ingest_setting("MAX_UPLOAD_FIXES")
+        if not buggy_id or not isinstance(fixes, list) or len(fixes) > max_fixes:
+            await self.send_message({
+                "type": "error",
+                "error": f"location_batch needs a buggy_id and a list of at most {max_fixes} fixes"
+            })
+            return
+
+        number_plate = await self.check_assigned_buggy(buggy_id)
+        if number_plate is None:
+            pings, rejected = [], len(fixes)
+        else:
+            pings, rejected = parse_fixes(buggy_id, self.user.id, fixes, timezone.now())
+        PINGS.inc(len(pings), result='accepted')
+        PINGS.inc(rejected, result='rejected')
+
+        if pings:
+            snaps = await asnap_pings(pings)
+            get_ingest_buffer().add_batch(pings)
+            # Fixes older than the buggy's trail are dropped by the store
+            await get_trail_store().aextend(buggy_id, [
+                (ping.latitude, ping.longitude, round(ping.timestamp.timestamp() * 1000))
+                for ping in pings
+            ])
+
+            # Only the newest fix moves the buggy, and only if live pings
+            # haven't already moved it further
+            newest = pings[-1]
+            current = (await get_live_store().aget_many([buggy_id]))[0]
+            if current is None or parse_datetime(current["last_updated"]) < newest.timestamp:
+                await self.set_live_location(
+                    buggy_id, number_plate, newest.latitude, newest.longitude,
+                    newest.direction, newest.timestamp, snaps[-1],
                 )
-                
-            return True
-        except Buggy.DoesNotExist:
-            return False
+                await self.publish_location(
+                    buggy_id, newest.latitude, newest.longitude, newest.direction, newest.timestamp
+                )
+
+        # Lets the app drop the fixes it has uploaded
+        await self.send_message({
+            "type": "location_batch_ack",
+            "buggy_id": buggy_id,
+            "accepted": len(pings),
+            "rejected": rejected
+        })
+
+    async def update_buggy_location(self, buggy_id, latitude, longitude, direction):
+        number_plate = await self.check_assigned_buggy(buggy_id)
+        if number_plate is None:
+            return None
+
+        ping = Ping(
+            buggy_id=buggy_id,
+            driver_id=self.user.id,
+            latitude=latitude,
+            longitude=longitude,
+            direction=direction,
+            timestamp=timezone.now(),
+        )
+        snap, = await asnap_pings([ping])
+        await self.set_live_location(
+            buggy_id, number_plate, ping.latitude, ping.longitude, direction, ping.timestamp, snap
+        )
+        get_ingest_buffer().add(ping)
+        return ping
+
+    async def check_assigned_buggy(self, buggy_id):
+        """Return the buggy's number plate if this driver may report for it."""
+        # Remember a successful check for a few seconds so steady pings
+        # don't each cost a query.
+        checked = getattr(self, '_checked_buggy', None)
+        if checked and checked[0] == buggy_id and checked[2] > time.monotonic():
+            return checked[1]
+
+        number_plate = await self.get_assigned_running_buggy(buggy_id)
+        if number_plate is None:
+            self._checked_buggy = None
+            return None
+
+        self._checked_buggy = (
+            buggy_id, number_plate, time.monotonic() + ingest_setting("BUGGY_CHECK_TTL")
+        )
+        return number_plate
+
+    @db_helper("get_assigned_running_buggy")
+    def get_assigned_running_buggy(self, buggy_id):
+        from .models import Buggy
+
+        return Buggy.objects.filter(
+            id=buggy_id,
+            assigned_driver=self.user,
+            is_running=True
+        ).values_list('number_plate', flat=True).first()
 
 
 # ------------------ Token Auth Middleware ------------------
@@ -179,16 +452,21 @@ class TokenAuthMiddleware:
         
         return await self.inner(scope, receive, send)
     
-    @database_sync_to_async
-    def get_user(self, token_key):
-        from rest_framework.authtoken.models import Token
+    async def get_user(self, token_key):
+        from users.authentication import get_token_cache
+
+        # Reconnect storms are served from the local cache tier without a thread hop
+        user = get_token_cache().get_local(token_key)
+        if user is None:
+            user = await self.resolve_user(token_key)
+        return user
+
+    @db_helper("resolve_user")
+    def resolve_user(self, token_key):
         from django.contrib.auth.models import AnonymousUser
+        from users.authentication import get_token_user
 
-        try:
-            token = Token.objects.get(key=token_key)
-            return token.user
-        except Token.DoesNotExist:
-            return AnonymousUser()
+        return get_token_user(token_key) or AnonymousUser()
 
 def TokenAuthMiddlewareStack(inner):
     from channels.auth import AuthMiddlewareStack
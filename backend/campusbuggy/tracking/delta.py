@@ -0,0 +1,84 @@
+"""
+Delta mode of the student feed.
+
+Students opt in with ``"delta": true`` on ``subscribe``. Each socket then
+remembers what it last sent per buggy and the feed's ``location_update`` and
+``location_batch`` frames carry partial updates:
+
+* the first update of a buggy on the connection has every field, with
+  coordinates rounded to ``TRACKING_BROADCAST['DELTA_PRECISION']`` decimal
+  places and the direction to whole degrees;
+* later ones have ``buggy_id``, ``dt`` (milliseconds since that buggy's
+  previous update on this socket) and only the fields that changed;
+* updates that change nothing at that precision are not sent at all.
+
+Clients merge each update into the state they keep per buggy. Frames are
+built per socket, so delta mode trades the broadcaster's encode-once frames
+for fewer bytes on the air.
+"""
+from django.conf import settings
+
+from .wire import epoch_millis
+
+DELTA_PRECISION = 5
+
+STATE_FIELDS = ("latitude", "longitude", "direction", "driver_name")
+
+
+def delta_precision():
+    return getattr(settings, "TRACKING_BROADCAST", {}).get("DELTA_PRECISION", DELTA_PRECISION)
+
+
+class DeltaEncoder:
+    """What one socket last sent per buggy, and the deltas against it."""
+
+    def __init__(self, precision=DELTA_PRECISION):
+        self.precision = precision
+        # buggy id -> (state tuple in STATE_FIELDS order, epoch millis)
+        self._sent = {}
+
+    def quantize(self, update):
+        direction = update["direction"]
+        return (
+            round(update["latitude"], self.precision),
+            round(update["longitude"], self.precision),
+            None if direction is None else round(direction),
+            update["driver_name"],
+        )
+
+    def update(self, update):
+        """The partial update to send for ``update``, or None to send nothing."""
+        buggy_id = update["buggy_id"]
+        state = self.quantize(update)
+        previous = self._sent.get(buggy_id)
+
+        if previous is None:
+            self._sent[buggy_id] = (state, epoch_millis(update["timestamp"]))
+            return {
+                "buggy_id": buggy_id,
+                **dict(zip(STATE_FIELDS, state)),
+                "timestamp": update["timestamp"],
+            }
+
+        sent_state, sent_millis = previous
+        if state == sent_state:
+            return None
+
+        millis = epoch_millis(update["timestamp"])
+        self._sent[buggy_id] = (state, millis)
+        delta = {"buggy_id": buggy_id, "dt": millis - sent_millis}
+        for field, value, sent in zip(STATE_FIELDS, state, sent_state):
+            if value != sent:
+                delta[field] = value
+        return delta
+
+    def updates(self, updates):
+        return [delta for delta in map(self.update, updates) if delta is not None]
+
+    def forget(self, buggy_ids):
+        """Send full state next time, e.g. after a buggy was unsubscribed."""
+        for buggy_id in buggy_ids:
+            self._sent.pop(buggy_id, None)
+
+    def reset(self):
+        self._sent.clear()
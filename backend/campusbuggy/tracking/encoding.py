@@ -0,0 +1,121 @@
+"""
+Compact encodings for location trails.
+
+A trail of thousands of ``{latitude, longitude, timestamp}`` dicts is mostly
+repeated keys and digits. Trail endpoints can instead return:
+
+``polyline``
+    Coordinates as a Google encoded polyline (precision 5, ~1 m) and the
+    timestamps as millisecond deltas encoded with the same varint alphabet.
+
+``columnar``
+    Plain JSON integer columns: coordinates scaled by ``10**precision`` and
+    delta-encoded, timestamps as millisecond deltas from ``start``.
+
+Both are built with numpy over whole columns rather than per-row dicts.
+"""
+import numpy as np
+
+from .history import format_timestamp
+
+TRAIL_FORMATS = ('polyline', 'columnar')
+
+POLYLINE_PRECISION = 5
+COLUMNAR_PRECISION = 6
+
+# 5-bit groups needed for any zigzagged 64-bit value
+_MAX_GROUPS = 13
+_SHIFTS = np.arange(_MAX_GROUPS, dtype=np.int64) * 5
+
+
+def columns_from_rows(rows):
+    """Split history rows ``(id, latitude, longitude, timestamp)`` into column arrays."""
+    if not rows:
+        return np.empty(0), np.empty(0), []
+    _, latitudes, longitudes, timestamps = zip(*rows)
+    return np.asarray(latitudes, dtype=np.float64), np.asarray(longitudes, dtype=np.float64), timestamps
+
+
+def epoch_millis(timestamps):
+    return np.fromiter(
+        (round(ts.timestamp() * 1000) for ts in timestamps), dtype=np.int64, count=len(timestamps)
+    )
+
+
+def deltas(values):
+    return np.diff(values, prepend=values.dtype.type(0))
+
+
+def encode_varints(values):
+    """
+    Encode signed integers with the encoded-polyline algorithm: zigzag, then
+    little-endian 5-bit groups offset by 63, with 0x20 marking continuation.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if values.size == 0:
+        return ""
+
+    zigzag = (values << 1) ^ (values >> 63)
+    shifted = zigzag[:, None] >> _SHIFTS
+    groups = shifted & 31
+
+    # Number of 5-bit groups per value (at least one, even for zero)
+    counts = np.maximum(1, np.count_nonzero(shifted, axis=1))
+
+    index = np.arange(_MAX_GROUPS)
+    used = index < counts[:, None]
+    continued = index < (counts - 1)[:, None]
+    chars = groups + 63 + (continued * 0x20)
+    return chars[used].astype(np.uint8).tobytes().decode('ascii')
+
+
+def decode_varints(text):
+    values, current, shift = [], 0, 0
+    for char in text.encode('ascii'):
+        chunk = char - 63
+        current |= (chunk & 31) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(current >> 1) if current & 1 else current >> 1)
+            current, shift = 0, 0
+    return values
+
+
+def encode_trail(fmt, latitudes, longitudes, timestamps):
+    """Encode a trail as ``fmt`` (one of TRAIL_FORMATS)."""
+    start = format_timestamp(timestamps[0]) if len(timestamps) else None
+    return encode_millis_trail(fmt, latitudes, longitudes, epoch_millis(timestamps), start)
+
+
+def encode_millis_trail(fmt, latitudes, longitudes, millis, start):
+    """``encode_trail`` for timestamps already in epoch milliseconds."""
+    count = len(millis)
+    times = deltas(millis - millis[0]) if count else millis
+
+    if fmt == 'polyline':
+        scale = 10 ** POLYLINE_PRECISION
+        coordinates = np.empty(count * 2, dtype=np.int64)
+        coordinates[0::2] = deltas(np.round(latitudes * scale).astype(np.int64))
+        coordinates[1::2] = deltas(np.round(longitudes * scale).astype(np.int64))
+        return {
+            "format": "polyline",
+            "precision": POLYLINE_PRECISION,
+            "count": count,
+            "start": start,
+            "polyline": encode_varints(coordinates),
+            "times": encode_varints(times),
+        }
+
+    if fmt == 'columnar':
+        scale = 10 ** COLUMNAR_PRECISION
+        return {
+            "format": "columnar",
+            "precision": COLUMNAR_PRECISION,
+            "count": count,
+            "start": start,
+            "latitude": deltas(np.round(latitudes * scale).astype(np.int64)).tolist(),
+            "longitude": deltas(np.round(longitudes * scale).astype(np.int64)).tolist(),
+            "time": times.tolist(),
+        }
+
+    raise ValueError(f"Unknown trail format {fmt!r}")
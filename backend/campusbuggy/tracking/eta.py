@@ -0,0 +1,328 @@
+"""
+Estimated arrival times of running buggies at campus stops.
+
+``EtaEngine`` keeps every active ``Stop`` as numpy columns and, per buggy,
+its smoothed speed and heading. Each accepted ping updates that buggy's
+motion and recomputes its ETA to every stop at once with array operations,
+so a ping costs one vectorized pass over the stops and no queries. The
+results are cached per buggy as one row of ETAs and distances; reads age
+them by the time since they were computed.
+
+The estimate is deliberately simple: straight-line distance times
+``ROUTE_FACTOR`` (paths on campus are longer than the crow flies), divided
+by the buggy's recent speed (never below ``MIN_SPEED``), plus up to
+``TURN_PENALTY`` of that time for stops behind the buggy's heading.
+
+ETAs are served by ``StopEtaView`` and pushed to sockets that sent
+``subscribe_etas``, at most every ``PUSH_INTERVAL`` seconds per buggy.
+
+The engine lives in the worker process. With a shared trail store (Redis),
+buggies pinging other workers are picked up from their trails at most every
+``REFRESH_INTERVAL`` seconds. Stops are reloaded when they are edited here,
+and at least every ``STOPS_REFRESH`` seconds for edits made elsewhere.
+"""
+import math
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .executor import get_db_executor
+from .geo import EARTH_RADIUS_M, bearing, haversine, to_xy
+from .groups import STOP_ETAS_GROUP
+from .trails import get_trail_store
+
+DEFAULTS = {
+    "ROUTE_FACTOR": 1.3,        # path length / straight-line distance
+    "DEFAULT_SPEED": 4.0,       # m/s until a buggy has been seen moving
+    "MIN_SPEED": 1.0,           # m/s floor for buggies standing still
+    "SPEED_SMOOTHING": 0.3,     # weight of the newest speed sample
+    "MIN_MOVE": 5.0,            # metres moved before the heading is updated
+    "TURN_PENALTY": 1.0,        # extra fraction of the ETA for a stop behind
+    "ARRIVAL_RADIUS": 30.0,     # metres; closer counts as at the stop
+    "MAX_ETA": 1800,            # seconds; later arrivals are not reported
+    "PUSH_INTERVAL": 5.0,       # seconds between pushes per buggy
+    "REFRESH_INTERVAL": 5.0,    # seconds, shared trail stores only
+    "STOPS_REFRESH": 60.0,      # seconds
+}
+
+
+def eta_setting(name):
+    return getattr(settings, "TRACKING_ETA", {}).get(name, DEFAULTS[name])
+
+
+@dataclass(slots=True)
+class Motion:
+    latitude: float
+    longitude: float
+    millis: int
+    speed: float
+    heading: float | None
+
+
+@dataclass(slots=True)
+class EtaRow:
+    """A buggy's ETA (seconds) and distance (metres) to every stop, as computed at ``millis``."""
+    etas: np.ndarray
+    distances: np.ndarray
+    millis: int
+
+
+class EtaEngine:
+    def __init__(self, route_factor=1.3, default_speed=4.0, min_speed=1.0, speed_smoothing=0.3,
+                 min_move=5.0, turn_penalty=1.0, arrival_radius=30.0, max_eta=1800,
+                 push_interval=5.0, stops_refresh=60.0):
+        self.route_factor = route_factor
+        self.default_speed = default_speed
+        self.min_speed = min_speed
+        self.speed_smoothing = speed_smoothing
+        self.min_move = min_move
+        self.turn_penalty = turn_penalty
+        self.arrival_radius = arrival_radius
+        self.max_eta = max_eta
+        self.push_interval = round(push_interval * 1000)
+        self.stops_refresh = stops_refresh
+
+        self._lock = threading.Lock()
+        self.stop_ids = np.empty(0, dtype=np.int64)
+        self.stop_names = []
+        self._stop_index = {}
+        self._stop_latitudes = np.empty(0, dtype=np.float64)
+        self._stop_longitudes = np.empty(0, dtype=np.float64)
+        self.stops_loaded_at = None
+
+        self._motion = {}
+        self._rows = {}
+        # buggy_id -> epoch millis of its last push
+        self._pushed = {}
+        self.synced_at = None
+
+        self.updates = 0
+        self.pushes = 0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            route_factor=eta_setting("ROUTE_FACTOR"),
+            default_speed=eta_setting("DEFAULT_SPEED"),
+            min_speed=eta_setting("MIN_SPEED"),
+            speed_smoothing=eta_setting("SPEED_SMOOTHING"),
+            min_move=eta_setting("MIN_MOVE"),
+            turn_penalty=eta_setting("TURN_PENALTY"),
+            arrival_radius=eta_setting("ARRIVAL_RADIUS"),
+            max_eta=eta_setting("MAX_ETA"),
+            push_interval=eta_setting("PUSH_INTERVAL"),
+            stops_refresh=eta_setting("STOPS_REFRESH"),
+        )
+
+    def stats(self):
+        return {
+            "stops": len(self.stop_ids),
+            "buggies": len(self._rows),
+            "updates": self.updates,
+            "pushes": self.pushes,
+        }
+
+    # ------------------ Stops ------------------
+
+    @property
+    def needs_stops(self):
+        return (
+            self.stops_loaded_at is None
+            or time.monotonic() - self.stops_loaded_at > self.stops_refresh
+        )
+
+    def invalidate_stops(self):
+        self.stops_loaded_at = None
+
+    def load_stops(self):
+        from .models import Stop
+
+        self.set_stops(Stop.objects.filter(is_active=True).order_by('id').values_list(
+            'id', 'name', 'latitude', 'longitude'
+        ))
+
+    def set_stops(self, stops):
+        """Replace the stops with ``(id, name, latitude, longitude)`` and recompute every buggy."""
+        stops = list(stops)
+        with self._lock:
+            self.stop_ids = np.fromiter((stop[0] for stop in stops), dtype=np.int64, count=len(stops))
+            self.stop_names = [stop[1] for stop in stops]
+            self._stop_index = {stop[0]: index for index, stop in enumerate(stops)}
+            self._stop_latitudes = np.fromiter((stop[2] for stop in stops), dtype=np.float64, count=len(stops))
+            self._stop_longitudes = np.fromiter((stop[3] for stop in stops), dtype=np.float64, count=len(stops))
+            self._rows = {
+                buggy_id: self._compute(motion) for buggy_id, motion in self._motion.items()
+            }
+            self.stops_loaded_at = time.monotonic()
+
+    # ------------------ Updates ------------------
+
+    def update(self, buggy_id, latitude, longitude, millis, direction=None):
+        """
+        Record a buggy's position and recompute its ETAs. Returns them as
+        ``buggy_etas`` does if they are due to be pushed, else None.
+        """
+        with self._lock:
+            motion = self._motion.get(buggy_id)
+            if motion is not None and millis <= motion.millis:
+                return None
+            self._motion[buggy_id] = motion = self._advance(motion, latitude, longitude, millis, direction)
+            row = self._rows[buggy_id] = self._compute(motion)
+            self.updates += 1
+
+            if millis - self._pushed.get(buggy_id, 0) < self.push_interval:
+                return None
+            self._pushed[buggy_id] = millis
+            self.pushes += 1
+            return self.buggy_etas(row, millis)
+
+    def _advance(self, motion, latitude, longitude, millis, direction):
+        if motion is None:
+            return Motion(latitude, longitude, millis, self.default_speed, direction)
+
+        moved = haversine(motion.latitude, motion.longitude, latitude, longitude)
+        sample = moved / ((millis - motion.millis) / 1000)
+        speed = motion.speed + self.speed_smoothing * (sample - motion.speed)
+
+        if moved >= self.min_move:
+            x, y = to_xy(latitude, longitude, motion.latitude, motion.longitude)
+            heading = bearing(0.0, 0.0, x, y)
+        elif direction is not None:
+            heading = direction
+        else:
+            heading = motion.heading
+        return Motion(latitude, longitude, millis, speed, heading)
+
+    def _compute(self, motion):
+        # Equirectangular offsets to every stop (see tracking/geo.py)
+        scale = math.pi / 180 * EARTH_RADIUS_M
+        x = (self._stop_longitudes - motion.longitude) * (scale * math.cos(math.radians(motion.latitude)))
+        y = (self._stop_latitudes - motion.latitude) * scale
+        distances = np.hypot(x, y)
+
+        etas = distances * (self.route_factor / max(motion.speed, self.min_speed))
+        if motion.heading is not None and self.turn_penalty:
+            # 0 for a stop straight ahead, 1 for one straight behind
+            offset = np.arctan2(x, y) - math.radians(motion.heading)
+            etas *= 1 + self.turn_penalty * (1 - np.cos(offset)) / 2
+        etas[distances <= self.arrival_radius] = 0.0
+        return EtaRow(etas, distances, motion.millis)
+
+    def remove(self, buggy_ids):
+        with self._lock:
+            for buggy_id in buggy_ids:
+                self._motion.pop(buggy_id, None)
+                self._rows.pop(buggy_id, None)
+                self._pushed.pop(buggy_id, None)
+
+    def sync(self, trails):
+        """Pick up buggies from ``TrailStore.get`` whose pings this worker hasn't seen."""
+        self.remove(set(self._motion) - set(trails))
+        for buggy_id, (latitudes, longitudes, millis) in trails.items():
+            for latitude, longitude, ms in zip(latitudes.tolist(), longitudes.tolist(), millis.tolist()):
+                self.update(buggy_id, latitude, longitude, ms)
+        self.synced_at = time.monotonic()
+
+    # ------------------ Reads ------------------
+
+    def reported(self, row, now_millis, indexes=None):
+        """``(stop index, eta, distance)`` of a row at ``now_millis``, within ``MAX_ETA``."""
+        etas, distances = row.etas, row.distances
+        if indexes is None:
+            indexes = np.arange(len(etas))
+        etas = np.maximum(etas[indexes] - (now_millis - row.millis) / 1000, 0.0)
+        keep = etas <= self.max_eta
+        return zip(indexes[keep].tolist(), etas[keep].tolist(), distances[indexes][keep].tolist())
+
+    def buggy_etas(self, row, now_millis):
+        """``[{"stop_id", "eta", "distance"}]`` of one buggy's row; call with the lock held."""
+        return [
+            {"stop_id": int(self.stop_ids[index]), "eta": round(eta), "distance": round(distance, 1)}
+            for index, eta, distance in self.reported(row, now_millis)
+        ]
+
+    def stop_etas(self, stop_ids=None, now_millis=None):
+        """
+        ``[{"stop_id", "name", "etas": [{"buggy_id", "eta", "distance"}]}]``
+        for ``stop_ids`` (default every stop), soonest buggy first.
+        """
+        now_millis = now_millis or round(time.time() * 1000)
+        with self._lock:
+            if stop_ids is None:
+                indexes = np.arange(len(self.stop_ids))
+            else:
+                indexes = np.array(sorted(
+                    self._stop_index[stop_id] for stop_id in stop_ids if stop_id in self._stop_index
+                ), dtype=np.int64)
+            by_stop = {index: [] for index in indexes.tolist()}
+            for buggy_id, row in self._rows.items():
+                for index, eta, distance in self.reported(row, now_millis, indexes):
+                    by_stop[index].append({"buggy_id": buggy_id, "eta": round(eta), "distance": round(distance, 1)})
+
+            return [
+                {
+                    "stop_id": int(self.stop_ids[index]),
+                    "name": self.stop_names[index],
+                    "etas": sorted(etas, key=lambda item: item["eta"]),
+                }
+                for index, etas in by_stop.items()
+            ]
+
+
+def needs_sync(engine, trails):
+    return trails.shared and (
+        engine.synced_at is None
+        or time.monotonic() - engine.synced_at > eta_setting("REFRESH_INTERVAL")
+    )
+
+
+def stop_etas(stop_ids=None):
+    engine = get_eta_engine()
+    if engine.needs_stops:
+        engine.load_stops()
+    trails = get_trail_store()
+    if needs_sync(engine, trails):
+        engine.sync(trails.get())
+    return engine.stop_etas(stop_ids)
+
+
+async def astop_etas(stop_ids=None):
+    engine = get_eta_engine()
+    if engine.needs_stops or needs_sync(engine, get_trail_store()):
+        return await sync_to_async(stop_etas)(stop_ids)
+    return engine.stop_etas(stop_ids)
+
+
+async def aupdate_etas(buggy_id, latitude, longitude, direction, timestamp):
+    """Recompute a buggy's ETAs after a ping and push them when due."""
+    engine = get_eta_engine()
+    if engine.needs_stops:
+        await get_db_executor().run(engine.load_stops, helper="load_stops")
+
+    etas = engine.update(buggy_id, latitude, longitude, round(timestamp.timestamp() * 1000), direction)
+    if etas is not None:
+        await publish_etas(buggy_id, etas)
+
+
+async def publish_etas(buggy_id, etas):
+    # Each socket picks out the stops it watches; an empty list withdraws the buggy
+    await get_channel_layer().group_send(STOP_ETAS_GROUP, {
+        "type": "eta_update",
+        "buggy_id": buggy_id,
+        "etas": etas,
+    })
+
+
+_engine = None
+
+
+def get_eta_engine():
+    global _engine
+    if _engine is None:
+        _engine = EtaEngine.from_settings()
+    return _engine
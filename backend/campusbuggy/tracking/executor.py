@@ -0,0 +1,124 @@
+"""
+Dedicated threads for the tracking app's blocking database calls.
+
+``database_sync_to_async`` runs every call on the single thread shared by all
+thread-sensitive sync code in the process, so under load pings queue behind
+each other's buggy checks, token lookups and ingest flushes. Django's async
+ORM methods (``aget``, ``afirst``, ``aexists``...) are ``sync_to_async``
+wrappers around the same thread and don't avoid that queue.
+
+Helpers decorated with ``db_helper`` run instead on a pool of
+``TRACKING_DB_EXECUTOR['MAX_WORKERS']`` threads. Each thread has its own
+database connection, checked around every call like
+``database_sync_to_async`` does. ``MAX_WORKERS`` of 0 keeps the shared
+thread. Left unset it is 4, or 1 on SQLite: SQLite takes one writer at a
+time, and concurrent writer threads fail with "database is locked" under
+load instead of running faster. Every call records how long it queued for a
+thread and how long it ran (see tracking/metrics.py).
+"""
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .metrics import DB_POOL_WAIT_SECONDS, DB_SECONDS
+
+MAX_WORKERS = 4
+
+
+def default_max_workers():
+    if settings.DATABASES["default"]["ENGINE"] == "django.db.backends.sqlite3":
+        return 1
+    return MAX_WORKERS
+
+
+class DatabaseExecutor:
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self._pool = None
+        if max_workers > 0:
+            self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="tracking-db")
+
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.running = 0
+        self.calls = 0
+
+    @classmethod
+    def from_settings(cls):
+        config = getattr(settings, "TRACKING_DB_EXECUTOR", {})
+        max_workers = config.get("MAX_WORKERS")
+        return cls(max_workers=default_max_workers() if max_workers is None else max_workers)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "calls": self.calls,
+                "running": self.running,
+                # Cancelled callers can leave a call briefly counted twice
+                "queued": max(0, self.in_flight - self.running),
+            }
+
+    def wrap(self, func, helper):
+        """An async callable running ``func`` on this executor."""
+        def run(queued_at, *args, **kwargs):
+            started = time.perf_counter()
+            DB_POOL_WAIT_SECONDS.observe(started - queued_at, helper=helper)
+            with self._lock:
+                self.running += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                DB_SECONDS.observe(time.perf_counter() - started, helper=helper)
+
+        if self._pool is None:
+            run_async = database_sync_to_async(run)
+        else:
+            run_async = database_sync_to_async(run, thread_sensitive=False, executor=self._pool)
+
+        async def call(*args, **kwargs):
+            with self._lock:
+                self.in_flight += 1
+                self.calls += 1
+            try:
+                return await run_async(time.perf_counter(), *args, **kwargs)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+
+        return call
+
+    async def run(self, func, *args, helper, **kwargs):
+        return await self.wrap(func, helper)(*args, **kwargs)
+
+
+_executor = None
+
+
+def get_db_executor():
+    global _executor
+    if _executor is None:
+        _executor = DatabaseExecutor.from_settings()
+    return _executor
+
+
+def db_helper(helper):
+    """Run the decorated sync function on the DB executor when awaited."""
+    def decorator(func):
+        call = None
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            nonlocal call
+            if call is None:
+                call = get_db_executor().wrap(func, helper)
+            return await call(*args, **kwargs)
+
+        return wrapper
+    return decorator
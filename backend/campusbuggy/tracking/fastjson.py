@@ -0,0 +1,65 @@
+"""
+Pluggable JSON encoding for outbound frames and tracking responses.
+
+``TRACKING_JSON['ENCODER']`` picks the ``dumps(obj) -> bytes`` used by the
+broadcaster, snapshot frames and ``FastJSONRenderer``:
+
+``auto``
+    orjson when it is installed, otherwise the standard library.
+``orjson`` / ``json``
+    Force one of the two.
+a dotted path
+    Any callable taking an object and returning UTF-8 JSON bytes.
+
+Values the encoder doesn't know (Decimals, lazy strings, ...) fall back to
+DRF's ``JSONEncoder``.
+"""
+import json
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_fallback = JSONEncoder()
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj, default=_fallback.default)
+
+
+def stdlib_dumps(obj):
+    return json.dumps(
+        obj, cls=JSONEncoder, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode()
+
+
+def load_encoder(name):
+    if name == "auto":
+        return orjson_dumps if orjson is not None else stdlib_dumps
+    if name == "orjson":
+        if orjson is None:
+            raise ImportError("TRACKING_JSON['ENCODER'] is 'orjson' but orjson is not installed")
+        return orjson_dumps
+    if name == "json":
+        return stdlib_dumps
+    return import_string(name)
+
+
+_dumps = None
+
+
+def dumps_bytes(obj):
+    global _dumps
+    if _dumps is None:
+        _dumps = load_encoder(getattr(settings, "TRACKING_JSON", {}).get("ENCODER", "auto"))
+    return _dumps(obj)
+
+
+def dumps(obj):
+    """Encode ``obj`` as a JSON ``str``, e.g. for WebSocket text frames."""
+    return dumps_bytes(obj).decode()
@@ -0,0 +1,54 @@
+"""
+Small geometry helpers for campus-scale distances.
+
+Buggies move within a few kilometres, so an equirectangular projection around
+a reference point is accurate to well under a metre and much cheaper than
+great-circle maths on the hot path.
+"""
+import math
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def to_xy(lat, lon, lat0, lon0):
+    """Project ``(lat, lon)`` to metres east/north of ``(lat0, lon0)``."""
+    x = math.radians(lon - lon0) * math.cos(math.radians(lat0)) * EARTH_RADIUS_M
+    y = math.radians(lat - lat0) * EARTH_RADIUS_M
+    return x, y
+
+
+def bearing(x1, y1, x2, y2):
+    """Compass bearing in degrees of the projected segment (x1, y1) -> (x2, y2)."""
+    return math.degrees(math.atan2(x2 - x1, y2 - y1)) % 360
+
+
+def angle_between(a, b):
+    """Smallest difference between two bearings, in degrees."""
+    diff = abs(a - b) % 360
+    return 360 - diff if diff > 180 else diff
+
+
+def point_segment_distance(px, py, ax, ay, bx, by):
+    """Distance from P to segment AB in projected metres."""
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    if length2 == 0:
+        return math.hypot(px - ax, py - ay)
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length2))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def from_xy(x, y, lat0, lon0):
+    """Inverse of ``to_xy``."""
+    lat = lat0 + math.degrees(y / EARTH_RADIUS_M)
+    lon = lon0 + math.degrees(x / (EARTH_RADIUS_M * math.cos(math.radians(lat0))))
+    return lat, lon
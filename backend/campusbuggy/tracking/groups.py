@@ -0,0 +1,27 @@
+"""
+Channel group names used for location fan-out.
+
+Every update is sent to the group of its buggy and to ``ALL_BUGGIES_GROUP``.
+Student sockets join only the groups they subscribed to, so an update reaches
+the sockets watching that buggy plus those that explicitly asked for all.
+"""
+
+ALL_BUGGIES_GROUP = "location_updates"
+
+# Sockets watching stop ETAs (see tracking/eta.py)
+STOP_ETAS_GROUP = "stop_etas"
+
+
+def buggy_group(buggy_id):
+    return f"buggy_{buggy_id}"
+
+
+def parse_buggy_ids(values):
+    """Return the valid integer buggy ids in ``values``, ignoring anything else."""
+    buggy_ids = set()
+    for value in values if isinstance(values, list) else []:
+        try:
+            buggy_ids.add(int(value))
+        except (TypeError, ValueError):
+            continue
+    return buggy_ids
@@ -0,0 +1,336 @@
+"""
+Usage heatmaps: where the buggies spent their time, by hour of day, over any
+range of days.
+
+Positions are binned into a fixed grid over the campus,
+``TRACKING_HEATMAP['BOUNDS']`` split into ``CELL_SIZE`` metre cells, with one
+layer per local hour of day. Each day is one ``HeatmapDay`` row holding its
+``(24, rows, cols)`` buggy-seconds as a zlib-compressed array, so a week is
+seven small blobs however many fixes it had.
+
+History keeps only the points the simplifier marks as significant: corners
+and gap ends, not evenly timed samples. Binning those points would pile the
+weight onto turns. Instead every interval between consecutive points of a
+buggy (up to ``MAX_GAP`` seconds long) is resampled along the straight line
+between them every ``SAMPLE_INTERVAL`` seconds, and each sample weighs the
+seconds it stands for. Straight runs and long stops count for as long as
+they lasted (see ``dwell_samples``).
+
+Counts are kept up to date as history is written: ``IngestBuffer`` hands
+every flushed batch of history rows to a ``HeatmapAccumulator``, which bins
+them with ``np.bincount`` and merges its pending counts into the day rows
+every ``FLUSH_INTERVAL`` seconds. ``manage.py rebuild_heatmap`` recomputes
+whole days from stored history (and per-minute rollups of pruned months) in
+the same way.
+
+``HeatmapView`` decodes the requested days and adds them up as arrays; raw
+points are never scanned or grouped in SQL at request time.
+
+Changing the bounds or cell size starts a new grid: days binned with the old
+one are ignored until they are rebuilt.
+"""
+import math
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .geo import EARTH_RADIUS_M
+
+DEFAULTS = {
+    # south, west, north, east
+    "BOUNDS": (12.955, 77.578, 12.988, 77.611),
+    "CELL_SIZE": 50.0,          # metres
+    "SAMPLE_INTERVAL": 10.0,    # seconds between samples of an interval
+    "MAX_GAP": 600.0,           # seconds; longer intervals aren't counted
+    "FLUSH_INTERVAL": 60.0,     # seconds
+    "DEFAULT_DAYS": 7,
+    "MAX_DAYS": 366,
+}
+
+HOURS = 24
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+# Every UTC offset in use is a whole number of quarter hours
+_OFFSET_QUANTUM = 900
+
+
+def heatmap_setting(name):
+    return getattr(settings, "TRACKING_HEATMAP", {}).get(name, DEFAULTS[name])
+
+
+class HeatmapGrid:
+    def __init__(self, bounds, cell_size):
+        south, west, north, east = bounds
+        self.bounds = (south, west, north, east)
+        self.cell_size = cell_size
+        self.lat_step = cell_size / METRES_PER_DEGREE
+        self.lon_step = self.lat_step / math.cos(math.radians((south + north) / 2))
+        self.rows = max(1, math.ceil((north - south) / self.lat_step))
+        self.cols = max(1, math.ceil((east - west) / self.lon_step))
+        self.shape = (HOURS, self.rows, self.cols)
+        self.size = HOURS * self.rows * self.cols
+        # Stored with every day so counts from another grid (or of fixes
+        # rather than seconds, as first stored) are never mixed in
+        self.key = f"{south},{west},{north},{east}/{cell_size}/seconds"
+
+    @classmethod
+    def from_settings(cls):
+        return cls(heatmap_setting("BOUNDS"), heatmap_setting("CELL_SIZE"))
+
+    def bin(self, latitudes, longitudes, hours, weights):
+        """Flat ``(hour, row, col)`` sums of ``weights``, and the sum outside the grid."""
+        south, west = self.bounds[0], self.bounds[1]
+        rows = np.floor((np.asarray(latitudes, dtype=np.float64) - south) / self.lat_step).astype(np.int64)
+        cols = np.floor((np.asarray(longitudes, dtype=np.float64) - west) / self.lon_step).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+
+        flat = (np.asarray(hours, dtype=np.int64)[inside] * self.rows + rows[inside]) * self.cols + cols[inside]
+        weights = np.asarray(weights, dtype=np.float64)
+        counts = np.bincount(flat, weights=weights[inside], minlength=self.size)
+        return counts, float(weights[~inside].sum())
+
+    def encode(self, counts):
+        return zlib.compress(np.ascontiguousarray(counts, dtype='<u4').tobytes(), 6)
+
+    def decode(self, blob):
+        return np.frombuffer(zlib.decompress(blob), dtype='<u4').reshape(self.shape)
+
+
+def dwell_samples(buggy_ids, latitudes, longitudes, seconds, step, max_gap):
+    """
+    Resample consecutive points of each buggy (sorted by buggy, then time;
+    ``seconds`` since the epoch) every ``step`` seconds along the line
+    between them. Returns sample latitudes, longitudes, times and the seconds
+    each sample stands for. Intervals over ``max_gap`` are skipped.
+    """
+    buggy_ids = np.asarray(buggy_ids)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    seconds = np.asarray(seconds, dtype=np.float64)
+
+    gaps = np.diff(seconds)
+    pairs = np.flatnonzero((buggy_ids[1:] == buggy_ids[:-1]) & (gaps > 0) & (gaps <= max_gap))
+    gaps = gaps[pairs]
+    per_pair = np.maximum(np.ceil(gaps / step), 1).astype(np.int64)
+
+    pair = np.repeat(pairs, per_pair)
+    count = np.repeat(per_pair, per_pair)
+    index = np.arange(len(pair)) - np.repeat(np.cumsum(per_pair) - per_pair, per_pair)
+    fraction = (index + 0.5) / count
+    return (
+        latitudes[pair] + fraction * (latitudes[pair + 1] - latitudes[pair]),
+        longitudes[pair] + fraction * (longitudes[pair + 1] - longitudes[pair]),
+        seconds[pair] + fraction * (seconds[pair + 1] - seconds[pair]),
+        np.repeat(gaps / per_pair, per_pair),
+    )
+
+
+def local_days_and_hours(seconds):
+    """Local date ordinal and hour of day of each time in seconds since the epoch."""
+    quanta, inverse = np.unique(
+        np.floor(np.asarray(seconds, dtype=np.float64) / _OFFSET_QUANTUM).astype(np.int64),
+        return_inverse=True,
+    )
+    # One localtime() per quarter hour rather than per sample
+    local = [
+        timezone.localtime(datetime.fromtimestamp(quantum * _OFFSET_QUANTUM, tz=dt_timezone.utc))
+        for quantum in quanta.tolist()
+    ]
+    days = np.array([value.toordinal() for value in local], dtype=np.int64)
+    hours = np.array([value.hour for value in local], dtype=np.int64)
+    return days[inverse], hours[inverse]
+
+
+def bin_by_day(grid, latitudes, longitudes, seconds, weights):
+    """``{date: (flat seconds, outside)}`` of weighted samples spanning any number of days."""
+    days, hours = local_days_and_hours(seconds)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    binned = {}
+    for ordinal in np.unique(days).tolist():
+        mask = days == ordinal
+        binned[date.fromordinal(ordinal)] = grid.bin(
+            latitudes[mask], longitudes[mask], hours[mask], weights[mask]
+        )
+    return binned
+
+
+def save_day(grid, day, counts, outside):
+    """Add ``counts`` to the stored day in one locked read-modify-write."""
+    from .models import HeatmapDay
+
+    counts = np.rint(counts).astype(np.uint64)
+    outside = round(outside)
+    with transaction.atomic():
+        row, created = HeatmapDay.objects.select_for_update().get_or_create(
+            date=day, grid=grid.key,
+            defaults={
+                "counts": grid.encode(counts),
+                "total": int(counts.sum()),
+                "outside": outside,
+            },
+        )
+        if created:
+            return
+        counts = counts + grid.decode(bytes(row.counts)).ravel()
+        outside += row.outside
+        row.counts = grid.encode(counts)
+        row.total = int(counts.sum())
+        row.outside = outside
+        row.save(update_fields=["counts", "total", "outside", "updated_at"])
+
+
+class HeatmapAccumulator:
+    """Buggy-seconds of written history not yet merged into ``HeatmapDay`` rows."""
+
+    def __init__(self, grid, sample_interval=10.0, max_gap=600.0, flush_interval=60.0):
+        self.grid = grid
+        self.sample_interval = sample_interval
+        self.max_gap = max_gap
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # date -> [flat seconds, outside]
+        self._pending = {}
+        # buggy_id -> (seconds, latitude, longitude) of its newest point
+        self._last = {}
+        self._flushed_at = time.monotonic()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            HeatmapGrid.from_settings(),
+            sample_interval=heatmap_setting("SAMPLE_INTERVAL"),
+            max_gap=heatmap_setting("MAX_GAP"),
+            flush_interval=heatmap_setting("FLUSH_INTERVAL"),
+        )
+
+    @property
+    def pending(self):
+        return bool(self._pending)
+
+    def add(self, pings):
+        if not pings:
+            return
+        with self._lock:
+            # Each buggy's points continue from its newest one of earlier batches;
+            # late uploads from before it can't be placed and are left out
+            rows = []
+            for ping in pings:
+                last = self._last.get(ping.buggy_id)
+                seconds = ping.timestamp.timestamp()
+                if last is None or seconds > last[0]:
+                    rows.append((ping.buggy_id, seconds, ping.latitude, ping.longitude))
+            previous = [
+                (buggy_id, *self._last[buggy_id])
+                for buggy_id in {row[0] for row in rows} if buggy_id in self._last
+            ]
+            rows = sorted(previous + rows)
+            for buggy_id, seconds, latitude, longitude in rows:
+                self._last[buggy_id] = (seconds, latitude, longitude)
+        if len(rows) < 2:
+            return
+
+        buggy_ids, seconds, latitudes, longitudes = zip(*rows)
+        binned = bin_by_day(self.grid, *dwell_samples(
+            buggy_ids, latitudes, longitudes, seconds, self.sample_interval, self.max_gap
+        ))
+        with self._lock:
+            for day, (counts, outside) in binned.items():
+                pending = self._pending.get(day)
+                if pending is None:
+                    self._pending[day] = [counts, outside]
+                else:
+                    pending[0] += counts
+                    pending[1] += outside
+
+    def flush(self, force=False):
+        """Merge pending counts into the day rows if ``FLUSH_INTERVAL`` has passed."""
+        with self._lock:
+            if not self._pending:
+                return
+            if not force and time.monotonic() - self._flushed_at < self.flush_interval:
+                return
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+
+        for day, (counts, outside) in pending.items():
+            save_day(self.grid, day, counts, outside)
+
+
+def parse_hours(value):
+    """Hours of day from ``"7-9,17"``; raises ValueError."""
+    hours = set()
+    for part in value.split(','):
+        first, _, last = part.partition('-')
+        first, last = int(first), int(last or first)
+        if not (0 <= first <= last < HOURS):
+            raise ValueError("hours must be 0-23, as in '7-9,17'")
+        hours.update(range(first, last + 1))
+    return sorted(hours)
+
+
+def parse_heatmap_range(params):
+    """
+    ``(first, last)`` local dates from ``start``/``end`` (YYYY-MM-DD, ``end``
+    defaulting to today) or else the last ``days`` days. Raises ValueError.
+    """
+    today = timezone.localdate()
+    if 'start' in params:
+        first = date.fromisoformat(params['start'])
+        last = date.fromisoformat(params['end']) if 'end' in params else today
+    else:
+        days = int(params.get('days', heatmap_setting("DEFAULT_DAYS")))
+        if days < 1:
+            raise ValueError("days must be positive")
+        first, last = today - timedelta(days=days - 1), today
+    if last < first:
+        raise ValueError("'end' is before 'start'")
+    if (last - first).days >= heatmap_setting("MAX_DAYS"):
+        raise ValueError(f"At most {heatmap_setting('MAX_DAYS')} days")
+    return first, last
+
+
+def heatmap(first, last, hours=None, grid=None):
+    """
+    The buggy-seconds of every stored day in ``[first, last]`` added up:
+    non-empty cells as ``[row, col, seconds]`` (row 0 is the southern edge,
+    col 0 the western) over ``hours`` (default all), and totals per hour of day.
+    """
+    from .models import HeatmapDay
+
+    grid = grid or HeatmapGrid.from_settings()
+    days = HeatmapDay.objects.filter(
+        grid=grid.key, date__gte=first, date__lte=last
+    ).values_list('counts', 'outside')
+
+    counts = np.zeros(grid.shape, dtype=np.uint64)
+    outside = stored = 0
+    for blob, day_outside in days.iterator():
+        counts += grid.decode(bytes(blob))
+        outside += day_outside
+        stored += 1
+
+    selected = counts if hours is None else counts[hours]
+    cells = selected.sum(axis=0)
+    rows, cols = np.nonzero(cells)
+    return {
+        "bounds": list(grid.bounds),
+        "cell_size": grid.cell_size,
+        "rows": grid.rows,
+        "cols": grid.cols,
+        "start": first.isoformat(),
+        "end": last.isoformat(),
+        "days": stored,
+        "unit": "seconds",
+        "hours": counts.sum(axis=(1, 2)).tolist(),
+        "total": int(cells.sum()),
+        "outside": outside,
+        "cells": np.column_stack((rows, cols, cells[rows, cols].astype(np.int64))).tolist(),
+    }
@@ -0,0 +1,153 @@
+"""
+Read helpers for ``Location`` history.
+
+History for a long range can be hundreds of thousands of rows, so the
+history endpoints never materialise it as model instances. Rows are read as
+``(id, latitude, longitude, timestamp)`` tuples ordered by the
+``(buggy, timestamp)`` index, either one keyset page at a time or streamed in
+keyset chunks. Reads go through the history storage (tracking/partitions.py),
+so archived months are only touched when the requested range reaches them.
+"""
+import base64
+import binascii
+import datetime
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .partitions import get_history_storage
+
+DEFAULTS = {
+    "STREAM_CHUNK_SIZE": 2000,
+    "PAGE_SIZE": 1000,
+    "MAX_PAGE_SIZE": 10000,
+    "RETENTION_DAYS": 180,
+    "PARTITIONS_AHEAD": 2,
+}
+
+HISTORY_FIELDS = ("id", "latitude", "longitude", "timestamp")
+
+
+def history_setting(name):
+    return getattr(settings, "TRACKING_HISTORY", {}).get(name, DEFAULTS[name])
+
+
+def parse_since(since):
+    """
+    Turn a ``{number}{unit}`` range such as ``30m``, ``1h`` or ``7d`` into the
+    start time of that range. Raises ValueError for anything else.
+    """
+    time_value = int(since[:-1])
+    time_unit = since[-1].lower()
+
+    if time_unit == 'h':
+        delta = datetime.timedelta(hours=time_value)
+    elif time_unit == 'm':
+        delta = datetime.timedelta(minutes=time_value)
+    elif time_unit == 'd':
+        delta = datetime.timedelta(days=time_value)
+    else:
+        raise ValueError("Invalid time unit")
+
+    return timezone.now() - delta
+
+
+def format_timestamp(value):
+    # Same output as DRF's DateTimeField
+    value = timezone.localtime(value).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def history_rows(buggy_id, start_time, after=None, limit=None):
+    """
+    Ordered ``HISTORY_FIELDS`` tuples of a buggy since ``start_time``, after an
+    optional cursor, up to ``limit`` rows.
+    """
+    rows = []
+    for source in get_history_storage().sources(start_time):
+        query = source.filter(buggy_id=buggy_id, timestamp__gte=start_time)
+        if after is not None:
+            timestamp, row_id = after
+            query = query.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=row_id))
+        query = query.order_by('timestamp', 'id').values_list(*HISTORY_FIELDS)
+        if limit is None:
+            rows.extend(query)
+            continue
+        rows.extend(query[:limit - len(rows)])
+        if len(rows) >= limit:
+            break
+    return rows
+
+
+def row_to_dict(row):
+    return {"latitude": row[1], "longitude": row[2], "timestamp": format_timestamp(row[3])}
+
+
+# ------------------ Keyset pagination ------------------
+
+def encode_cursor(row):
+    raw = f"{row[3].isoformat()}|{row[0]}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return ``(timestamp, id)`` from a cursor. Raises ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, row_id = raw.split('|')
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+    parsed = parse_datetime(timestamp)
+    if parsed is None:
+        raise ValueError("Invalid cursor")
+    return parsed, int(row_id)
+
+
+def history_page(buggy_id, start_time, limit, cursor=None):
+    """Return one page of rows and the cursor of the next page (None at the end)."""
+    after = decode_cursor(cursor) if cursor else None
+    rows = history_rows(buggy_id, start_time, after, limit + 1)
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+# ------------------ Streaming ------------------
+#
+# Streamed responses are served by Daphne from async iterators (a sync
+# iterator would be buffered whole before the first byte). Rows are read in
+# keyset chunks, each in its own short query, so memory stays flat and the
+# first chunk arrives as fast as a single page.
+
+async def history_chunks(buggy_id, start_time):
+    chunk_size = history_setting("STREAM_CHUNK_SIZE")
+    after = None
+    while True:
+        rows = await sync_to_async(history_rows)(buggy_id, start_time, after, chunk_size)
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        after = (rows[-1][3], rows[-1][0])
+
+
+async def stream_ndjson(buggy_id, start_time):
+    """One JSON object per line."""
+    async for rows in history_chunks(buggy_id, start_time):
+        yield "".join(json.dumps(row_to_dict(row)) + "\n" for row in rows)
+
+
+async def stream_json_array(buggy_id, start_time):
+    """A single JSON array, written incrementally."""
+    yield "["
+    separator = ""
+    async for rows in history_chunks(buggy_id, start_time):
+        yield separator + ",".join(json.dumps(row_to_dict(row)) for row in rows)
+        separator = ","
+    yield "]"
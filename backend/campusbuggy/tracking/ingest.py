@@ -0,0 +1,431 @@
+"""
+Write-behind ingest for driver location pings.
+
+``LocationConsumer`` hands every accepted ping to the per-worker
+``IngestBuffer``. The buffer keeps the latest ping per buggy for the
+``BuggyLocation`` checkpoint and the pings that ``tracking.simplify`` marks as
+significant for ``Location`` history, and writes both out on a short interval with ``bulk_create``
+instead of running several queries per ping. Live positions are served from
+``tracking.live``; ``BuggyLocation`` is only a durable checkpoint of them.
+
+Fixes a driver recorded while offline arrive as one ``location_batch`` upload
+(see ``parse_fixes``) and are queued together with ``add_batch``, which
+flushes them in a single write.
+
+Every flush also extends the precomputed trips (``tracking.trips``) and the
+usage heatmap (``tracking.heatmap``) with the history rows it wrote.
+"""
+import asyncio
+import atexit
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .executor import get_db_executor
+from .heatmap import HeatmapAccumulator
+from .simplify import TrajectorySimplifier
+from .trips import TripBuilder, close_open_trips
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "FLUSH_INTERVAL": 1.0,
+    "BATCH_SIZE": 500,
+    "CHECKPOINT_INTERVAL": 30,
+    "BUGGY_CHECK_TTL": 5.0,
+    "MAX_UPLOAD_FIXES": 1000,
+}
+
+# Uploaded fixes may be this far ahead of the server clock
+MAX_CLOCK_SKEW = timedelta(seconds=60)
+
+
+def ingest_setting(name):
+    return getattr(settings, "TRACKING_INGEST", {}).get(name, DEFAULTS[name])
+
+
+@dataclass(slots=True)
+class Ping:
+    buggy_id: int
+    driver_id: int
+    latitude: float
+    longitude: float
+    direction: float | None
+    timestamp: datetime
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def is_valid_fix(latitude, longitude, direction=None):
+    """Numeric, in-range coordinates and a numeric direction if there is one."""
+    return (
+        _is_number(latitude) and -90 <= latitude <= 90
+        and _is_number(longitude) and -180 <= longitude <= 180
+        and (direction is None or _is_number(direction))
+    )
+
+
+def parse_fix_timestamp(value):
+    """An ISO 8601 string or epoch milliseconds as an aware datetime, else None."""
+    if _is_number(value):
+        try:
+            return datetime.fromtimestamp(value / 1000, tz=dt_timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            return None
+    if isinstance(value, str):
+        try:
+            parsed = parse_datetime(value)
+        except ValueError:
+            return None
+        if parsed is not None and timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+    return None
+
+
+def parse_fixes(buggy_id, driver_id, fixes, now):
+    """
+    Validate uploaded ``{"latitude", "longitude", "direction"?, "timestamp"}``
+    fixes in one pass. Returns the valid ones as pings, oldest first and
+    without duplicate timestamps, and the number rejected.
+    """
+    pings = {}
+    for fix in fixes:
+        if not isinstance(fix, dict):
+            continue
+        latitude, longitude = fix.get("latitude"), fix.get("longitude")
+        direction = fix.get("direction")
+        timestamp = parse_fix_timestamp(fix.get("timestamp"))
+        if (
+            not is_valid_fix(latitude, longitude, direction)
+            or timestamp is None or timestamp > now + MAX_CLOCK_SKEW
+        ):
+            continue
+        pings[timestamp] = Ping(
+            buggy_id=buggy_id,
+            driver_id=driver_id,
+            latitude=latitude,
+            longitude=longitude,
+            direction=direction,
+            timestamp=timestamp,
+        )
+    return [pings[timestamp] for timestamp in sorted(pings)], len(fixes) - len(pings)
+
+
+class IngestBuffer:
+    """
+    Buffers pings in memory and flushes them every ``flush_interval`` seconds,
+    or as soon as ``batch_size`` pings are waiting.
+    """
+
+    def __init__(self, flush_interval=1.0, batch_size=500, checkpoint_interval=30,
+                 simplifier=None, trips=None, heatmap=None):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.simplifier = simplifier or TrajectorySimplifier()
+        self.trips = trips or TripBuilder()
+        self.heatmap = heatmap or HeatmapAccumulator.from_settings()
+        self.checkpoint_interval = timedelta(seconds=checkpoint_interval)
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._live = {}
+        self._history = []
+        # buggy_id -> (timestamp, driver_id) of the last ping queued for BuggyLocation.
+        self._last_checkpoint = {}
+        # buggy_id -> when its open trip ended, closed on the next flush
+        self._trip_closes = {}
+
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+
+        self.enqueued = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped_pings = 0
+        self.live_rows_written = 0
+        self.history_rows_written = 0
+        self.last_flush_seconds = 0.0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            flush_interval=ingest_setting("FLUSH_INTERVAL"),
+            batch_size=ingest_setting("BATCH_SIZE"),
+            checkpoint_interval=ingest_setting("CHECKPOINT_INTERVAL"),
+            simplifier=TrajectorySimplifier.from_settings(),
+            trips=TripBuilder.from_settings(),
+            heatmap=HeatmapAccumulator.from_settings(),
+        )
+
+    @property
+    def queue_depth(self):
+        return len(self._live) + len(self._history)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "pending_live": len(self._live),
+                "pending_history": len(self._history),
+                "enqueued": self.enqueued,
+                "flushes": self.flushes,
+                "failed_flushes": self.failed_flushes,
+                "dropped_pings": self.dropped_pings,
+                "live_rows_written": self.live_rows_written,
+                "history_rows_written": self.history_rows_written,
+                "last_flush_seconds": self.last_flush_seconds,
+            }
+
+    def add(self, ping):
+        with self._lock:
+            if ping.buggy_id in self._live or self._checkpoint_due(ping):
+                self._live[ping.buggy_id] = ping
+            self._history.extend(self.simplifier.feed(ping))
+            self.enqueued += 1
+            depth = self.queue_depth
+
+        self._ensure_flusher()
+        if depth >= self.batch_size:
+            self._wakeup.set()
+
+    def add_batch(self, pings):
+        """
+        Queue one buggy's uploaded pings, oldest first, and flush them
+        together. Pings no newer than what the simplifier already saw for the
+        buggy (uploaded after live pings resumed) can't be placed on its track
+        and are stored as they are.
+        """
+        if not pings:
+            return
+        newest = pings[-1]
+        with self._lock:
+            for ping in pings:
+                if self.simplifier.is_behind(ping):
+                    self._history.append(ping)
+                else:
+                    self._history.extend(self.simplifier.feed(ping))
+
+            pending = self._live.get(newest.buggy_id)
+            if pending is not None:
+                if pending.timestamp < newest.timestamp:
+                    self._live[newest.buggy_id] = newest
+            elif self._checkpoint_due(newest):
+                self._live[newest.buggy_id] = newest
+            self.enqueued += len(pings)
+
+        self._ensure_flusher()
+        self._wakeup.set()
+
+    def discard_driver(self, driver_id):
+        """
+        Drop pending live positions of a driver that has just disconnected and
+        close their history tracks, keeping the final unsaved fix.
+        """
+        with self._lock:
+            for buggy_id in self.simplifier.buggies_of_driver(driver_id):
+                self._history.extend(self.simplifier.finish(buggy_id))
+            self._live = {
+                buggy_id: ping for buggy_id, ping in self._live.items()
+                if ping.driver_id != driver_id
+            }
+            self._last_checkpoint = {
+                buggy_id: checkpoint for buggy_id, checkpoint in self._last_checkpoint.items()
+                if checkpoint[1] != driver_id
+            }
+
+    def close_trip(self, buggy_id, at):
+        """
+        End the buggy's open trip at ``at`` (a status change). Its pings still
+        waiting here belong to that trip, so the flusher writes them first and
+        then closes it, off the caller's thread.
+        """
+        with self._lock:
+            self._trip_closes[buggy_id] = max(at, self._trip_closes.get(buggy_id, at))
+        if not self._wake_flusher():
+            # No flusher in this process, so none of the buggy's pings are buffered here
+            self.flush()
+
+    def _checkpoint_due(self, ping):
+        last = self._last_checkpoint.get(ping.buggy_id)
+        if last is not None and ping.timestamp - last[0] < self.checkpoint_interval:
+            return False
+        self._last_checkpoint[ping.buggy_id] = (ping.timestamp, ping.driver_id)
+        return True
+
+    # ------------------ Flushing ------------------
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    def _wake_flusher(self):
+        """Wake the flusher from any thread; False if there is none running."""
+        loop = self._loop
+        if loop is None or loop.is_closed() or self._task is None or self._task.done():
+            return False
+        loop.call_soon_threadsafe(self._wakeup.set)
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self.queue_depth or self.heatmap.pending or self._trip_closes:
+                await self.aflush()
+
+    async def aflush(self):
+        await get_db_executor().run(self.flush, helper="ingest_flush")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                live, self._live = self._live, {}
+                history, self._history = self._history, []
+                closes, self._trip_closes = self._trip_closes, {}
+            if not live and not history and not closes:
+                self._flush_heatmap()
+                return
+
+            started = time.perf_counter()
+            try:
+                self._write(live, history, closes)
+            except Exception:
+                self.failed_flushes += 1
+                logger.exception(
+                    "Dropping %d live and %d history pings after a failed flush",
+                    len(live), len(history),
+                )
+            finally:
+                self.flushes += 1
+                self.last_flush_seconds = time.perf_counter() - started
+            self._flush_heatmap()
+
+    def _flush_heatmap(self, force=False):
+        try:
+            self.heatmap.flush(force=force)
+        except Exception:
+            # Lost counts come back with rebuild_heatmap
+            logger.exception("Failed to merge heatmap counts")
+
+    def _drop_deleted_buggies(self, live, history):
+        """
+        Leave out pings of buggies deleted while they were buffered, so they
+        can't fail the bulk writes of every other buggy.
+        """
+        from .models import Buggy
+
+        buggy_ids = set(live) | {ping.buggy_id for ping in history}
+        if not buggy_ids:
+            return live, history
+        existing = set(Buggy.objects.filter(id__in=buggy_ids).values_list('id', flat=True))
+        if existing == buggy_ids:
+            return live, history
+
+        kept_live = {buggy_id: ping for buggy_id, ping in live.items() if buggy_id in existing}
+        kept_history = [ping for ping in history if ping.buggy_id in existing]
+        dropped = len(live) - len(kept_live) + len(history) - len(kept_history)
+        self.dropped_pings += dropped
+        logger.warning(
+            "Dropping %d pings of deleted buggies %s", dropped, sorted(buggy_ids - existing)
+        )
+        return kept_live, kept_history
+
+    def _write(self, live, history, closes=None):
+        from .models import BuggyLocation, Location
+
+        live, history = self._drop_deleted_buggies(live, history)
+        if live:
+            BuggyLocation.objects.bulk_create(
+                [
+                    BuggyLocation(
+                        buggy_id=ping.buggy_id,
+                        latitude=ping.latitude,
+                        longitude=ping.longitude,
+                        direction=ping.direction,
+                    )
+                    for ping in live.values()
+                ],
+                batch_size=self.batch_size,
+                update_conflicts=True,
+                unique_fields=["buggy"],
+                update_fields=["latitude", "longitude", "direction", "last_updated"],
+            )
+            self.live_rows_written += len(live)
+
+        rows = [
+            Location(
+                buggy_id=ping.buggy_id,
+                driver_id=ping.driver_id,
+                latitude=ping.latitude,
+                longitude=ping.longitude,
+                timestamp=ping.timestamp,
+            )
+            for ping in history
+        ]
+        if rows:
+            Location.objects.bulk_create(rows, batch_size=self.batch_size)
+            self.history_rows_written += len(rows)
+
+        try:
+            self._extend_trips(history, closes or {})
+        except Exception:
+            # The history is saved; backfill_trips can rebuild the trips
+            logger.exception("Failed to extend trips with %d history pings", len(history))
+
+        if rows:
+            try:
+                self.heatmap.add(history)
+            except Exception:
+                logger.exception("Failed to bin %d history pings for the heatmap", len(history))
+
+    def _extend_trips(self, history, closes):
+        if not closes:
+            self.trips.add(history)
+            return
+        # Pings up to a status change end the trip it closes; later ones start the next
+        earlier, later = [], []
+        for ping in history:
+            if ping.buggy_id in closes and ping.timestamp > closes[ping.buggy_id]:
+                later.append(ping)
+            else:
+                earlier.append(ping)
+        self.trips.add(earlier)
+        for buggy_id in closes:
+            close_open_trips(buggy_id)
+            self.trips.forget(buggy_id)
+        self.trips.add(later)
+
+
+_buffer = None
+
+
+def get_ingest_buffer():
+    global _buffer
+    if _buffer is None:
+        _buffer = IngestBuffer.from_settings()
+        atexit.register(_flush_on_exit)
+    return _buffer
+
+
+def _flush_on_exit():
+    if _buffer is not None:
+        if _buffer.queue_depth or _buffer._trip_closes:
+            _buffer.flush()
+        _buffer._flush_heatmap(force=True)
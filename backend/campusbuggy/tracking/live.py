@@ -0,0 +1,254 @@
+"""
+Live fleet state: the latest position of every running buggy.
+
+``LocationConsumer`` writes here on every accepted ping and ``LiveLocationView``
+reads from here, so the hot path never touches SQL. ``BuggyLocation`` is only
+checkpointed by the ingest buffer every ``CHECKPOINT_INTERVAL`` seconds.
+
+The backend is chosen with ``TRACKING_LIVE_STORE['BACKEND']``:
+``LocalLiveStore`` keeps state in the worker process, ``RedisLiveStore`` keeps
+it in a Redis hash shared by all workers.
+
+Stores also keep monotonically increasing state versions: ``live`` moves on
+every position change, ``fleet`` whenever a buggy is started, stopped or
+edited. Polling endpoints turn them into ETags (see tracking/conditional.py).
+"""
+import json
+import secrets
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+def live_entry(buggy_id, buggy_number, latitude, longitude, direction, driver_name, timestamp,
+               snap=None):
+    return {
+        "buggy_id": buggy_id,
+        "buggy_number": buggy_number,
+        "latitude": latitude,
+        "longitude": longitude,
+        "direction": direction,
+        "driver_name": driver_name,
+        "last_updated": timezone.localtime(timestamp).isoformat(),
+        # Where on which route the position was snapped to (see tracking/snapping.py)
+        "route_id": snap.route_id if snap else None,
+        "route_distance": round(snap.route_distance, 1) if snap else None,
+    }
+
+
+class LiveStore:
+    """
+    Base class for live state backends. Entries are plain dicts built by
+    ``live_entry`` and keyed by buggy id. The ``a``-prefixed methods are used
+    from consumers; backends with blocking I/O override them.
+    """
+    # Local state is empty after a restart and has to be loaded from the
+    # BuggyLocation checkpoints once.
+    needs_warm_up = False
+    # Whether other worker processes write to the same state
+    shared = False
+    # Bumped on every local change; None when changes can't be observed
+    version = None
+
+    VERSION_SCOPES = ("live", "fleet")
+
+    def set(self, buggy_id, entry):
+        raise NotImplementedError
+
+    def state_version(self, scope):
+        raise NotImplementedError
+
+    def bump(self, scope):
+        raise NotImplementedError
+
+    def etag(self, scope):
+        # The epoch keeps versions of different processes (or of a
+        # restarted one) from ever producing the same tag
+        return f'"{scope}-{self.epoch}-{self.state_version(scope)}"'
+
+    def all(self):
+        raise NotImplementedError
+
+    def get_many(self, buggy_ids):
+        """Entries for ``buggy_ids`` in the same order, ``None`` where missing."""
+        raise NotImplementedError
+
+    def delete(self, buggy_ids):
+        raise NotImplementedError
+
+    async def aset(self, buggy_id, entry):
+        self.set(buggy_id, entry)
+
+    async def aall(self):
+        return self.all()
+
+    async def aget_many(self, buggy_ids):
+        return self.get_many(buggy_ids)
+
+    async def adelete(self, buggy_ids):
+        self.delete(buggy_ids)
+
+    def warm_up(self):
+        from .models import BuggyLocation
+
+        locations = BuggyLocation.objects.filter(
+            buggy__is_running=True
+        ).select_related('buggy', 'buggy__assigned_driver')
+
+        for location in locations:
+            driver = location.buggy.assigned_driver
+            self.set_default(location.buggy_id, live_entry(
+                location.buggy_id,
+                location.buggy.number_plate,
+                location.latitude,
+                location.longitude,
+                location.direction,
+                driver.username if driver else None,
+                location.last_updated,
+            ))
+        self.needs_warm_up = False
+
+    def set_default(self, buggy_id, entry):
+        raise NotImplementedError
+
+
+class LocalLiveStore(LiveStore):
+    needs_warm_up = True
+
+    def __init__(self, **options):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._versions = dict.fromkeys(self.VERSION_SCOPES, 0)
+        self.epoch = secrets.token_hex(4)
+
+    @property
+    def version(self):
+        return self._versions["live"]
+
+    def state_version(self, scope):
+        return self._versions[scope]
+
+    def bump(self, scope):
+        with self._lock:
+            self._versions[scope] += 1
+
+    def set(self, buggy_id, entry):
+        with self._lock:
+            self._entries[buggy_id] = entry
+            self._versions["live"] += 1
+
+    def set_default(self, buggy_id, entry):
+        with self._lock:
+            if buggy_id not in self._entries:
+                self._entries[buggy_id] = entry
+                self._versions["live"] += 1
+
+    def all(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def get_many(self, buggy_ids):
+        with self._lock:
+            return [self._entries.get(buggy_id) for buggy_id in buggy_ids]
+
+    def delete(self, buggy_ids):
+        with self._lock:
+            for buggy_id in buggy_ids:
+                if self._entries.pop(buggy_id, None) is not None:
+                    self._versions["live"] += 1
+
+
+class RedisLiveStore(LiveStore):
+    shared = True
+
+    def __init__(self, url="redis://127.0.0.1:6379/0", key="campusbuggy:live", **options):
+        import redis
+        import redis.asyncio
+
+        self.key = key
+        # Versions sit next to the entries so every worker sees the same ones
+        self.versions_key = f"{key}:versions"
+        self._epoch = None
+        self._client = redis.Redis.from_url(url, **options)
+        self._async_client = redis.asyncio.Redis.from_url(url, **options)
+
+    @property
+    def epoch(self):
+        # Shared by all workers, new whenever Redis lost the versions
+        if self._epoch is None:
+            epoch_key = f"{self.key}:epoch"
+            self._client.set(epoch_key, secrets.token_hex(4), nx=True)
+            self._epoch = self._client.get(epoch_key).decode()
+        return self._epoch
+
+    def state_version(self, scope):
+        return int(self._client.hget(self.versions_key, scope) or 0)
+
+    def bump(self, scope):
+        self._client.hincrby(self.versions_key, scope, 1)
+
+    def set(self, buggy_id, entry):
+        pipe = self._client.pipeline()
+        pipe.hset(self.key, buggy_id, json.dumps(entry))
+        pipe.hincrby(self.versions_key, "live", 1)
+        pipe.execute()
+
+    def set_default(self, buggy_id, entry):
+        if self._client.hsetnx(self.key, buggy_id, json.dumps(entry)):
+            self.bump("live")
+
+    def all(self):
+        return [json.loads(value) for value in self._client.hvals(self.key)]
+
+    def get_many(self, buggy_ids):
+        if not buggy_ids:
+            return []
+        values = self._client.hmget(self.key, buggy_ids)
+        return [json.loads(value) if value is not None else None for value in values]
+
+    def delete(self, buggy_ids):
+        if buggy_ids:
+            pipe = self._client.pipeline()
+            pipe.hdel(self.key, *buggy_ids)
+            pipe.hincrby(self.versions_key, "live", 1)
+            pipe.execute()
+
+    async def aset(self, buggy_id, entry):
+        pipe = self._async_client.pipeline()
+        pipe.hset(self.key, buggy_id, json.dumps(entry))
+        pipe.hincrby(self.versions_key, "live", 1)
+        await pipe.execute()
+
+    async def aall(self):
+        return [json.loads(value) for value in await self._async_client.hvals(self.key)]
+
+    async def aget_many(self, buggy_ids):
+        if not buggy_ids:
+            return []
+        values = await self._async_client.hmget(self.key, buggy_ids)
+        return [json.loads(value) if value is not None else None for value in values]
+
+    async def adelete(self, buggy_ids):
+        if buggy_ids:
+            pipe = self._async_client.pipeline()
+            pipe.hdel(self.key, *buggy_ids)
+            pipe.hincrby(self.versions_key, "live", 1)
+            await pipe.execute()
+
+
+_store = None
+
+
+def live_store_settings():
+    return getattr(settings, "TRACKING_LIVE_STORE", {})
+
+
+def get_live_store():
+    global _store
+    if _store is None:
+        config = live_store_settings()
+        backend = import_string(config.get("BACKEND", "tracking.live.LocalLiveStore"))
+        _store = backend(**config.get("OPTIONS", {}))
+    return _store
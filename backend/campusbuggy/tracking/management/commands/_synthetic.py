@@ -0,0 +1,71 @@
+"""Synthetic buggy traces shared by the tracking benchmark commands."""
+import math
+import random
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from tracking.geo import EARTH_RADIUS_M
+from tracking.ingest import Ping
+
+CAMPUS_CENTER = (12.9716, 77.5946)
+
+# A campus loop in metres east/north of CAMPUS_CENTER; stops are marked True
+CAMPUS_LOOP = [
+    (0, 0, True), (220, 0, False), (260, 40, False), (260, 310, True),
+    (120, 420, False), (-90, 420, True), (-150, 360, False), (-150, 120, False),
+    (-60, 30, False),
+]
+
+
+def to_latlon(x, y, center=CAMPUS_CENTER):
+    lat = center[0] + math.degrees(y / EARTH_RADIUS_M)
+    lon = center[1] + math.degrees(x / (EARTH_RADIUS_M * math.cos(math.radians(center[0]))))
+    return lat, lon
+
+
+def loop_trace(buggy_id=1, driver_id=1, duration=3600, interval=1.0, speed=6.0,
+               stop_seconds=45, noise=3.0, seed=0, start=None, offset=0.0):
+    """
+    Yield ``(Ping, true_lat, true_lon)`` for a buggy driving CAMPUS_LOOP.
+
+    ``noise`` is the GPS error's standard deviation in metres; ``offset``
+    starts the buggy part-way round the loop (in metres).
+    """
+    rng = random.Random(seed)
+    start = start or datetime(2025, 1, 6, 9, 0, tzinfo=dt_timezone.utc)
+
+    legs = []
+    for (x1, y1, stop), (x2, y2, _) in zip(CAMPUS_LOOP, CAMPUS_LOOP[1:] + CAMPUS_LOOP[:1]):
+        legs.append((x1, y1, x2, y2, math.hypot(x2 - x1, y2 - y1), stop))
+
+    position = offset
+    leg_index, stopped_for = 0, 0.0
+    elapsed = 0.0
+    while elapsed < duration:
+        x1, y1, x2, y2, length, stop = legs[leg_index]
+        while position >= length:
+            position -= length
+            leg_index = (leg_index + 1) % len(legs)
+            x1, y1, x2, y2, length, stop = legs[leg_index]
+            if stop:
+                stopped_for = stop_seconds
+
+        t = position / length
+        x, y = x1 + (x2 - x1) * t, y1 + (y2 - y1) * t
+        true_lat, true_lon = to_latlon(x, y)
+        lat, lon = to_latlon(x + rng.gauss(0, noise), y + rng.gauss(0, noise))
+        direction = math.degrees(math.atan2(x2 - x1, y2 - y1)) % 360
+
+        yield Ping(
+            buggy_id=buggy_id,
+            driver_id=driver_id,
+            latitude=lat,
+            longitude=lon,
+            direction=direction,
+            timestamp=start + timedelta(seconds=elapsed),
+        ), true_lat, true_lon
+
+        elapsed += interval
+        if stopped_for > 0:
+            stopped_for -= interval
+        else:
+            position += speed * interval
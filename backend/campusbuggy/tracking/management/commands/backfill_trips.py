@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from tracking.history import parse_since
+from tracking.ingest import Ping
+from tracking.models import Buggy, Trip
+from tracking.partitions import get_history_storage
+from tracking.trips import segment_pings, trips_setting
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild trips from stored location history. Status changes aren't in the "
+        "history, so rebuilt trips are split on driver changes and long gaps only."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--buggy", type=int, action="append", help="Only this buggy (repeatable)")
+        parser.add_argument(
+            "--since", default=None,
+            help="Only rebuild history in this range (e.g. 7d); default all of it",
+        )
+        parser.add_argument(
+            "--max-gap", type=int, default=None,
+            help="Seconds without history that end a trip (default TRACKING_TRIPS['MAX_GAP'])",
+        )
+        parser.add_argument("--chunk-size", type=int, default=5000, help="History rows read per query")
+
+    def handle(self, *args, **options):
+        try:
+            start = parse_since(options["since"]) if options["since"] else None
+        except (ValueError, IndexError):
+            raise CommandError("Invalid --since; use {number}{unit} where unit is h, m, or d")
+        max_gap = timedelta(seconds=options["max_gap"] or trips_setting("MAX_GAP"))
+
+        buggies = Buggy.objects.order_by('id')
+        if options["buggy"]:
+            buggies = buggies.filter(id__in=options["buggy"])
+
+        total = 0
+        for buggy in buggies:
+            count = self.rebuild(buggy, start, max_gap, options["chunk_size"])
+            self.stdout.write(f"  {buggy.number_plate}: {count} trip(s)")
+            total += count
+        self.stdout.write(self.style.SUCCESS(f"{total} trip(s) rebuilt"))
+
+    def rebuild(self, buggy, start, max_gap, chunk_size):
+        if start is None:
+            start = datetime.min.replace(tzinfo=dt_timezone.utc)
+        # A trip running across the start is rebuilt whole
+        straddling = Trip.objects.filter(
+            buggy=buggy, started_at__lt=start, ended_at__gte=start
+        ).order_by('started_at').values_list('started_at', flat=True).first()
+        if straddling is not None:
+            start = straddling
+
+        with transaction.atomic():
+            Trip.objects.filter(buggy=buggy, started_at__gte=start).delete()
+
+            created = 0
+            current = None
+            for pings in self.history(buggy.id, start, chunk_size):
+                trips = segment_pings(current, buggy.id, pings, max_gap)
+                if trips:
+                    # Only the last trip can still grow
+                    *closed, current = trips
+                    Trip.objects.bulk_create(closed)
+                    created += len(closed)
+
+            if current is not None:
+                # Leave a recent trip of a running buggy open for live history
+                current.is_open = (
+                    buggy.is_running and timezone.now() - current.ended_at <= max_gap
+                )
+                current.save()
+                created += 1
+        return created
+
+    def history(self, buggy_id, start, chunk_size):
+        for source in get_history_storage().sources(start):
+            rows = source.filter(buggy_id=buggy_id, timestamp__gte=start).order_by(
+                'timestamp', 'id'
+            ).values_list('driver_id', 'latitude', 'longitude', 'timestamp')
+
+            chunk = []
+            for driver_id, latitude, longitude, timestamp in rows.iterator(chunk_size=chunk_size):
+                chunk.append(Ping(
+                    buggy_id=buggy_id, driver_id=driver_id, latitude=latitude,
+                    longitude=longitude, direction=None, timestamp=timestamp,
+                ))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
@@ -0,0 +1,94 @@
+import json
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from tracking.geo import point_segment_distance, to_xy
+from tracking.simplify import TrajectorySimplifier
+
+from ._synthetic import loop_trace
+
+
+def fixed_interval_rule(pings, interval=timedelta(minutes=5)):
+    """The previous retention rule: one stored fix per five minutes."""
+    stored, last = [], None
+    for ping in pings:
+        if last is None or ping.timestamp - last >= interval:
+            stored.append(ping)
+            last = ping.timestamp
+    return stored
+
+
+def path_errors(trace, stored):
+    """
+    Distance in metres from every true position to the stored path segment
+    covering its timestamp.
+    """
+    errors = []
+    index = 0
+    for ping, lat, lon in trace:
+        while index + 1 < len(stored) and stored[index + 1].timestamp <= ping.timestamp:
+            index += 1
+        a = stored[index]
+        b = stored[min(index + 1, len(stored) - 1)]
+        ax, ay = to_xy(a.latitude, a.longitude, lat, lon)
+        bx, by = to_xy(b.latitude, b.longitude, lat, lon)
+        errors.append(point_segment_distance(0.0, 0.0, ax, ay, bx, by))
+    return errors
+
+
+def summarize(name, trace, stored, seconds):
+    errors = sorted(path_errors(trace, stored))
+    return {
+        "rule": name,
+        "rows": len(stored),
+        "mean_error_m": round(statistics.fmean(errors), 2),
+        "p95_error_m": round(errors[int(len(errors) * 0.95)], 2),
+        "max_error_m": round(errors[-1], 2),
+        "us_per_ping": round(seconds / len(trace) * 1e6, 2),
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare stored history rows and path error of the simplifier against the 5-minute rule."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--duration", type=int, default=3600, help="Seconds of driving to simulate")
+        parser.add_argument("--interval", type=float, default=1.0, help="Seconds between pings")
+        parser.add_argument("--noise", type=float, default=3.0, help="GPS noise in metres")
+        parser.add_argument("--json", action="store_true", help="Print machine-readable output")
+
+    def handle(self, *args, **options):
+        trace = list(loop_trace(
+            duration=options["duration"], interval=options["interval"], noise=options["noise"]
+        ))
+        pings = [ping for ping, _, _ in trace]
+
+        started = time.perf_counter()
+        baseline = fixed_interval_rule(pings)
+        baseline_seconds = time.perf_counter() - started
+
+        simplifier = TrajectorySimplifier.from_settings()
+        started = time.perf_counter()
+        simplified = [fix for ping in pings for fix in simplifier.feed(ping)]
+        simplified += simplifier.finish(pings[0].buggy_id)
+        simplified_seconds = time.perf_counter() - started
+
+        results = [
+            summarize("every_5_minutes", trace, baseline, baseline_seconds),
+            summarize("simplifier", trace, simplified, simplified_seconds),
+        ]
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"pings": len(pings), "results": results}))
+            return
+
+        self.stdout.write(f"{len(pings)} pings over {options['duration']}s")
+        self.stdout.write(f"{'rule':<18}{'rows':>8}{'mean m':>10}{'p95 m':>10}{'max m':>10}{'us/ping':>10}")
+        for row in results:
+            self.stdout.write(
+                f"{row['rule']:<18}{row['rows']:>8}{row['mean_error_m']:>10}"
+                f"{row['p95_error_m']:>10}{row['max_error_m']:>10}{row['us_per_ping']:>10}"
+            )
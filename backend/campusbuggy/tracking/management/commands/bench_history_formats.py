@@ -0,0 +1,70 @@
+import gzip
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from tracking.encoding import columns_from_rows, encode_trail
+from tracking.history import row_to_dict
+from tracking.models import Location
+from tracking.serializers import LocationHistorySerializer
+
+from ._synthetic import loop_trace
+
+
+def serializer_json(rows):
+    """The previous response: ModelSerializer over model instances."""
+    locations = [
+        Location(id=row[0], latitude=row[1], longitude=row[2], timestamp=row[3]) for row in rows
+    ]
+    return LocationHistorySerializer(locations, many=True).data
+
+
+ENCODERS = {
+    "serializer_json": serializer_json,
+    "json": lambda rows: [row_to_dict(row) for row in rows],
+    "columnar": lambda rows: encode_trail("columnar", *columns_from_rows(rows)),
+    "polyline": lambda rows: encode_trail("polyline", *columns_from_rows(rows)),
+}
+
+
+class Command(BaseCommand):
+    help = "Compare payload size and encode time of the history response formats."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--points", type=int, default=5000, help="Trail length")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed runs per format (best is kept)")
+        parser.add_argument("--json", action="store_true", help="Print machine-readable output")
+
+    def handle(self, *args, **options):
+        rows = [
+            (index, ping.latitude, ping.longitude, ping.timestamp)
+            for index, (ping, _, _) in enumerate(loop_trace(duration=options["points"]))
+        ]
+
+        results = []
+        for name, encode in ENCODERS.items():
+            best = float("inf")
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                body = json.dumps(encode(rows)).encode()
+                best = min(best, time.perf_counter() - started)
+            results.append({
+                "format": name,
+                "bytes": len(body),
+                "gzip_bytes": len(gzip.compress(body)),
+                "bytes_per_point": round(len(body) / len(rows), 2),
+                "encode_ms": round(best * 1000, 2),
+            })
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"points": len(rows), "results": results}))
+            return
+
+        self.stdout.write(f"{len(rows)} points")
+        self.stdout.write(f"{'format':<18}{'bytes':>10}{'gzip':>10}{'B/point':>10}{'encode ms':>12}")
+        for row in results:
+            self.stdout.write(
+                f"{row['format']:<18}{row['bytes']:>10}{row['gzip_bytes']:>10}"
+                f"{row['bytes_per_point']:>10}{row['encode_ms']:>12}"
+            )
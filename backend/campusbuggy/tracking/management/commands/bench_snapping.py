@@ -0,0 +1,119 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from tracking.geo import haversine
+from tracking.snapping import RouteIndex, routes_setting
+
+from ._synthetic import CAMPUS_LOOP, loop_trace, to_latlon
+
+
+def campus_segments(grid_spacing, extent):
+    """The CAMPUS_LOOP route plus a grid of streets around it, as ``RouteIndex.build`` rows."""
+    segments = []
+    for (x1, y1, _), (x2, y2, _) in zip(CAMPUS_LOOP, CAMPUS_LOOP[1:] + CAMPUS_LOOP[:1]):
+        segments.append((1, *to_latlon(x1, y1), *to_latlon(x2, y2)))
+
+    if grid_spacing:
+        route_id = 2
+        half = extent // 2
+        for offset in range(-half, half + 1, grid_spacing):
+            # One north-south and one east-west street, split into blocks
+            for start in range(-half, half, grid_spacing):
+                end = start + grid_spacing
+                segments.append((route_id, *to_latlon(offset, start), *to_latlon(offset, end)))
+                segments.append((route_id + 1, *to_latlon(start, offset), *to_latlon(end, offset)))
+            route_id += 2
+    return segments
+
+
+class Command(BaseCommand):
+    help = "Measure snapping cost and accuracy on a synthetic campus road network."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pings", type=int, default=20000, help="Synthetic fixes to snap")
+        parser.add_argument("--buggies", type=int, default=10, help="Buggies driving the loop")
+        parser.add_argument("--noise", type=float, default=6.0, help="GPS error in metres (std dev)")
+        parser.add_argument(
+            "--grid-spacing", type=int, default=100,
+            help="Metres between the extra grid streets (0 for just the loop)",
+        )
+        parser.add_argument("--extent", type=int, default=2000, help="Metres covered by the street grid")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed runs (best is kept)")
+        parser.add_argument("--json", action="store_true", help="Print machine-readable output")
+
+    def handle(self, *args, **options):
+        segments = campus_segments(options["grid_spacing"], options["extent"])
+        index = RouteIndex.from_settings()
+        started = time.perf_counter()
+        index.build(segments)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        per_buggy = max(1, options["pings"] // options["buggies"])
+        fixes = [
+            (ping.latitude, ping.longitude, ping.direction, true_lat, true_lon)
+            for buggy in range(options["buggies"])
+            for ping, true_lat, true_lon in loop_trace(
+                buggy_id=buggy + 1, duration=per_buggy, noise=options["noise"],
+                seed=buggy, offset=buggy * 137.0,
+            )
+        ]
+
+        best = float("inf")
+        for _ in range(options["repeat"]):
+            started = time.perf_counter()
+            snaps = [index.snap(lat, lon, direction) for lat, lon, direction, _, _ in fixes]
+            best = min(best, time.perf_counter() - started)
+        per_ping_us = best / len(fixes) * 1e6
+
+        raw_errors, snapped_errors = [], []
+        for (lat, lon, _, true_lat, true_lon), snap in zip(fixes, snaps):
+            raw_errors.append(haversine(lat, lon, true_lat, true_lon))
+            if snap is not None:
+                lat, lon = snap.latitude, snap.longitude
+            snapped_errors.append(haversine(lat, lon, true_lat, true_lon))
+
+        def summary(errors):
+            ordered = sorted(errors)
+            return {
+                "mean": round(statistics.fmean(ordered), 2),
+                "p95": round(ordered[int(len(ordered) * 0.95)], 2),
+            }
+
+        candidates = [cell.shape[1] for cell in index._cells.values()]
+        result = {
+            "segments": len(segments),
+            "cells": len(candidates),
+            "mean_candidates_per_cell": round(statistics.fmean(candidates), 2),
+            "build_ms": round(build_ms, 2),
+            "pings": len(fixes),
+            "snap_us": round(per_ping_us, 2),
+            "pings_per_second": round(1e6 / per_ping_us),
+            "snapped": round(sum(snap is not None for snap in snaps) / len(fixes), 4),
+            "raw_error_m": summary(raw_errors),
+            "snapped_error_m": summary(snapped_errors),
+            "max_distance": routes_setting("MAX_DISTANCE"),
+        }
+
+        if options["json"]:
+            self.stdout.write(json.dumps(result))
+            return
+
+        self.stdout.write(
+            f"{result['segments']} segments in {result['cells']} cells "
+            f"({result['mean_candidates_per_cell']} per cell), built in {result['build_ms']} ms"
+        )
+        self.stdout.write(
+            f"{result['pings']} fixes: {result['snap_us']} us per fix "
+            f"({result['pings_per_second']}/s on one core), {result['snapped']:.1%} snapped"
+        )
+        self.stdout.write(
+            f"error to true position   raw mean {result['raw_error_m']['mean']} m, "
+            f"p95 {result['raw_error_m']['p95']} m"
+        )
+        self.stdout.write(
+            f"                         snapped mean {result['snapped_error_m']['mean']} m, "
+            f"p95 {result['snapped_error_m']['p95']} m"
+        )
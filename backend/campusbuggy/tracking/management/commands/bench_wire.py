@@ -0,0 +1,90 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from tracking.wire import CODECS
+
+from ._synthetic import loop_trace
+
+
+def best_per_item(run, items, repeat):
+    """Best-of-``repeat`` time of ``run(items)``, in microseconds per item."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run(items)
+        best = min(best, time.perf_counter() - started)
+    return round(best / len(items) * 1e6, 2)
+
+
+class Command(BaseCommand):
+    help = "Compare bytes and CPU per location update of the WebSocket wire formats."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--updates", type=int, default=5000, help="Synthetic updates to encode")
+        parser.add_argument("--batch", type=int, default=20, help="Buggies per location_batch frame")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed runs per codec (best is kept)")
+        parser.add_argument("--json", action="store_true", help="Print machine-readable output")
+
+    def handle(self, *args, **options):
+        events = [
+            {
+                "type": "location_update",
+                "buggy_id": 1 + index % options["batch"],
+                "latitude": ping.latitude,
+                "longitude": ping.longitude,
+                "direction": round(index * 7.3 % 360, 1),
+                "driver_name": f"driver{1 + index % options['batch']}",
+                "timestamp": ping.timestamp.isoformat(),
+            }
+            for index, (ping, _, _) in enumerate(loop_trace(duration=options["updates"]))
+        ]
+        batches = [events[i:i + options["batch"]] for i in range(0, len(events), options["batch"])]
+        repeat = options["repeat"]
+
+        results = []
+        for codec in CODECS:
+            uplink = [
+                codec.driver_update_frame(e["buggy_id"], e["latitude"], e["longitude"], e["direction"])
+                for e in events
+            ]
+            decode_args = [
+                (None, frame) if isinstance(frame, bytes) else (frame, None) for frame in uplink
+            ]
+            updates = [codec.location_update_frame(event) for event in events]
+            batch_frames = [codec.location_batch_frame(batch) for batch in batches]
+
+            results.append({
+                "codec": codec.name,
+                "uplink_bytes": round(sum(map(len, uplink)) / len(uplink), 2),
+                "uplink_decode_us": best_per_item(
+                    lambda items: [codec.decode(*args) for args in items], decode_args, repeat
+                ),
+                "update_bytes": round(sum(map(len, updates)) / len(updates), 2),
+                "update_encode_us": best_per_item(
+                    lambda items: [codec.location_update_frame(event) for event in items], events, repeat
+                ),
+                "batch_bytes_per_update": round(sum(map(len, batch_frames)) / len(events), 2),
+                "batch_encode_us_per_update": round(best_per_item(
+                    lambda items: [codec.location_batch_frame(batch) for batch in items], batches, repeat
+                ) / options["batch"], 2),
+            })
+
+        if options["json"]:
+            self.stdout.write(json.dumps({
+                "updates": len(events), "batch": options["batch"], "results": results,
+            }))
+            return
+
+        self.stdout.write(f"{len(events)} updates, batches of {options['batch']}")
+        self.stdout.write(
+            f"{'codec':<24}{'up B':>8}{'decode us':>11}{'update B':>10}{'encode us':>11}"
+            f"{'batch B/upd':>13}{'batch us/upd':>14}"
+        )
+        for row in results:
+            self.stdout.write(
+                f"{row['codec']:<24}{row['uplink_bytes']:>8}{row['uplink_decode_us']:>11}"
+                f"{row['update_bytes']:>10}{row['update_encode_us']:>11}"
+                f"{row['batch_bytes_per_update']:>13}{row['batch_encode_us_per_update']:>14}"
+            )
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from tracking.history import history_setting
+from tracking.partitions import (
+    NativePartitions, get_history_storage, month_start, next_month,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Create upcoming monthly history partitions (PostgreSQL) or move closed "
+        "months into per-month archive tables (other databases). Run daily."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ahead", type=int, default=None,
+            help="Months to create ahead of the current one (default TRACKING_HISTORY['PARTITIONS_AHEAD'])",
+        )
+
+    def handle(self, *args, **options):
+        storage = get_history_storage()
+        current = month_start(timezone.now())
+
+        if isinstance(storage, NativePartitions):
+            ahead = options["ahead"]
+            if ahead is None:
+                ahead = history_setting("PARTITIONS_AHEAD")
+            months = [current]
+            for _ in range(ahead):
+                months.append(next_month(months[-1]))
+            created = storage.ensure(months)
+        else:
+            created = storage.archive(before=current)
+
+        for name in created:
+            self.stdout.write(f"  {name}")
+        self.stdout.write(self.style.SUCCESS(f"{len(created)} partition(s) created or filled"))
@@ -0,0 +1,312 @@
+"""
+In-process load test of the tracking pipeline.
+
+Runs ``campusbuggy.asgi.application`` inside this process against a fresh
+test database and an in-memory channel layer, connects simulated drivers and
+students through the real WebSocket stack, and measures what one worker
+sustains: ping -> delivery latency, message throughput, SQL queries per ping
+and memory per connection. ``--json`` prints one object suitable for
+comparing releases.
+"""
+import asyncio
+import json
+import math
+import random
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from ._synthetic import CAMPUS_CENTER
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class QueryCounter:
+    """Counts SQL statements on every connection, in every thread, while active."""
+
+    def __init__(self):
+        self.active = False
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.active:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def create_users(drivers, students):
+    # No passwords: hashing them would dominate setup time
+    from rest_framework.authtoken.models import Token
+
+    from tracking.models import Buggy
+    from users.models import User
+
+    driver_tokens, student_tokens, buggy_ids = [], [], []
+    for index in range(drivers):
+        driver = User.objects.create_user(
+            f"load-driver-{index}", password=None, user_type="driver",
+            phone_number=f"1{index:09d}", first_name="Load", last_name="Driver",
+        )
+        buggy = Buggy.objects.create(
+            number_plate=f"LOAD-{index}", capacity=6, assigned_driver=driver, is_running=True
+        )
+        driver_tokens.append(Token.objects.create(user=driver).key)
+        buggy_ids.append(buggy.id)
+    for index in range(students):
+        student = User.objects.create_user(
+            f"load-student-{index}", password=None, user_type="student",
+            phone_number=f"2{index:09d}", first_name="Load", last_name="Student",
+        )
+        student_tokens.append(Token.objects.create(user=student).key)
+    return driver_tokens, student_tokens, buggy_ids
+
+
+class LoadRun:
+    def __init__(self, application, driver_tokens, student_tokens, buggy_ids, options, counter):
+        self.application = application
+        self.driver_tokens = driver_tokens
+        self.student_tokens = student_tokens
+        self.buggy_ids = buggy_ids
+        self.options = options
+        self.counter = counter
+
+        # (buggy id, latitude) -> monotonic send time; every ping has a unique latitude
+        self.sent = {}
+        self.pings = 0
+        self.latencies = []
+        self.frames = 0
+        self.updates = 0
+
+    async def connect(self, token):
+        from channels.testing import WebsocketCommunicator
+
+        communicator = WebsocketCommunicator(self.application, f"ws/location/updates?token={token}")
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise RuntimeError("WebSocket connection was rejected")
+        return communicator
+
+    async def read(self, communicator):
+        # Read the output queue directly: receive_from() cancels the app on timeout
+        while True:
+            message = await communicator.output_queue.get()
+            if message.get("type") != "websocket.send":
+                continue
+            received = time.monotonic()
+            frame = json.loads(message["text"])
+            if frame["type"] == "location_batch":
+                updates = frame["updates"]
+            elif frame["type"] == "location_update":
+                updates = [frame]
+            else:
+                continue
+            self.frames += 1
+            for update in updates:
+                sent = self.sent.get((update["buggy_id"], update["latitude"]))
+                if sent is not None:
+                    self.updates += 1
+                    self.latencies.append(received - sent)
+
+    async def drive(self, communicator, buggy_id, index, deadline):
+        interval = 1.0 / self.options["rate"]
+        rng = random.Random(index)
+        await asyncio.sleep(rng.uniform(0, interval))
+        sequence = 0
+        while time.monotonic() < deadline:
+            sequence += 1
+            latitude = CAMPUS_CENTER[0] + index * 1e-4 + sequence * 1e-7
+            self.sent[(buggy_id, latitude)] = time.monotonic()
+            await communicator.send_json_to({
+                "type": "location_update",
+                "buggy_id": buggy_id,
+                "latitude": latitude,
+                "longitude": CAMPUS_CENTER[1],
+                "direction": 0,
+            })
+            self.pings += 1
+            await asyncio.sleep(interval)
+
+    async def run(self):
+        from tracking.broadcast import get_broadcaster
+        from tracking.executor import get_db_executor
+        from tracking.ingest import get_ingest_buffer
+
+        options = self.options
+        if options["tick"] is not None:
+            get_broadcaster().tick_interval = options["tick"]
+
+        # Memory is traced only while connecting; tracing slows everything down
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        drivers = [await self.connect(token) for token in self.driver_tokens]
+        students = [await self.connect(token) for token in self.student_tokens]
+        connected_bytes = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+
+        for index, student in enumerate(students):
+            if options["subscribe"] == "all":
+                await student.send_json_to({"type": "subscribe", "all": True})
+            else:
+                buggy_id = self.buggy_ids[index % len(self.buggy_ids)]
+                await student.send_json_to({"type": "subscribe", "buggy_ids": [buggy_id]})
+        readers = [asyncio.ensure_future(self.read(student)) for student in students]
+        await asyncio.sleep(0.2)
+
+        self.counter.active = True
+        started = time.monotonic()
+        deadline = started + options["duration"]
+        await asyncio.gather(*(
+            self.drive(driver, buggy_id, index, deadline)
+            for index, (driver, buggy_id) in enumerate(zip(drivers, self.buggy_ids))
+        ))
+        # Let the last tick go out and the write-behind buffer drain
+        tick = get_broadcaster().tick_interval
+        await asyncio.sleep(tick + 0.2)
+        await get_ingest_buffer().aflush()
+        elapsed = time.monotonic() - started
+        self.counter.active = False
+
+        for reader in readers:
+            reader.cancel()
+        for communicator in drivers + students:
+            await communicator.disconnect()
+        # Disconnecting drivers queues their last fixes; write them before
+        # the test database goes away
+        await get_ingest_buffer().aflush()
+
+        latencies_ms = [latency * 1000 for latency in self.latencies]
+        connections_count = len(drivers) + len(students)
+        return {
+            "config": {
+                "drivers": len(drivers),
+                "students": len(students),
+                "rate": options["rate"],
+                "duration": options["duration"],
+                "subscribe": options["subscribe"],
+                "tick_interval": tick,
+                "db_workers": get_db_executor().max_workers,
+                "database": connections["default"].vendor,
+            },
+            "pings": self.pings,
+            "pings_per_sec": round(self.pings / options["duration"], 1),
+            "frames_delivered": self.frames,
+            "frames_per_sec": round(self.frames / elapsed, 1),
+            "updates_delivered": self.updates,
+            "updates_per_sec": round(self.updates / elapsed, 1),
+            "latency_ms": {
+                "samples": len(latencies_ms),
+                "p50": _round(percentile(latencies_ms, 50)),
+                "p90": _round(percentile(latencies_ms, 90)),
+                "p99": _round(percentile(latencies_ms, 99)),
+                "max": _round(max(latencies_ms, default=None)),
+            },
+            "queries": self.counter.count,
+            "queries_per_ping": round(self.counter.count / self.pings, 3) if self.pings else None,
+            "memory_per_connection_bytes": round(connected_bytes / connections_count) if connections_count else None,
+            "broadcast": get_broadcaster().stats(),
+            "ingest": get_ingest_buffer().stats(),
+            "db_executor": get_db_executor().stats(),
+        }
+
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+
+class Command(BaseCommand):
+    help = (
+        "Load the tracking pipeline in-process with simulated drivers and students "
+        "and report latency, throughput, queries per ping and memory per connection."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--drivers", type=int, default=20, help="Simulated drivers, one buggy each")
+        parser.add_argument("--students", type=int, default=200, help="Simulated student sockets")
+        parser.add_argument("--rate", type=float, default=1.0, help="Pings per second per driver")
+        parser.add_argument("--duration", type=float, default=10.0, help="Seconds of pinging")
+        parser.add_argument(
+            "--subscribe", choices=["all", "buggy"], default="all",
+            help="Students subscribe to every buggy, or each to one buggy",
+        )
+        parser.add_argument(
+            "--tick", type=float, default=None,
+            help="Override TRACKING_BROADCAST['TICK_INTERVAL'] (seconds)",
+        )
+        parser.add_argument(
+            "--db-workers", type=int, default=None,
+            help="Override TRACKING_DB_EXECUTOR['MAX_WORKERS'] (0 = shared sync thread)",
+        )
+        parser.add_argument(
+            "--check-ttl", type=float, default=None,
+            help="Override TRACKING_INGEST['BUGGY_CHECK_TTL'] (0 = query on every ping)",
+        )
+        parser.add_argument("--json", action="store_true", help="Print machine-readable output")
+
+    def handle(self, *args, **options):
+        counter = QueryCounter()
+        layers = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+        live_store = {"BACKEND": "tracking.live.LocalLiveStore"}
+        overrides = {}
+        if options["db_workers"] is not None:
+            overrides["TRACKING_DB_EXECUTOR"] = {"MAX_WORKERS": options["db_workers"]}
+        if options["check_ttl"] is not None:
+            overrides["TRACKING_INGEST"] = {
+                **getattr(settings, "TRACKING_INGEST", {}), "BUGGY_CHECK_TTL": options["check_ttl"],
+            }
+
+        with override_settings(CHANNEL_LAYERS=layers, TRACKING_LIVE_STORE=live_store, **overrides):
+            from channels.layers import channel_layers
+
+            channel_layers.backends = {}
+            self.stderr.write("Creating test database...")
+            old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+            try:
+                driver_tokens, student_tokens, buggy_ids = create_users(
+                    options["drivers"], options["students"]
+                )
+                connection_created.connect(counter.install)
+                for connection in connections.all():
+                    counter.install(connection)
+
+                from campusbuggy.asgi import application
+
+                run = LoadRun(application, driver_tokens, student_tokens, buggy_ids, options, counter)
+                report = asyncio.run(run.run())
+            finally:
+                connection_created.disconnect(counter.install)
+                connections.close_all()
+                teardown_databases(old_config, verbosity=0)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+
+        config, latency = report["config"], report["latency_ms"]
+        self.stdout.write(
+            f"{config['drivers']} drivers x {config['rate']}/s, {config['students']} students "
+            f"({config['subscribe']}), {config['duration']}s, tick {config['tick_interval']}s, "
+            f"{config['db_workers']} DB workers, {config['database']}"
+        )
+        self.stdout.write(f"pings sent          {report['pings']} ({report['pings_per_sec']}/s)")
+        self.stdout.write(f"frames delivered    {report['frames_delivered']} ({report['frames_per_sec']}/s)")
+        self.stdout.write(f"updates delivered   {report['updates_delivered']} ({report['updates_per_sec']}/s)")
+        self.stdout.write(
+            f"latency ms          p50 {latency['p50']}  p90 {latency['p90']}  "
+            f"p99 {latency['p99']}  max {latency['max']}"
+        )
+        self.stdout.write(f"queries per ping    {report['queries_per_ping']}")
+        self.stdout.write(f"bytes per socket    {report['memory_per_connection_bytes']}")
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from tracking.history import history_setting
+from tracking.partitions import get_history_storage, minute_start, rollup_before
+
+
+class Command(BaseCommand):
+    help = "Roll up and delete Location history older than the retention period."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=None,
+            help="Days of full history to keep (default TRACKING_HISTORY['RETENTION_DAYS'])",
+        )
+        parser.add_argument("--no-rollup", action="store_true", help="Drop old history without per-minute rollups")
+        parser.add_argument("--dry-run", action="store_true", help="Only print the cutoff")
+
+    def handle(self, *args, **options):
+        days = options["days"] if options["days"] is not None else history_setting("RETENTION_DAYS")
+        cutoff = minute_start(timezone.now() - timedelta(days=days))
+        self.stdout.write(f"Pruning history before {cutoff.isoformat()}")
+        if options["dry_run"]:
+            return
+
+        if not options["no_rollup"]:
+            written = rollup_before(cutoff)
+            self.stdout.write(f"{written} minute rollup(s) written")
+
+        dropped = get_history_storage().drop_before(cutoff)
+        for name in dropped:
+            self.stdout.write(f"  dropped {name}")
+        self.stdout.write(self.style.SUCCESS(f"{len(dropped)} partition(s) dropped"))
@@ -0,0 +1,115 @@
+from datetime import datetime, time, timedelta
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from tracking.heatmap import HeatmapGrid, bin_by_day, dwell_samples, heatmap_setting
+from tracking.history import parse_since
+from tracking.models import HeatmapDay, LocationRollup
+from tracking.partitions import get_history_storage
+
+# A rollup stands for its minute of fixes, so it is placed mid-minute
+ROLLUP_OFFSET = 30.0
+
+# Today and yesterday still take live counts: buffered pings, late uploads
+# and intervals running across midnight are merged into them by
+# HeatmapAccumulator, and rebuilding a day under it loses or doubles them
+LIVE_DAYS = 2
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute daily heatmaps from stored location history and rollups. Today and "
+        "yesterday are left to the live counts, so only days before them are rebuilt."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since", default=None,
+            help="Only rebuild days in this range (e.g. 7d); default all history",
+        )
+        parser.add_argument("--chunk-size", type=int, default=5000, help="History rows read per query")
+
+    def handle(self, *args, **options):
+        try:
+            start = parse_since(options["since"]) if options["since"] else self.oldest()
+        except (ValueError, IndexError):
+            raise CommandError("Invalid --since; use {number}{unit} where unit is h, m, or d")
+        if start is None:
+            self.stdout.write("No history to rebuild")
+            return
+
+        grid = HeatmapGrid.from_settings()
+        day = timezone.localtime(start).date()
+        last = timezone.localdate() - timedelta(days=LIVE_DAYS)
+        if day > last:
+            if options["since"]:
+                raise CommandError(f"Days after {last} are still being counted live; pick a longer --since")
+            self.stdout.write("No days old enough to rebuild")
+            return
+
+        rebuilt = 0
+        while day <= last:
+            total = self.rebuild(grid, day, options["chunk_size"])
+            if total:
+                self.stdout.write(f"  {day}: {total} buggy-second(s)")
+                rebuilt += 1
+            day += timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(f"{rebuilt} day(s) rebuilt on grid {grid.key}"))
+
+    def oldest(self):
+        candidates = [
+            source.aggregate(oldest=Min('timestamp'))['oldest']
+            for source in get_history_storage().all_sources()
+        ]
+        candidates.append(LocationRollup.objects.aggregate(oldest=Min('minute'))['oldest'])
+        candidates = [value for value in candidates if value is not None]
+        return min(candidates) if candidates else None
+
+    def rebuild(self, grid, day, chunk_size):
+        day_start = timezone.make_aware(datetime.combine(day, time.min))
+        day_end = timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+        # Intervals running across midnight are sampled whole and split by day
+        max_gap = heatmap_setting("MAX_GAP")
+        margin = timedelta(seconds=max_gap)
+
+        rows = list(self.points(day_start - margin, day_end + margin, chunk_size))
+        counts, outside = np.zeros(grid.size), 0.0
+        if rows:
+            buggy_ids, seconds, latitudes, longitudes = (np.array(column) for column in zip(*rows))
+            order = np.lexsort((seconds, buggy_ids))
+            binned = bin_by_day(grid, *dwell_samples(
+                buggy_ids[order], latitudes[order], longitudes[order], seconds[order],
+                heatmap_setting("SAMPLE_INTERVAL"), max_gap,
+            ))
+            counts, outside = binned.get(day, (counts, outside))
+
+        counts = np.rint(counts).astype(np.uint64)
+        total, outside = int(counts.sum()), round(outside)
+        with transaction.atomic():
+            HeatmapDay.objects.filter(date=day, grid=grid.key).delete()
+            if total or outside:
+                HeatmapDay.objects.create(
+                    date=day, grid=grid.key, counts=grid.encode(counts),
+                    total=total, outside=outside,
+                )
+        return total + outside
+
+    def points(self, start, end, chunk_size):
+        """``(buggy_id, seconds, latitude, longitude)`` of history and rollups in ``[start, end)``."""
+        for source in get_history_storage().sources(start):
+            rows = source.filter(timestamp__gte=start, timestamp__lt=end).values_list(
+                'buggy_id', 'timestamp', 'latitude', 'longitude'
+            )
+            for buggy_id, timestamp, latitude, longitude in rows.iterator(chunk_size=chunk_size):
+                yield buggy_id, timestamp.timestamp(), latitude, longitude
+
+        # History pruned to per-minute rollups
+        rollups = LocationRollup.objects.filter(minute__gte=start, minute__lt=end).values_list(
+            'buggy_id', 'minute', 'latitude', 'longitude'
+        )
+        for buggy_id, minute, latitude, longitude in rollups.iterator(chunk_size=chunk_size):
+            yield buggy_id, minute.timestamp() + ROLLUP_OFFSET, latitude, longitude
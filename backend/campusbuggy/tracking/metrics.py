@@ -0,0 +1,144 @@
+"""
+Hot-path metrics for the tracking app (served on ``/metrics``, see
+``campusbuggy.metrics``).
+
+Group sizes are counted from this process's sockets; with a channel layer
+shared by several workers each worker reports its own members.
+"""
+import threading
+from collections import Counter as Tally
+
+from campusbuggy.metrics import collector, counter, gauge, histogram
+
+# Message types clients may send; anything else is counted as "other" so
+# client input can't create new label values
+MESSAGE_TYPES = {"location_update", "location_batch", "subscribe", "nearby", "trails",
+                 "subscribe_etas"}
+
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+WS_MESSAGES = counter(
+    "tracking_ws_messages_total", "WebSocket messages received from clients", ["type"]
+)
+WS_RECEIVE_SECONDS = histogram(
+    "tracking_ws_receive_seconds", "Time spent in LocationConsumer.receive", ["type"]
+)
+PINGS = counter("tracking_pings_total", "Driver location pings", ["result"])
+OPEN_SOCKETS = gauge("tracking_open_sockets", "Open WebSocket connections", ["user_type"])
+
+DB_SECONDS = histogram(
+    "tracking_db_seconds", "Time spent in database helpers, excluding thread pool wait", ["helper"]
+)
+DB_POOL_WAIT_SECONDS = histogram(
+    "tracking_db_pool_wait_seconds",
+    "Time database helpers queued for a DB executor thread",
+    ["helper"],
+)
+
+DELTA_UPDATES = counter(
+    "tracking_delta_updates_total", "Updates to delta-mode sockets by outcome", ["result"]
+)
+
+SNAPPED_PINGS = counter(
+    "tracking_snapped_pings_total", "Accepted fixes by whether they were snapped to a road", ["result"]
+)
+
+GROUP_SEND_SECONDS = histogram(
+    "tracking_group_send_seconds", "Time spent in channel layer group_send", ["group"]
+)
+FANOUT = histogram(
+    "tracking_broadcast_fanout",
+    "Local sockets a broadcast tick delivers to",
+    buckets=FANOUT_BUCKETS,
+)
+
+
+def message_type_label(message_type):
+    return message_type if message_type in MESSAGE_TYPES else "other"
+
+
+# ------------------ Group membership ------------------
+
+_members_lock = threading.Lock()
+_members = Tally()
+
+
+def group_joined(group):
+    with _members_lock:
+        _members[group] += 1
+
+
+def group_left(group):
+    with _members_lock:
+        _members[group] -= 1
+        if _members[group] <= 0:
+            del _members[group]
+
+
+def group_size(group):
+    return _members.get(group, 0)
+
+
+@collector
+def collect_groups():
+    with _members_lock:
+        members = list(_members.items())
+    yield (
+        "tracking_group_members", "gauge", "Local sockets subscribed to each group",
+        [({"group": group}, count) for group, count in members],
+    )
+
+
+@collector
+def collect_pipeline():
+    # Stats the pipeline components already keep, read at scrape time
+    from users.authentication import get_token_cache
+
+    from .broadcast import get_broadcaster
+    from .executor import get_db_executor
+    from .ingest import get_ingest_buffer
+    from .readcache import get_read_cache
+
+    ingest = get_ingest_buffer().stats()
+    yield ("tracking_ingest_queue_depth", "gauge", "Pings waiting to be written", [({}, ingest["queue_depth"])])
+    yield ("tracking_ingest_enqueued_total", "counter", "Pings accepted by the ingest buffer", [({}, ingest["enqueued"])])
+    yield ("tracking_ingest_flushes_total", "counter", "Ingest buffer flushes", [
+        ({"result": "ok"}, ingest["flushes"]), ({"result": "failed"}, ingest["failed_flushes"]),
+    ])
+    yield ("tracking_ingest_rows_written_total", "counter", "Rows written by the ingest buffer", [
+        ({"table": "buggylocation"}, ingest["live_rows_written"]),
+        ({"table": "location"}, ingest["history_rows_written"]),
+    ])
+
+    broadcast = get_broadcaster().stats()
+    yield ("tracking_broadcast_pending", "gauge", "Updates waiting for the next tick", [({}, broadcast["pending"])])
+    yield ("tracking_broadcast_updates_total", "counter", "Location updates by outcome", [
+        ({"outcome": "published"}, broadcast["updates_published"]),
+        ({"outcome": "sent"}, broadcast["updates_sent"]),
+        ({"outcome": "coalesced"}, broadcast["frames_saved"]),
+    ])
+    yield ("tracking_broadcast_tick_lag_seconds", "gauge", "Lag of the last broadcast tick", [
+        ({}, broadcast["last_tick_lag"]),
+    ])
+
+    executor = get_db_executor().stats()
+    yield ("tracking_db_executor_workers", "gauge", "Threads of the DB executor, 0 for the shared thread", [
+        ({}, executor["max_workers"]),
+    ])
+    yield ("tracking_db_executor_calls", "gauge", "DB executor calls by state", [
+        ({"state": "queued"}, executor["queued"]), ({"state": "running"}, executor["running"]),
+    ])
+
+    tokens = get_token_cache().stats()
+    yield ("token_cache_lookups_total", "counter", "Token cache lookups", [
+        ({"result": "local_hit"}, tokens["local_hits"]),
+        ({"result": "shared_hit"}, tokens["shared_hits"]),
+        ({"result": "miss"}, tokens["misses"]),
+    ])
+
+    views = get_read_cache().stats()["views"]
+    yield ("tracking_read_cache_lookups_total", "counter", "Read model cache lookups", [
+        ({"view": view, "result": result}, counts[key])
+        for view, counts in views.items()
+        for result, key in (("hit", "hits"), ("miss", "misses"))
+    ])
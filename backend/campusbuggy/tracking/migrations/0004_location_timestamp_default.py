@@ -0,0 +1,20 @@
+# Generated by Django 5.2 on 2026-10-18 00:31
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracking", "0003_buggy_capacity"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="location",
+            name="timestamp",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, editable=False
+            ),
+        ),
+    ]
@@ -0,0 +1,145 @@
+# Generated by Django 5.2 on 2026-10-18 00:42
+
+import django.db.models.deletion
+from datetime import datetime, timezone
+from django.conf import settings
+from django.db import migrations, models
+
+# On PostgreSQL, tracking_location becomes a native range-partitioned table
+# with one partition per month (see tracking/partitions.py). Partitioned
+# tables need the partition key in the primary key and, before PostgreSQL 17,
+# can't use identity columns, so ids come from a plain sequence instead.
+
+TABLE = "tracking_location"
+INDEXES = {
+    "tracking_lo_buggy_i_4535c3_idx": '(buggy_id, "timestamp")',
+    "tracking_lo_timesta_81721e_idx": '("timestamp")',
+}
+DRIVER_INDEX = "tracking_location_driver_id_idx"
+SEQUENCE = "tracking_location_pid_seq"
+PARTITIONS_AHEAD = 2
+
+
+def month_starts(first, months_after_now):
+    now = datetime.now(timezone.utc)
+    last = (now.year * 12 + now.month - 1) + months_after_now
+    month = first.year * 12 + first.month - 1
+    while month <= last:
+        yield datetime(month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+        month += 1
+
+
+def swap_table(schema_editor, user_table, partitioned):
+    execute = schema_editor.execute
+    old = f"{TABLE}_old"
+
+    execute(f"ALTER TABLE {TABLE} RENAME TO {old}")
+    for index in INDEXES:
+        execute(f"ALTER INDEX {index} RENAME TO {index[:-4]}_old")
+    # Only the partitioned table uses this name; Django names its FK index with a hash
+    execute(f"ALTER INDEX IF EXISTS {DRIVER_INDEX} RENAME TO {TABLE}_driver_id_old")
+
+    if partitioned:
+        execute(f"CREATE SEQUENCE {SEQUENCE}")
+        id_column = f"id bigint NOT NULL DEFAULT nextval('{SEQUENCE}')"
+        primary_key = 'PRIMARY KEY (id, "timestamp")'
+        suffix = ' PARTITION BY RANGE ("timestamp")'
+    else:
+        id_column = "id bigint NOT NULL GENERATED BY DEFAULT AS IDENTITY"
+        primary_key = "PRIMARY KEY (id)"
+        suffix = ""
+
+    execute(
+        f"CREATE TABLE {TABLE} ("
+        f"{id_column}, "
+        "latitude double precision NOT NULL, "
+        "longitude double precision NOT NULL, "
+        '"timestamp" timestamp with time zone NOT NULL, '
+        "buggy_id bigint NOT NULL REFERENCES tracking_buggy (id) DEFERRABLE INITIALLY DEFERRED, "
+        f"driver_id bigint NOT NULL REFERENCES {user_table} (id) DEFERRABLE INITIALLY DEFERRED, "
+        f"{primary_key}){suffix}"
+    )
+    if partitioned:
+        execute(f"ALTER SEQUENCE {SEQUENCE} OWNED BY {TABLE}.id")
+    for index, columns in INDEXES.items():
+        execute(f"CREATE INDEX {index} ON {TABLE} {columns}")
+    execute(f"CREATE INDEX {DRIVER_INDEX} ON {TABLE} (driver_id)")
+
+    if partitioned:
+        execute(f"CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT")
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f'SELECT MIN("timestamp") FROM {old}')
+            first = cursor.fetchone()[0] or datetime.now(timezone.utc)
+        for month in month_starts(first, PARTITIONS_AHEAD):
+            following = datetime(
+                month.year + month.month // 12, month.month % 12 + 1, 1, tzinfo=timezone.utc
+            )
+            execute(
+                f"CREATE TABLE {TABLE}_{month:%Y%m} PARTITION OF {TABLE} FOR VALUES "
+                f"FROM ('{month:%Y-%m-%d}+00') TO ('{following:%Y-%m-%d}+00')"
+            )
+
+    columns = 'id, latitude, longitude, "timestamp", buggy_id, driver_id'
+    execute(f"INSERT INTO {TABLE} ({columns}) SELECT {columns} FROM {old}")
+    if partitioned:
+        sequence = f"'{SEQUENCE}'"
+    else:
+        sequence = f"pg_get_serial_sequence('{TABLE}', 'id')"
+    execute(f"SELECT setval({sequence}, COALESCE((SELECT MAX(id) FROM {TABLE}), 0) + 1, false)")
+    execute(f"DROP TABLE {old} CASCADE")
+
+
+def partition_location(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    user_table = apps.get_model(settings.AUTH_USER_MODEL)._meta.db_table
+    swap_table(schema_editor, user_table, partitioned=True)
+
+
+def unpartition_location(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    user_table = apps.get_model(settings.AUTH_USER_MODEL)._meta.db_table
+    swap_table(schema_editor, user_table, partitioned=False)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracking", "0004_location_timestamp_default"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LocationRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("minute", models.DateTimeField()),
+                ("samples", models.PositiveIntegerField()),
+                ("latitude", models.FloatField()),
+                ("longitude", models.FloatField()),
+                (
+                    "buggy",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="tracking.buggy"
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("buggy", "minute"), name="unique_rollup_minute"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(partition_location, unpartition_location),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2 on 2026-10-18 01:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0005_location_partitions_and_rollup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Trip',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField()),
+                ('is_open', models.BooleanField(default=True)),
+                ('point_count', models.PositiveIntegerField(default=0)),
+                ('distance', models.FloatField(default=0)),
+                ('min_latitude', models.FloatField()),
+                ('min_longitude', models.FloatField()),
+                ('max_latitude', models.FloatField()),
+                ('max_longitude', models.FloatField()),
+                ('end_latitude', models.FloatField()),
+                ('end_longitude', models.FloatField()),
+                ('polyline', models.TextField(blank=True, default='')),
+                ('times', models.TextField(blank=True, default='')),
+                ('buggy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tracking.buggy')),
+                ('driver', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['buggy', 'started_at'], name='tracking_tr_buggy_i_7717e8_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('is_open', True)), fields=('buggy',), name='one_open_trip_per_buggy')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2 on 2026-10-18 01:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0007_stop'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Route',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('is_active', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RouteSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField()),
+                ('start_latitude', models.FloatField()),
+                ('start_longitude', models.FloatField()),
+                ('end_latitude', models.FloatField()),
+                ('end_longitude', models.FloatField()),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='tracking.route')),
+            ],
+            options={
+                'ordering': ['route', 'sequence'],
+                'constraints': [models.UniqueConstraint(fields=('route', 'sequence'), name='unique_route_segment')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-18 01:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0008_route'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HeatmapDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('grid', models.CharField(max_length=100)),
+                ('counts', models.BinaryField()),
+                ('total', models.PositiveBigIntegerField(default=0)),
+                ('outside', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('date', 'grid'), name='unique_heatmap_day')],
+            },
+        ),
+    ]
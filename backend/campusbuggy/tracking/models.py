@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 
 # For buggy 
 class Buggy(models.Model):
@@ -33,10 +34,114 @@ class Location(models.Model):
     driver = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     latitude = models.FloatField()
     longitude = models.FloatField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set from the ping itself so write-behind flushes keep the original time
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     
     class Meta:
         indexes = [
             models.Index(fields=['buggy', 'timestamp']),
             models.Index(fields=['timestamp']),
-        ]
\ No newline at end of file
+        ]
+
+# Per-minute summary of history that has aged out of Location
+class LocationRollup(models.Model):
+    buggy = models.ForeignKey(Buggy, on_delete=models.CASCADE)
+    minute = models.DateTimeField()
+    samples = models.PositiveIntegerField()
+    latitude = models.FloatField()  # mean of the minute's fixes
+    longitude = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['buggy', 'minute'], name='unique_rollup_minute'),
+        ]
+
+# A buggy's run, segmented from its location history (see tracking/trips.py)
+class Trip(models.Model):
+    buggy = models.ForeignKey(Buggy, on_delete=models.CASCADE)
+    driver = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True
+    )
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    is_open = models.BooleanField(default=True)  # still being extended by new history
+    point_count = models.PositiveIntegerField(default=0)
+    distance = models.FloatField(default=0)  # metres
+    min_latitude = models.FloatField()
+    min_longitude = models.FloatField()
+    max_latitude = models.FloatField()
+    max_longitude = models.FloatField()
+    # Last fix, to continue the encoded path
+    end_latitude = models.FloatField()
+    end_longitude = models.FloatField()
+    # The path in the "polyline" trail format (see tracking/encoding.py)
+    polyline = models.TextField(blank=True, default='')
+    times = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['buggy', 'started_at']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['buggy'], condition=models.Q(is_open=True), name='one_open_trip_per_buggy'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.buggy.number_plate} {self.started_at:%Y-%m-%d %H:%M}"
+
+# A campus stop buggies pick students up at (see tracking/eta.py)
+class Stop(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    is_active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.name
+
+# A road buggies drive on; incoming fixes are snapped to it (see tracking/snapping.py)
+class Route(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    is_active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.name
+
+# One straight piece of a route, in driving order
+class RouteSegment(models.Model):
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='segments')
+    sequence = models.PositiveIntegerField()
+    start_latitude = models.FloatField()
+    start_longitude = models.FloatField()
+    end_latitude = models.FloatField()
+    end_longitude = models.FloatField()
+
+    class Meta:
+        ordering = ['route', 'sequence']
+        constraints = [
+            models.UniqueConstraint(fields=['route', 'sequence'], name='unique_route_segment'),
+        ]
+
+    def __str__(self):
+        return f"{self.route.name} #{self.sequence}"
+
+# Time buggies spent in each grid cell per hour of one day (see tracking/heatmap.py)
+class HeatmapDay(models.Model):
+    date = models.DateField()
+    # Bounds and cell size the counts were binned with
+    grid = models.CharField(max_length=100)
+    # zlib-compressed little-endian uint32 buggy-seconds, shape (24, rows, cols)
+    counts = models.BinaryField()
+    total = models.PositiveBigIntegerField(default=0)
+    outside = models.PositiveBigIntegerField(default=0)  # buggy-seconds outside the grid
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'grid'], name='unique_heatmap_day'),
+        ]
+
+    def __str__(self):
+        return f"Heatmap {self.date}"
@@ -0,0 +1,196 @@
+"""
+"Buggies near me" queries over live positions.
+
+``NearbyIndex`` is a uniform grid over latitude/longitude. ``LocationConsumer``
+moves a buggy between cells on every accepted ping, and a query only visits
+the cells overlapping the search circle, so its cost depends on how many
+buggies are nearby rather than on the fleet size.
+
+Cells are ``CELL_SIZE`` metres tall and the same number of degrees wide
+(narrower in metres away from the equator, which the search accounts for).
+
+The index lives in the worker process. With a shared live store (Redis),
+pings received by other workers are picked up by rebuilding the index from
+the store at most every ``REFRESH_INTERVAL`` seconds.
+"""
+import heapq
+import math
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .geo import EARTH_RADIUS_M, haversine
+from .live import get_live_store
+
+DEFAULTS = {
+    "CELL_SIZE": 250,           # metres
+    "DEFAULT_RADIUS": 1000,     # metres
+    "MAX_RADIUS": 5000,
+    "DEFAULT_LIMIT": 5,
+    "MAX_LIMIT": 50,
+    "REFRESH_INTERVAL": 5.0,    # seconds, shared live stores only
+}
+
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+
+def nearby_setting(name):
+    return getattr(settings, "TRACKING_NEARBY", {}).get(name, DEFAULTS[name])
+
+
+class NearbyIndex:
+    def __init__(self, cell_size=250):
+        self.cell_degrees = cell_size / METRES_PER_DEGREE
+        self._lock = threading.Lock()
+        self._cells = {}
+        # buggy id -> (latitude, longitude, cell)
+        self._positions = {}
+        self.synced_at = None
+
+    def cell_of(self, latitude, longitude):
+        return (
+            math.floor(latitude / self.cell_degrees),
+            math.floor(longitude / self.cell_degrees),
+        )
+
+    def update(self, buggy_id, latitude, longitude):
+        cell = self.cell_of(latitude, longitude)
+        with self._lock:
+            previous = self._positions.get(buggy_id)
+            if previous is not None and previous[2] != cell:
+                self._discard_from_cell(buggy_id, previous[2])
+            self._cells.setdefault(cell, set()).add(buggy_id)
+            self._positions[buggy_id] = (latitude, longitude, cell)
+
+    def remove(self, buggy_ids):
+        with self._lock:
+            for buggy_id in buggy_ids:
+                previous = self._positions.pop(buggy_id, None)
+                if previous is not None:
+                    self._discard_from_cell(buggy_id, previous[2])
+
+    def rebuild(self, entries):
+        """Replace the index with ``live_entry`` dicts."""
+        with self._lock:
+            self._cells = {}
+            self._positions = {}
+            for entry in entries:
+                latitude, longitude = entry["latitude"], entry["longitude"]
+                cell = self.cell_of(latitude, longitude)
+                self._cells.setdefault(cell, set()).add(entry["buggy_id"])
+                self._positions[entry["buggy_id"]] = (latitude, longitude, cell)
+            self.synced_at = time.monotonic()
+
+    def nearest(self, latitude, longitude, radius, limit):
+        """``(distance, buggy_id)`` of the ``limit`` closest buggies within ``radius`` metres."""
+        row, col = self.cell_of(latitude, longitude)
+        rows = math.ceil(radius / METRES_PER_DEGREE / self.cell_degrees)
+        # Degrees of longitude shrink towards the poles
+        shrink = max(math.cos(math.radians(min(abs(latitude) + rows * self.cell_degrees, 89.0))), 1e-6)
+        cols = math.ceil(rows / shrink)
+
+        with self._lock:
+            if (2 * rows + 1) * (2 * cols + 1) >= len(self._positions):
+                # Fewer buggies than cells to visit: just check them all
+                candidates = list(self._positions.items())
+            else:
+                candidates = [
+                    (buggy_id, self._positions[buggy_id])
+                    for r in range(row - rows, row + rows + 1)
+                    for c in range(col - cols, col + cols + 1)
+                    for buggy_id in self._cells.get((r, c), ())
+                ]
+
+        found = []
+        for buggy_id, (lat, lon, _) in candidates:
+            distance = haversine(latitude, longitude, lat, lon)
+            if distance <= radius:
+                found.append((distance, buggy_id))
+        return heapq.nsmallest(limit, found)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _discard_from_cell(self, buggy_id, cell):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(buggy_id)
+            if not members:
+                del self._cells[cell]
+
+
+def parse_nearby_query(params):
+    """
+    Read ``latitude``, ``longitude`` and optional ``radius`` (metres) and
+    ``limit`` from a query dict or WebSocket message. Raises ValueError.
+    """
+    try:
+        latitude = float(params["latitude"])
+        longitude = float(params["longitude"])
+        radius = float(params.get("radius") or nearby_setting("DEFAULT_RADIUS"))
+        limit = int(params.get("limit") or nearby_setting("DEFAULT_LIMIT"))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("latitude and longitude are required; radius and limit must be numbers")
+
+    # float() accepts "nan" and "inf", which would get past the range checks
+    if not all(math.isfinite(value) for value in (latitude, longitude, radius)):
+        raise ValueError("latitude, longitude and radius must be finite numbers")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("latitude or longitude out of range")
+    if radius <= 0 or limit <= 0:
+        raise ValueError("radius and limit must be positive")
+    return (
+        latitude, longitude,
+        min(radius, nearby_setting("MAX_RADIUS")),
+        min(limit, nearby_setting("MAX_LIMIT")),
+    )
+
+
+def with_distances(matches, entries):
+    return [
+        {**entry, "distance": round(distance, 1)}
+        for (distance, _), entry in zip(matches, entries)
+        if entry is not None
+    ]
+
+
+def needs_rebuild(index, store):
+    if index.synced_at is None:
+        return True
+    return store.shared and time.monotonic() - index.synced_at > nearby_setting("REFRESH_INTERVAL")
+
+
+def nearby_buggies(latitude, longitude, radius, limit):
+    """Live entries of the closest running buggies, each with ``distance`` in metres."""
+    store = get_live_store()
+    if store.needs_warm_up:
+        store.warm_up()
+    index = get_nearby_index()
+    if needs_rebuild(index, store):
+        index.rebuild(store.all())
+
+    matches = index.nearest(latitude, longitude, radius, limit)
+    return with_distances(matches, store.get_many([buggy_id for _, buggy_id in matches]))
+
+
+async def anearby_buggies(latitude, longitude, radius, limit):
+    # A cold or stale index is rebuilt through the sync path in a thread
+    store = get_live_store()
+    index = get_nearby_index()
+    if store.needs_warm_up or needs_rebuild(index, store):
+        return await sync_to_async(nearby_buggies)(latitude, longitude, radius, limit)
+
+    matches = index.nearest(latitude, longitude, radius, limit)
+    return with_distances(matches, await store.aget_many([buggy_id for _, buggy_id in matches]))
+
+
+_index = None
+
+
+def get_nearby_index():
+    global _index
+    if _index is None:
+        _index = NearbyIndex(cell_size=nearby_setting("CELL_SIZE"))
+    return _index
@@ -0,0 +1,324 @@
+"""
+Time-partitioned storage for ``Location`` history.
+
+History is split into one partition per calendar month (UTC) so that range
+queries only read the months they overlap and retention can drop whole months
+instead of deleting row by row.
+
+On PostgreSQL ``tracking_location`` is a native ``PARTITION BY RANGE`` table
+(see migration 0005) with a ``_default`` partition for stragglers; the planner
+prunes partitions outside a query's time range.
+
+Other backends use table-per-period: new rows land in ``tracking_location``
+and ``manage.py history_partitions`` moves every closed month into its own
+``tracking_location_YYYYMM`` table. Queries read the archive tables that
+overlap the requested range, then the live table.
+
+The storage in use is picked from ``TRACKING_HISTORY['PARTITIONING']``
+(``auto``, ``native`` or ``tables``).
+
+Before old months are dropped, ``rollup_before`` condenses them into one
+``LocationRollup`` row per buggy and minute.
+"""
+import re
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.apps.registry import Apps
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Avg, Count
+from django.db.models.functions import TruncMinute
+
+from .models import Buggy, Location, LocationRollup
+
+TABLE = Location._meta.db_table
+PARTITION_RE = re.compile(rf"^{TABLE}_(\d{{4}})(\d{{2}})$")
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+
+def month_start(value):
+    value = value.astimezone(dt_timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def next_month(start):
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def months_between(start, end):
+    """Month starts of every month overlapping ``[start, end)``."""
+    months = []
+    month = month_start(start)
+    while month < end:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+def partition_name(month):
+    return f"{TABLE}_{month:%Y%m}"
+
+
+def partition_month(name):
+    match = PARTITION_RE.match(name)
+    if match is None:
+        return None
+    return datetime(int(match[1]), int(match[2]), 1, tzinfo=dt_timezone.utc)
+
+
+def sql_timestamp(value):
+    # Partition bounds are DDL and can't be bound as parameters
+    return f"'{value:%Y-%m-%d %H:%M:%S}+00'"
+
+
+class HistoryStorage:
+    def sources(self, start_time):
+        """Querysets to read, in time order, for rows at or after ``start_time``."""
+        raise NotImplementedError
+
+    def all_sources(self):
+        return self.sources(datetime.min.replace(tzinfo=dt_timezone.utc))
+
+    def ensure(self, months):
+        """Make sure partitions exist for ``months``; return the names created."""
+        return []
+
+    def archive(self, before):
+        """Move rows older than ``before`` out of the live table; return moved months."""
+        return []
+
+    def drop_before(self, cutoff):
+        """Delete history older than ``cutoff``; return the dropped partitions."""
+        raise NotImplementedError
+
+
+class NativePartitions(HistoryStorage):
+    def partitions(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = %s::regclass",
+                [TABLE],
+            )
+            names = [row[0] for row in cursor.fetchall()]
+        return sorted(
+            (month, name) for name in names
+            if (month := partition_month(name)) is not None
+        )
+
+    def sources(self, start_time):
+        # The planner prunes partitions from the timestamp filter
+        return [Location.objects.all()]
+
+    def ensure(self, months):
+        existing = {name for _, name in self.partitions()}
+        created = []
+        quote = connection.ops.quote_name
+        for month in months:
+            name = partition_name(month)
+            if name in existing:
+                continue
+            start, end = sql_timestamp(month), sql_timestamp(next_month(month))
+            # Rows for this month may already sit in the default partition;
+            # move them over before attaching or the attach would fail.
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TABLE {quote(name)} "
+                    f"(LIKE {quote(TABLE)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                )
+                cursor.execute(
+                    f"WITH moved AS (DELETE FROM {quote(DEFAULT_PARTITION)} "
+                    f"WHERE {quote('timestamp')} >= {start} AND {quote('timestamp')} < {end} "
+                    f"RETURNING *) INSERT INTO {quote(name)} SELECT * FROM moved"
+                )
+                cursor.execute(
+                    f"ALTER TABLE {quote(TABLE)} ATTACH PARTITION {quote(name)} "
+                    f"FOR VALUES FROM ({start}) TO ({end})"
+                )
+            created.append(name)
+        return created
+
+    def drop_before(self, cutoff):
+        dropped = []
+        with transaction.atomic():
+            for month, name in self.partitions():
+                if next_month(month) <= cutoff:
+                    with connection.cursor() as cursor:
+                        cursor.execute(f"DROP TABLE {connection.ops.quote_name(name)}")
+                    dropped.append(name)
+            # Whatever is left before the cutoff sits in the boundary month
+            # or the default partition
+            Location.objects.filter(timestamp__lt=cutoff).delete()
+        return dropped
+
+
+class TablePerPeriod(HistoryStorage):
+    # Other processes create archive tables, so the table list is re-read
+    # at most this often
+    TABLES_TTL = 60
+
+    def __init__(self):
+        self._apps = Apps()
+        self._models = {}
+        self._tables = None
+        self._tables_read = 0.0
+
+    def archive_model(self, month):
+        name = partition_name(month)
+        if name not in self._models:
+            meta = type("Meta", (), {
+                "app_label": "tracking",
+                "apps": self._apps,
+                "db_table": name,
+                "indexes": [models.Index(fields=["buggy_id", "timestamp"], name=f"{name}_bt")],
+            })
+            # Plain integer columns; archive tables carry no FK constraints
+            self._models[name] = type(f"LocationArchive{month:%Y%m}", (models.Model,), {
+                "__module__": __name__,
+                "Meta": meta,
+                "id": models.BigIntegerField(primary_key=True),
+                "buggy_id": models.BigIntegerField(),
+                "driver_id": models.BigIntegerField(),
+                "latitude": models.FloatField(),
+                "longitude": models.FloatField(),
+                "timestamp": models.DateTimeField(),
+            })
+        return self._models[name]
+
+    def archived_months(self, refresh=False):
+        if refresh or self._tables is None or time.monotonic() - self._tables_read > self.TABLES_TTL:
+            self._tables = sorted(
+                month for name in connection.introspection.table_names()
+                if (month := partition_month(name)) is not None
+            )
+            self._tables_read = time.monotonic()
+        return self._tables
+
+    def sources(self, start_time):
+        first = month_start(start_time)
+        archived = [
+            self.archive_model(month).objects.all()
+            for month in self.archived_months() if month >= first
+        ]
+        return archived + [Location.objects.all()]
+
+    def ensure(self, months):
+        existing = set(self.archived_months(refresh=True))
+        created = []
+        for month in months:
+            if month not in existing:
+                with connection.schema_editor() as schema_editor:
+                    schema_editor.create_model(self.archive_model(month))
+                created.append(partition_name(month))
+        self.archived_months(refresh=True)
+        return created
+
+    def archive(self, before):
+        oldest = Location.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+        if oldest is None or oldest >= before:
+            return []
+
+        months = months_between(oldest, month_start(before))
+        self.ensure(months)
+        quote = connection.ops.quote_name
+        columns = ", ".join(
+            quote(column) for column in ("id", "buggy_id", "driver_id", "latitude", "longitude", "timestamp")
+        )
+        for month in months:
+            rows = Location.objects.filter(timestamp__gte=month, timestamp__lt=next_month(month))
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f"INSERT INTO {quote(partition_name(month))} ({columns}) "
+                    f"SELECT {columns} FROM {quote(TABLE)} "
+                    f"WHERE {quote('timestamp')} >= %s AND {quote('timestamp')} < %s",
+                    [
+                        connection.ops.adapt_datetimefield_value(month),
+                        connection.ops.adapt_datetimefield_value(next_month(month)),
+                    ],
+                )
+                rows.delete()
+        return [partition_name(month) for month in months]
+
+    def drop_before(self, cutoff):
+        dropped = []
+        # Each drop is its own transaction: SQLite can't run the schema
+        # editor inside an outer one
+        for month in self.archived_months(refresh=True):
+            model = self.archive_model(month)
+            if next_month(month) <= cutoff:
+                with connection.schema_editor() as schema_editor:
+                    schema_editor.delete_model(model)
+                dropped.append(partition_name(month))
+            elif month < cutoff:
+                model.objects.filter(timestamp__lt=cutoff).delete()
+        Location.objects.filter(timestamp__lt=cutoff).delete()
+        self.archived_months(refresh=True)
+        return dropped
+
+
+def minute_start(value):
+    return value.replace(second=0, microsecond=0)
+
+
+def rollup_before(cutoff, batch_size=1000):
+    """
+    Summarise history older than ``cutoff`` into per-minute ``LocationRollup``
+    rows and return how many were written. Re-running over the same rows
+    rewrites the same values.
+    """
+    cutoff = minute_start(cutoff)
+    buggy_ids = set(Buggy.objects.values_list('id', flat=True))
+    written = 0
+    for source in get_history_storage().all_sources():
+        minutes = (
+            source.filter(timestamp__lt=cutoff)
+            .annotate(minute=TruncMinute('timestamp', tzinfo=dt_timezone.utc))
+            .values('buggy_id', 'minute')
+            .annotate(samples=Count('id'), mean_latitude=Avg('latitude'), mean_longitude=Avg('longitude'))
+            .order_by()
+        )
+        batch = []
+        for row in minutes.iterator(chunk_size=batch_size):
+            # Archive tables keep rows of buggies deleted since
+            if row['buggy_id'] not in buggy_ids:
+                continue
+            batch.append(LocationRollup(
+                buggy_id=row['buggy_id'],
+                minute=row['minute'],
+                samples=row['samples'],
+                latitude=row['mean_latitude'],
+                longitude=row['mean_longitude'],
+            ))
+            if len(batch) >= batch_size:
+                written += _save_rollups(batch)
+                batch = []
+        if batch:
+            written += _save_rollups(batch)
+    return written
+
+
+def _save_rollups(rollups):
+    LocationRollup.objects.bulk_create(
+        rollups,
+        update_conflicts=True,
+        unique_fields=['buggy', 'minute'],
+        update_fields=['samples', 'latitude', 'longitude'],
+    )
+    return len(rollups)
+
+
+_storage = None
+
+
+def get_history_storage():
+    global _storage
+    if _storage is None:
+        mode = getattr(settings, "TRACKING_HISTORY", {}).get("PARTITIONING", "auto")
+        if mode == "auto":
+            mode = "native" if connection.vendor == "postgresql" else "tables"
+        _storage = NativePartitions() if mode == "native" else TablePerPeriod()
+    return _storage
@@ -0,0 +1,197 @@
+"""
+Cached read models for buggy endpoints.
+
+The set of running buggies changes a few times a day, but
+``AvailableBuggiesView`` and ``AssignedBuggyView`` are read on every app
+start and poll. ``ReadModelCache`` keeps their serialized payloads, keyed per
+view (and per driver for the assigned buggy), in a process-local tier,
+optionally backed by a shared Django cache so other workers reuse them.
+
+The first miss in a process loads the running-buggy list and every
+assigned buggy in one query (``warm_up``) instead of one key at a time. It
+runs on the request thread, never at import: ASGI servers import the
+application inside their event loop, where ORM calls are refused.
+
+``tracking.signals`` invalidates exactly the affected keys once every
+``Buggy`` save or delete commits, which covers ``UpdateBuggyStatusView`` and
+admin edits. As with the token cache, other workers' local tiers aren't
+notified: every local entry expires ``LOCAL_TTL`` seconds after it was
+loaded, which bounds how stale they can be when running several workers.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError
+from django.db.models import Q
+
+from .models import Buggy
+from .serializers import BuggySerializer
+
+logger = logging.getLogger(__name__)
+
+AVAILABLE_BUGGIES_KEY = "available-buggies"
+
+
+def assigned_buggy_key(driver_id):
+    return f"assigned-buggy:{driver_id}"
+
+
+def key_view(key):
+    return key.split(":", 1)[0]
+
+
+class ReadModelCache:
+    needs_warm_up = True
+
+    def __init__(self, local_ttl=60, shared_cache=None, shared_ttl=300):
+        self.local_ttl = local_ttl
+        self.shared_cache = caches[shared_cache] if shared_cache else None
+        self.shared_ttl = shared_ttl
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        # Bumped by every invalidation, so a load that raced one isn't cached
+        self._generation = 0
+        # Per view: [hits, misses, invalidations]
+        self._counts = {}
+
+    @classmethod
+    def from_settings(cls):
+        config = getattr(settings, "READ_CACHE", {})
+        return cls(
+            local_ttl=config.get("LOCAL_TTL", 60),
+            shared_cache=config.get("SHARED_CACHE"),
+            shared_ttl=config.get("SHARED_TTL", 300),
+        )
+
+    @staticmethod
+    def shared_key(key):
+        return "readmodel:" + key
+
+    def get_or_load(self, key, loader):
+        """Cached value of ``key``, calling ``loader()`` on a miss. ``None`` is cached too."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._count(key, 0)
+                return entry[1]
+
+        if self.shared_cache is not None:
+            # Wrapped so a cached None ("no buggy assigned") is a hit
+            wrapped = self.shared_cache.get(self.shared_key(key))
+            if wrapped is not None:
+                self._set_local(key, wrapped[0])
+                with self._lock:
+                    self._count(key, 0)
+                return wrapped[0]
+
+        if self.needs_warm_up and self._warm_up_once():
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self._count(key, 1)
+                    return entry[1]
+
+        with self._lock:
+            self._count(key, 1)
+            generation = self._generation
+        value = loader()
+        if generation == self._generation:
+            self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        if self.shared_cache is not None:
+            self.shared_cache.set(self.shared_key(key), (value,), self.shared_ttl)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+                self._count(key, 2)
+        if self.shared_cache is not None:
+            self.shared_cache.delete_many([self.shared_key(key) for key in keys])
+
+    def stats(self):
+        with self._lock:
+            views = {}
+            for view, (hits, misses, invalidations) in self._counts.items():
+                lookups = hits + misses
+                views[view] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "invalidations": invalidations,
+                    "hit_rate": hits / lookups if lookups else 0.0,
+                }
+            return {"entries": len(self._entries), "views": views}
+
+    def warm_up(self):
+        """Load the running-buggy list and every driver's assigned buggy in one query."""
+        with self._lock:
+            generation = self._generation
+        buggies = list(Buggy.objects.filter(Q(assigned_driver__isnull=False) | Q(is_running=True)))
+        if generation != self._generation:
+            # Raced an invalidation; keys load one by one instead
+            return 0
+        self.set(AVAILABLE_BUGGIES_KEY, serialize_buggies(buggy for buggy in buggies if buggy.is_running))
+        for buggy in buggies:
+            if buggy.assigned_driver_id is not None:
+                self.set(assigned_buggy_key(buggy.assigned_driver_id), serialize_buggy(buggy))
+        return len(buggies)
+
+    def _warm_up_once(self):
+        with self._lock:
+            if not self.needs_warm_up:
+                return False
+            self.needs_warm_up = False
+        try:
+            count = self.warm_up()
+        except DatabaseError:
+            # E.g. migrations not applied yet; keys load one by one instead
+            logger.warning("Skipped read cache warm-up", exc_info=True)
+            return False
+        logger.info("Read cache warmed up with %d buggies", count)
+        return True
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.local_ttl, value)
+
+    def _count(self, key, index):
+        # Called with the lock held
+        counts = self._counts.setdefault(key_view(key), [0, 0, 0])
+        counts[index] += 1
+
+
+# Plain lists and dicts, so entries pickle cheaply into a shared cache
+
+def serialize_buggies(buggies):
+    return [dict(item) for item in BuggySerializer(list(buggies), many=True).data]
+
+
+def serialize_buggy(buggy):
+    return dict(BuggySerializer(buggy).data)
+
+
+def available_buggies():
+    return serialize_buggies(Buggy.objects.filter(is_running=True))
+
+
+def assigned_buggy(driver_id):
+    buggy = Buggy.objects.filter(assigned_driver_id=driver_id).first()
+    return serialize_buggy(buggy) if buggy is not None else None
+
+
+_cache = None
+
+
+def get_read_cache():
+    global _cache
+    if _cache is None:
+        _cache = ReadModelCache.from_settings()
+    return _cache
@@ -0,0 +1,37 @@
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+
+from .fastjson import dumps_bytes
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    ``JSONRenderer`` that encodes with ``TRACKING_JSON['ENCODER']``. Indented
+    output (the browsable API, ``; indent=`` requests) still goes through DRF.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps_bytes(data)
+
+
+class PolylineRenderer(FastJSONRenderer):
+    """Selected with ``?format=polyline``; the view encodes the trail itself."""
+    format = 'polyline'
+
+
+class ColumnarRenderer(FastJSONRenderer):
+    """Selected with ``?format=columnar``; the view encodes the trail itself."""
+    format = 'columnar'
+
+
+TRAIL_RENDERERS = [PolylineRenderer, ColumnarRenderer]
+
+# The configured renderers with plain JSON swapped for FastJSONRenderer
+TRACKING_RENDERERS = [FastJSONRenderer] + [
+    renderer for renderer in api_settings.DEFAULT_RENDERER_CLASSES
+    if not issubclass(renderer, JSONRenderer)
+]
@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Buggy, BuggyLocation, Location
+from .models import Buggy, BuggyLocation, Location, Stop, Trip
 
 class BuggyLocationSerializer(serializers.ModelSerializer):
     driver_name = serializers.SerializerMethodField()
@@ -23,4 +23,22 @@ class LocationHistorySerializer(serializers.ModelSerializer):
 class BuggySerializer(serializers.ModelSerializer):
     class Meta:
         model = Buggy
-        fields = ['id', 'number_plate', 'capacity', 'is_running']
\ No newline at end of file
+        fields = ['id', 'number_plate', 'capacity', 'is_running']
+
+class TripSerializer(serializers.ModelSerializer):
+    driver_name = serializers.CharField(source='driver.username', default=None)
+    bbox = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Trip
+        fields = ['id', 'buggy', 'driver_name', 'started_at', 'ended_at', 'is_open',
+                  'point_count', 'distance', 'bbox']
+
+    def get_bbox(self, obj):
+        # [min_latitude, min_longitude, max_latitude, max_longitude]
+        return [obj.min_latitude, obj.min_longitude, obj.max_latitude, obj.max_longitude]
+
+class StopSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Stop
+        fields = ['id', 'name', 'latitude', 'longitude']
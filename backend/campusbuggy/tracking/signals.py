@@ -0,0 +1,100 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .eta import get_eta_engine, publish_etas
+from .ingest import get_ingest_buffer
+from .live import get_live_store
+from .models import Buggy, Route, RouteSegment, Stop
+from .nearby import get_nearby_index
+from .readcache import AVAILABLE_BUGGIES_KEY, assigned_buggy_key, get_read_cache
+from .snapping import get_route_index
+from .trails import get_trail_store
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_init, sender=Buggy)
+def remember_assigned_driver(sender, instance, **kwargs):
+    # Reassigning a buggy changes the cached assignment of the previous driver too
+    instance._loaded_driver_id = instance.assigned_driver_id
+    instance._loaded_is_running = instance.is_running
+
+
+@receiver(post_save, sender=Buggy)
+@receiver(post_delete, sender=Buggy)
+def invalidate_read_cache(sender, instance, **kwargs):
+    drivers = {instance.assigned_driver_id, instance._loaded_driver_id} - {None}
+    keys = [AVAILABLE_BUGGIES_KEY, *(assigned_buggy_key(driver_id) for driver_id in drivers)]
+    instance._loaded_driver_id = instance.assigned_driver_id
+    # Only once committed: a read inside the transaction would cache the old rows
+    transaction.on_commit(lambda: get_read_cache().invalidate(*keys))
+
+
+@receiver(post_save, sender=Buggy)
+@receiver(post_delete, sender=Buggy)
+def bump_fleet_version(sender, instance, **kwargs):
+    # Any change to a buggy (UpdateBuggyStatusView, admin) invalidates fleet ETags.
+    # Runs on commit, after the read cache is cleared, so a poll can't render
+    # uncommitted rows under the new ETag.
+    transaction.on_commit(lambda: get_live_store().bump('fleet'))
+
+
+@receiver(post_save, sender=Buggy)
+def handle_status_change(sender, instance, created, **kwargs):
+    # Only act when is_running actually flips; saves that leave it alone
+    # (and new buggies) have nothing to close or withdraw
+    if created or instance.is_running == instance._loaded_is_running:
+        return
+    instance._loaded_is_running = instance.is_running
+
+    # Starting or stopping a buggy ends its current trip. The ingest buffer
+    # closes it on its next flush, after writing the pings that belong to it.
+    buggy_id, changed_at = instance.id, timezone.now()
+    transaction.on_commit(lambda: get_ingest_buffer().close_trip(buggy_id, changed_at))
+    if not instance.is_running:
+        # Stopped buggies disappear from the live view, whoever stopped them
+        transaction.on_commit(lambda: drop_from_live_view(buggy_id))
+
+
+@receiver(post_delete, sender=Buggy)
+def drop_deleted_buggy(sender, instance, **kwargs):
+    buggy_id = instance.id
+    transaction.on_commit(lambda: drop_from_live_view(buggy_id))
+
+
+def drop_from_live_view(buggy_id):
+    """
+    Remove a buggy from the live stores and withdraw its ETAs. The stores and
+    the channel layer may be on Redis, so a failing step is logged and the
+    rest still run.
+    """
+    for name, drop in (
+        ("live store", lambda: get_live_store().delete([buggy_id])),
+        ("nearby index", lambda: get_nearby_index().remove([buggy_id])),
+        ("trail store", lambda: get_trail_store().delete([buggy_id])),
+        ("ETA engine", lambda: get_eta_engine().remove([buggy_id])),
+        ("ETA stream", lambda: async_to_sync(publish_etas)(buggy_id, [])),
+    ):
+        try:
+            drop()
+        except Exception:
+            logger.exception("Failed to remove buggy %s from the %s", buggy_id, name)
+
+
+@receiver(post_save, sender=Stop)
+@receiver(post_delete, sender=Stop)
+def reload_stops(sender, instance, **kwargs):
+    get_eta_engine().invalidate_stops()
+
+
+@receiver(post_save, sender=Route)
+@receiver(post_delete, sender=Route)
+@receiver(post_save, sender=RouteSegment)
+@receiver(post_delete, sender=RouteSegment)
+def reload_routes(sender, instance, **kwargs):
+    get_route_index().invalidate()
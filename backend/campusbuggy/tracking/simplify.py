@@ -0,0 +1,137 @@
+"""
+Streaming trajectory simplification for location history.
+
+Instead of storing one ``Location`` per five minutes, the ingest buffer feeds
+every ping through a ``TrajectorySimplifier`` that keeps a little state per
+buggy in memory and decides, without reading the database, which fixes are
+significant enough to store. It is an opening-window simplifier in the
+spirit of online Douglas-Peucker:
+
+* the last stored fix is the *anchor*; later fixes collect in a window;
+* when a new fix makes any windowed fix deviate more than ``MAX_DEVIATION``
+  metres from the straight line anchor -> new fix, or the heading turns by
+  more than ``MAX_HEADING_CHANGE`` degrees, the previous fix was a corner and
+  is stored as the new anchor;
+* fixes within ``MIN_DISTANCE`` metres of the anchor are treated as jitter;
+* a fix is always stored once ``MAX_GAP`` seconds have passed since the
+  anchor, so parked buggies still leave a trace.
+"""
+import math
+from datetime import timedelta
+
+from django.conf import settings
+
+from .geo import angle_between, bearing, point_segment_distance, to_xy
+
+DEFAULTS = {
+    "MIN_DISTANCE": 15.0,
+    "MAX_DEVIATION": 12.0,
+    "MAX_HEADING_CHANGE": 45.0,
+    "MAX_GAP": 300,
+    "MAX_WINDOW": 60,
+}
+
+
+class _Track:
+    __slots__ = ("anchor", "window", "last")
+
+    def __init__(self, anchor):
+        self.anchor = anchor
+        # (ping, x, y) with x/y in metres relative to the anchor
+        self.window = []
+        self.last = anchor
+
+
+class TrajectorySimplifier:
+    def __init__(self, min_distance=15.0, max_deviation=12.0, max_heading_change=45.0,
+                 max_gap=300, max_window=60):
+        self.min_distance = min_distance
+        self.max_deviation = max_deviation
+        self.max_heading_change = max_heading_change
+        self.max_gap = timedelta(seconds=max_gap)
+        self.max_window = max_window
+        self._tracks = {}
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, "TRACKING_HISTORY", {})}
+        return cls(
+            min_distance=config["MIN_DISTANCE"],
+            max_deviation=config["MAX_DEVIATION"],
+            max_heading_change=config["MAX_HEADING_CHANGE"],
+            max_gap=config["MAX_GAP"],
+            max_window=config["MAX_WINDOW"],
+        )
+
+    def feed(self, ping):
+        """Return the fixes (zero, one or two) that should be stored after ``ping``."""
+        track = self._tracks.get(ping.buggy_id)
+        if track is None:
+            self._tracks[ping.buggy_id] = _Track(ping)
+            return [ping]
+
+        anchor = track.anchor
+        previous = track.last
+        track.last = ping
+
+        if ping.timestamp - anchor.timestamp >= self.max_gap:
+            stored = []
+            # Keep the end of the run before a long silence as well
+            if previous is not anchor and ping.timestamp - previous.timestamp >= self.max_gap:
+                stored.append(previous)
+            stored.append(ping)
+            self._reset(track, ping)
+            return stored
+
+        x, y = to_xy(ping.latitude, ping.longitude, anchor.latitude, anchor.longitude)
+        if math.hypot(x, y) < self.min_distance:
+            return []
+
+        if track.window and self._is_corner(track.window, x, y):
+            corner = track.window[-1][0]
+            self._reset(track, corner)
+            track.last = ping
+            track.window.append(
+                (ping, *to_xy(ping.latitude, ping.longitude, corner.latitude, corner.longitude))
+            )
+            return [corner]
+
+        track.window.append((ping, x, y))
+        if len(track.window) >= self.max_window:
+            self._reset(track, ping)
+            return [ping]
+        return []
+
+    def is_behind(self, ping):
+        """Whether ``ping`` is no newer than the last fix seen for its buggy."""
+        track = self._tracks.get(ping.buggy_id)
+        return track is not None and ping.timestamp <= track.last.timestamp
+
+    def finish(self, buggy_id):
+        """Forget a buggy's track, returning its last fix if it was never stored."""
+        track = self._tracks.pop(buggy_id, None)
+        if track is None or track.last is track.anchor:
+            return []
+        return [track.last]
+
+    def buggies_of_driver(self, driver_id):
+        return [
+            buggy_id for buggy_id, track in self._tracks.items()
+            if track.last.driver_id == driver_id
+        ]
+
+    def _reset(self, track, anchor):
+        track.anchor = anchor
+        track.window = []
+
+    def _is_corner(self, window, x, y):
+        for _, wx, wy in window:
+            if point_segment_distance(wx, wy, 0.0, 0.0, x, y) > self.max_deviation:
+                return True
+
+        _, px, py = window[-1]
+        if math.hypot(px, py) >= self.min_distance and math.hypot(x - px, y - py) >= self.min_distance:
+            turn = angle_between(bearing(0.0, 0.0, px, py), bearing(px, py, x, y))
+            if turn > self.max_heading_change:
+                return True
+        return False
@@ -0,0 +1,218 @@
+"""
+Snapping driver fixes to campus roads.
+
+Phone GPS wanders several metres off the road, and every wobble used to be
+stored and broadcast. ``RouteIndex`` holds the segments of every active
+``Route`` projected to metres around a campus origin, bucketed in a uniform
+grid of ``CELL_SIZE`` metre cells. Each segment is listed in every cell
+within ``MAX_DISTANCE`` of it, so snapping a fix only checks the segments
+of the one cell it falls in, with a single vectorized projection.
+
+A fix is moved to the closest point on the closest segment, with segments
+at an angle to the driver's reported direction counting up to
+``HEADING_WEIGHT`` metres further away so a buggy isn't pulled onto a cross
+street at junctions. Fixes further than ``MAX_DISTANCE`` from every road
+are kept as they are. The distance along the route comes for free and is
+part of the live entry.
+
+``LocationConsumer`` snaps every accepted fix before it reaches the live
+store, the ingest buffer and the broadcaster. Routes are reloaded when they
+are edited here, and at least every ``REFRESH_INTERVAL`` seconds for edits
+made elsewhere. ``manage.py bench_snapping`` measures the cost.
+"""
+import math
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from django.conf import settings
+
+from .executor import get_db_executor
+from .geo import from_xy, to_xy
+from .metrics import SNAPPED_PINGS
+
+DEFAULTS = {
+    "ENABLED": True,
+    "MAX_DISTANCE": 25.0,       # metres
+    "CELL_SIZE": 50.0,          # metres
+    "HEADING_WEIGHT": 10.0,     # metres added for a segment across the direction
+    "REFRESH_INTERVAL": 60.0,   # seconds
+}
+
+# Rows of the per-cell candidate arrays
+_AX, _AY, _DX, _DY, _INV_LENGTH2, _ANGLE, _INDEX = range(7)
+
+
+def routes_setting(name):
+    return getattr(settings, "TRACKING_ROUTES", {}).get(name, DEFAULTS[name])
+
+
+@dataclass(slots=True)
+class Snap:
+    latitude: float
+    longitude: float
+    route_id: int
+    # Metres from the start of the route
+    route_distance: float
+    # Metres the fix was moved
+    moved: float
+
+
+class RouteIndex:
+    def __init__(self, max_distance=25.0, cell_size=50.0, heading_weight=10.0, refresh_interval=60.0):
+        self.max_distance = max_distance
+        self.cell_size = cell_size
+        self.heading_weight = heading_weight
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        self.origin = None
+        self.segment_count = 0
+        self._cells = {}
+        self._route_ids = np.empty(0, dtype=np.int64)
+        self._offsets = np.empty(0, dtype=np.float64)
+        self._lengths = np.empty(0, dtype=np.float64)
+        self.loaded_at = None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_distance=routes_setting("MAX_DISTANCE"),
+            cell_size=routes_setting("CELL_SIZE"),
+            heading_weight=routes_setting("HEADING_WEIGHT"),
+            refresh_interval=routes_setting("REFRESH_INTERVAL"),
+        )
+
+    @property
+    def needs_load(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.refresh_interval
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def load(self):
+        from .models import RouteSegment
+
+        self.build(RouteSegment.objects.filter(route__is_active=True).order_by(
+            'route_id', 'sequence'
+        ).values_list(
+            'route_id', 'start_latitude', 'start_longitude', 'end_latitude', 'end_longitude'
+        ))
+
+    def build(self, segments):
+        """
+        Replace the index with ``(route_id, start_latitude, start_longitude,
+        end_latitude, end_longitude)`` segments, each route's in driving order.
+        """
+        segments = list(segments)
+        origin = (segments[0][1], segments[0][2]) if segments else None
+
+        count = len(segments)
+        columns = np.empty((7, count), dtype=np.float64)
+        route_ids = np.empty(count, dtype=np.int64)
+        lengths = np.empty(count, dtype=np.float64)
+        offsets = np.empty(count, dtype=np.float64)
+        cells = {}
+
+        previous_route, offset = None, 0.0
+        for index, (route_id, lat1, lon1, lat2, lon2) in enumerate(segments):
+            ax, ay = to_xy(lat1, lon1, *origin)
+            bx, by = to_xy(lat2, lon2, *origin)
+            dx, dy = bx - ax, by - ay
+            length = math.hypot(dx, dy)
+            if route_id != previous_route:
+                previous_route, offset = route_id, 0.0
+
+            columns[:, index] = (
+                ax, ay, dx, dy, 1 / max(length * length, 1e-9), math.atan2(dx, dy), index,
+            )
+            route_ids[index], lengths[index], offsets[index] = route_id, length, offset
+            offset += length
+
+            # Every cell within max_distance of the segment's bounding box
+            reach = self.max_distance
+            for cx in range(self._cell(min(ax, bx) - reach), self._cell(max(ax, bx) + reach) + 1):
+                for cy in range(self._cell(min(ay, by) - reach), self._cell(max(ay, by) + reach) + 1):
+                    cells.setdefault((cx, cy), []).append(index)
+
+        with self._lock:
+            self.origin = origin
+            self.segment_count = count
+            self._cells = {cell: columns[:, indexes] for cell, indexes in cells.items()}
+            self._route_ids, self._lengths, self._offsets = route_ids, lengths, offsets
+            self.loaded_at = time.monotonic()
+
+    def _cell(self, value):
+        return math.floor(value / self.cell_size)
+
+    def snap(self, latitude, longitude, direction=None):
+        """The closest point on a road within ``MAX_DISTANCE``, or None."""
+        with self._lock:
+            if self.origin is None:
+                return None
+            x, y = to_xy(latitude, longitude, *self.origin)
+            candidates = self._cells.get((self._cell(x), self._cell(y)))
+            if candidates is None:
+                return None
+
+            ax, ay, dx, dy = candidates[_AX], candidates[_AY], candidates[_DX], candidates[_DY]
+            t = np.clip(((x - ax) * dx + (y - ay) * dy) * candidates[_INV_LENGTH2], 0.0, 1.0)
+            px, py = ax + t * dx, ay + t * dy
+            distances = np.hypot(x - px, y - py)
+
+            scores = np.where(distances <= self.max_distance, distances, np.inf)
+            if direction is not None and self.heading_weight:
+                # Roads are driven both ways: only the angle to the road counts
+                scores += self.heading_weight * np.abs(
+                    np.sin(candidates[_ANGLE] - math.radians(direction))
+                )
+            best = int(np.argmin(scores))
+            if distances[best] > self.max_distance:
+                return None
+
+            index = int(candidates[_INDEX, best])
+            snapped_lat, snapped_lon = from_xy(float(px[best]), float(py[best]), *self.origin)
+            return Snap(
+                latitude=snapped_lat,
+                longitude=snapped_lon,
+                route_id=int(self._route_ids[index]),
+                route_distance=float(self._offsets[index] + t[best] * self._lengths[index]),
+                moved=float(distances[best]),
+            )
+
+
+async def asnap_pings(pings):
+    """
+    Snap ``pings`` to the roads in place, loading routes first if needed.
+    Returns each ping's ``Snap``, None where it was left as it was.
+    """
+    if not routes_setting("ENABLED"):
+        return [None] * len(pings)
+    index = get_route_index()
+    if index.needs_load:
+        await get_db_executor().run(index.load, helper="load_routes")
+    if not index.segment_count:
+        return [None] * len(pings)
+
+    snaps = []
+    for ping in pings:
+        snap = index.snap(ping.latitude, ping.longitude, ping.direction)
+        if snap is not None:
+            ping.latitude, ping.longitude = snap.latitude, snap.longitude
+        snaps.append(snap)
+
+    snapped = sum(snap is not None for snap in snaps)
+    SNAPPED_PINGS.inc(snapped, result='snapped')
+    SNAPPED_PINGS.inc(len(snaps) - snapped, result='off_route')
+    return snaps
+
+
+_index = None
+
+
+def get_route_index():
+    global _index
+    if _index is None:
+        _index = RouteIndex.from_settings()
+    return _index
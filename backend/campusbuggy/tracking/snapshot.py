@@ -0,0 +1,81 @@
+"""
+Fleet snapshot frames sent to students when they connect or subscribe.
+
+A new client would otherwise see nothing until each buggy pings again. The
+snapshot of the whole fleet is encoded once and reused by every connect until
+the live store changes, and then rebuilt at most every ``SNAPSHOT_MAX_AGE``
+seconds (later changes reach the client as ordinary updates anyway). Building
+it reads only the live store, never SQL, apart from the one-off warm-up of a
+local store. Each wire format's frame is encoded on first use after a build.
+"""
+import time
+
+from asgiref.sync import sync_to_async
+
+from .live import get_live_store, live_store_settings
+from .wire import JSON_CODEC
+
+SNAPSHOT_MAX_AGE = 1.0
+
+
+def snapshot_frame(entries, codec=JSON_CODEC):
+    return codec.encode({"type": "snapshot", "buggies": entries})
+
+
+class FleetSnapshot:
+    def __init__(self, max_age=SNAPSHOT_MAX_AGE):
+        self.max_age = max_age
+        self._entries = None
+        self._frames = {}
+        self._version = None
+        self._built_at = 0.0
+        self.builds = 0
+        self.served = 0
+
+    def is_fresh(self, store):
+        if self._entries is None:
+            return False
+        if time.monotonic() - self._built_at < self.max_age:
+            return True
+        # Local stores tell us whether anything changed since the last build
+        return store.version is not None and store.version == self._version
+
+    async def aframe(self, codec=JSON_CODEC):
+        """The encoded snapshot of every running buggy."""
+        store = get_live_store()
+        if not self.is_fresh(store):
+            if store.needs_warm_up:
+                await sync_to_async(store.warm_up)()
+            version = store.version
+            self._entries = await store.aall()
+            self._frames = {}
+            self._version = version
+            self._built_at = time.monotonic()
+            self.builds += 1
+        self.served += 1
+
+        frame = self._frames.get(codec.name)
+        if frame is None:
+            frame = self._frames[codec.name] = snapshot_frame(self._entries, codec)
+        return frame
+
+    async def aframe_for(self, buggy_ids, codec=JSON_CODEC):
+        """A snapshot of just ``buggy_ids``, for per-buggy subscriptions."""
+        store = get_live_store()
+        if store.needs_warm_up:
+            await sync_to_async(store.warm_up)()
+        entries = await store.aget_many(sorted(buggy_ids))
+        return snapshot_frame([entry for entry in entries if entry is not None], codec)
+
+    def stats(self):
+        return {"builds": self.builds, "served": self.served}
+
+
+_snapshot = None
+
+
+def get_fleet_snapshot():
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = FleetSnapshot(live_store_settings().get("SNAPSHOT_MAX_AGE", SNAPSHOT_MAX_AGE))
+    return _snapshot
@@ -1,3 +1,1347 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import msgpack
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from campusbuggy.asgi import application
+from users.models import User
+
+from . import broadcast, eta, ingest, live, nearby, partitions, readcache, snapping, snapshot, trails
+from .broadcast import get_broadcaster
+from .conditional import rendered_cache
+from .encoding import columns_from_rows, decode_varints, encode_trail
+from .eta import EtaEngine
+from .heatmap import HeatmapAccumulator, HeatmapGrid, dwell_samples
+from .executor import MAX_WORKERS, DatabaseExecutor, default_max_workers
+from .history import history_page, history_rows
+from .ingest import IngestBuffer, Ping, is_valid_fix, parse_fixes
+from .live import LocalLiveStore, get_live_store, live_entry
+from .models import Buggy, BuggyLocation, HeatmapDay, Location, LocationRollup, Trip
+from .nearby import NearbyIndex, parse_nearby_query
+from .partitions import get_history_storage, month_start, rollup_before
+from .readcache import (
+    AVAILABLE_BUGGIES_KEY, ReadModelCache, assigned_buggy, assigned_buggy_key, available_buggies,
+    get_read_cache,
+)
+from .simplify import TrajectorySimplifier
+from .snapping import RouteIndex
+from .trails import LocalTrailStore, encode_trails, now_millis
+from .trips import segment_pings
+from .wire import MSGPACK_CODEC
+
+# The production layer needs Redis
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+NOW = datetime(2025, 1, 6, 9, 0, tzinfo=dt_timezone.utc)
+
+
+def reset_tracking_state():
+    """Drop the per-process singletons so each test starts from empty stores."""
+    for module, name in (
+        (broadcast, '_ticker'), (eta, '_engine'), (ingest, '_buffer'), (live, '_store'),
+        (nearby, '_index'), (partitions, '_storage'), (readcache, '_cache'), (snapping, '_index'), (snapshot, '_snapshot'),
+        (trails, '_store'),
+    ):
+        setattr(module, name, None)
+    rendered_cache._bodies.clear()
+
+
+def make_user(username, user_type, phone_number):
+    return User.objects.create_user(
+        username, password='secret', user_type=user_type, phone_number=phone_number,
+        first_name=username, last_name='User',
+    )
+
+
+def make_fleet(drivers=1, students=1):
+    """Running buggies with their drivers' tokens, and student tokens."""
+    driver_tokens, student_tokens, buggy_ids = [], [], []
+    for index in range(drivers):
+        driver = make_user(f'driver{index}', 'driver', f'10000000{index:02d}')
+        buggy = Buggy.objects.create(
+            number_plate=f'BUG{index}', capacity=6, assigned_driver=driver, is_running=True
+        )
+        driver_tokens.append(Token.objects.create(user=driver).key)
+        buggy_ids.append(buggy.id)
+    for index in range(students):
+        student = make_user(f'student{index}', 'student', f'20000000{index:02d}')
+        student_tokens.append(Token.objects.create(user=student).key)
+    return driver_tokens, student_tokens, buggy_ids
+
+
+def ping(buggy_id, driver_id, seconds, latitude=12.97, longitude=77.59):
+    return Ping(
+        buggy_id=buggy_id, driver_id=driver_id, latitude=latitude, longitude=longitude,
+        direction=None, timestamp=NOW + timedelta(seconds=seconds),
+    )
+
+
+# ------------------ Ingest ------------------
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class IngestBufferTests(TestCase):
+    def setUp(self):
+        reset_tracking_state()
+        _, _, self.buggy_ids = make_fleet(2, 0)
+        self.drivers = dict(Buggy.objects.values_list('id', 'assigned_driver_id'))
+        # Flushed by the tests, not by the flusher
+        self.buffer = IngestBuffer(flush_interval=3600, batch_size=10000)
+
+    def add(self, pings):
+        async def add_all():
+            for item in pings:
+                self.buffer.add(item)
+            self.buffer._task.cancel()
+            await asyncio.sleep(0)
+        async_to_sync(add_all)()
+
+    def test_flush_writes_history_and_checkpoint(self):
+        buggy_id = self.buggy_ids[0]
+        driver_id = self.drivers[buggy_id]
+        # More than MAX_GAP apart, so both are kept
+        self.add([ping(buggy_id, driver_id, 0), ping(buggy_id, driver_id, 400, latitude=12.98)])
+        self.assertEqual(self.buffer.stats()["pending_history"], 2)
+
+        self.buffer.flush()
+
+        self.assertEqual(
+            list(Location.objects.order_by('timestamp').values_list('latitude', flat=True)), [12.97, 12.98]
+        )
+        self.assertEqual(BuggyLocation.objects.get(buggy_id=buggy_id).latitude, 12.98)
+        self.assertEqual(self.buffer.stats()["queue_depth"], 0)
+
+    def test_pings_of_deleted_buggies_are_dropped(self):
+        kept, deleted = self.buggy_ids
+        self.add([ping(kept, self.drivers[kept], 0), ping(deleted, self.drivers[deleted], 0)])
+        Buggy.objects.filter(id=deleted).delete()
+
+        with self.assertLogs('tracking.ingest', 'WARNING'):
+            self.buffer.flush()
+
+        stats = self.buffer.stats()
+        self.assertEqual((stats["failed_flushes"], stats["dropped_pings"]), (0, 2))
+        self.assertEqual(list(Location.objects.values_list('buggy_id', flat=True)), [kept])
+        self.assertTrue(BuggyLocation.objects.filter(buggy_id=kept).exists())
+
+    def test_status_change_splits_buffered_pings_between_trips(self):
+        buggy_id = self.buggy_ids[0]
+        driver_id = self.drivers[buggy_id]
+        self.add([ping(buggy_id, driver_id, seconds) for seconds in (0, 400, 800, 1200)])
+
+        # No flusher running, so this flushes right away
+        self.buffer.close_trip(buggy_id, NOW + timedelta(seconds=600))
+
+        trips = list(Trip.objects.order_by('started_at').values_list('started_at', 'ended_at', 'is_open'))
+        self.assertEqual(trips, [
+            (NOW, NOW + timedelta(seconds=400), False),
+            (NOW + timedelta(seconds=800), NOW + timedelta(seconds=1200), True),
+        ])
+
+
+class ParseFixesTests(SimpleTestCase):
+    def test_is_valid_fix(self):
+        self.assertTrue(is_valid_fix(12.97, 77.59))
+        self.assertTrue(is_valid_fix(-90, 180, 45.5))
+        self.assertFalse(is_valid_fix(91, 77.59))
+        self.assertFalse(is_valid_fix(12.97, -181))
+        self.assertFalse(is_valid_fix("12.97", 77.59))
+        self.assertFalse(is_valid_fix(True, 77.59))
+        self.assertFalse(is_valid_fix(float('nan'), 77.59))
+        self.assertFalse(is_valid_fix(12.97, 77.59, "north"))
+
+    def test_valid_fixes_sorted_and_deduplicated(self):
+        fixes = [
+            {"latitude": 12.98, "longitude": 77.6, "timestamp": (NOW - timedelta(seconds=5)).isoformat()},
+            {"latitude": 12.97, "longitude": 77.5, "direction": 90,
+             "timestamp": round((NOW - timedelta(seconds=10)).timestamp() * 1000)},
+            # Same timestamp as the first fix
+            {"latitude": 12.99, "longitude": 77.7, "timestamp": (NOW - timedelta(seconds=5)).isoformat()},
+        ]
+        pings, rejected = parse_fixes(1, 2, fixes, NOW)
+
+        self.assertEqual(rejected, 1)
+        self.assertEqual([p.timestamp for p in pings], [NOW - timedelta(seconds=10), NOW - timedelta(seconds=5)])
+        self.assertEqual((pings[0].buggy_id, pings[0].driver_id, pings[0].direction), (1, 2, 90))
+
+    def test_invalid_fixes_rejected(self):
+        fixes = [
+            "not a fix",
+            {"latitude": 200, "longitude": 77.6, "timestamp": NOW.isoformat()},
+            {"latitude": 12.97, "longitude": 77.6},
+            {"latitude": 12.97, "longitude": 77.6, "timestamp": "yesterday"},
+            {"latitude": 12.97, "longitude": 77.6, "direction": "north", "timestamp": NOW.isoformat()},
+            # Too far in the future
+            {"latitude": 12.97, "longitude": 77.6, "timestamp": (NOW + timedelta(hours=1)).isoformat()},
+        ]
+        self.assertEqual(parse_fixes(1, 2, fixes, NOW), ([], len(fixes)))
+
+
+# ------------------ Trips ------------------
+
+class SegmentPingsTests(SimpleTestCase):
+    max_gap = timedelta(minutes=10)
+
+    def test_splits_on_gaps_and_driver_changes(self):
+        pings = [
+            ping(1, 10, 0), ping(1, 10, 60, latitude=12.971),
+            # Gap longer than max_gap
+            ping(1, 10, 60 + 601), ping(1, 10, 60 + 660),
+            # Another driver takes over
+            ping(1, 11, 60 + 700),
+        ]
+        trips = segment_pings(None, 1, pings, self.max_gap)
+
+        self.assertEqual(len(trips), 3)
+        self.assertEqual([trip.driver_id for trip in trips], [10, 10, 11])
+        self.assertEqual([trip.is_open for trip in trips], [False, False, True])
+        self.assertEqual((trips[0].started_at, trips[0].ended_at), (pings[0].timestamp, pings[1].timestamp))
+        self.assertAlmostEqual(trips[0].distance, 111.2, delta=0.5)
+        self.assertEqual(trips[0].max_latitude, 12.971)
+
+    def test_continues_open_trip(self):
+        open_trip = segment_pings(None, 1, [ping(1, 10, 0)], self.max_gap)[0]
+        trips = segment_pings(open_trip, 1, [ping(1, 10, 30), ping(1, 10, 90)], self.max_gap)
+
+        self.assertEqual(trips, [open_trip])
+        self.assertTrue(open_trip.is_open)
+        self.assertEqual(open_trip.ended_at, NOW + timedelta(seconds=90))
+
+    def test_closes_stale_open_trip(self):
+        open_trip = segment_pings(None, 1, [ping(1, 10, 0)], self.max_gap)[0]
+        trips = segment_pings(open_trip, 1, [ping(1, 10, 3600)], self.max_gap)
+
+        self.assertIs(trips[0], open_trip)
+        self.assertFalse(open_trip.is_open)
+        self.assertEqual(trips[1].started_at, NOW + timedelta(seconds=3600))
+
+    def test_no_pings(self):
+        self.assertEqual(segment_pings(None, 1, [], self.max_gap), [])
+
+
+# ------------------ History simplification ------------------
+
+class TrajectorySimplifierTests(SimpleTestCase):
+    def setUp(self):
+        self.simplifier = TrajectorySimplifier(
+            min_distance=15.0, max_deviation=12.0, max_heading_change=45.0, max_gap=300, max_window=60
+        )
+
+    def feed(self, pings):
+        return [stored for item in pings for stored in self.simplifier.feed(item)]
+
+    def test_straight_runs_keep_only_their_corners(self):
+        # North in ~22 m steps, then east
+        north = [ping(1, 10, index, latitude=12.97 + index * 2e-4) for index in range(5)]
+        east = [ping(1, 10, 5 + index, latitude=12.9708, longitude=77.59 + (index + 1) * 2e-4) for index in range(3)]
+
+        self.assertEqual(self.feed(north), [north[0]])
+        self.assertEqual(self.feed(east), [north[-1]])
+        # The track ends with its last, unsaved fix
+        self.assertEqual(self.simplifier.finish(1), [east[-1]])
+        self.assertEqual(self.simplifier.finish(1), [])
+
+    def test_jitter_is_dropped(self):
+        pings = [ping(1, 10, index, latitude=12.97 + (index % 2) * 5e-5) for index in range(10)]
+        self.assertEqual(self.feed(pings), [pings[0]])
+
+    def test_parked_buggies_leave_a_fix_every_max_gap(self):
+        pings = [ping(1, 10, seconds) for seconds in (0, 100, 200, 300, 400)]
+        self.assertEqual(self.feed(pings), [pings[0], pings[3]])
+
+    def test_tracks_are_per_buggy(self):
+        first, second = ping(1, 10, 0), ping(2, 11, 0)
+        self.assertEqual(self.feed([first, second]), [first, second])
+        self.assertEqual(self.simplifier.buggies_of_driver(11), [2])
+        self.assertTrue(self.simplifier.is_behind(ping(1, 10, 0)))
+        self.assertFalse(self.simplifier.is_behind(ping(1, 10, 1)))
+
+
+# ------------------ Live store ------------------
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class LiveStoreTests(TestCase):
+    def setUp(self):
+        reset_tracking_state()
+        _, (self.token,), self.buggy_ids = make_fleet(2, 1)
+
+    def entry(self, buggy_id, latitude=12.97):
+        return live_entry(buggy_id, f'BUG{buggy_id}', latitude, 77.59, None, 'driver', NOW)
+
+    def test_local_store(self):
+        store = LocalLiveStore()
+        store.set(1, self.entry(1))
+        store.set(2, self.entry(2))
+        store.set(1, self.entry(1, latitude=12.98))
+
+        self.assertEqual([entry["latitude"] if entry else None for entry in store.get_many([1, 3, 2])],
+                         [12.98, None, 12.97])
+        self.assertEqual(store.version, 3)
+        store.delete([2, 3])
+        self.assertEqual([entry["buggy_id"] for entry in store.all()], [1])
+        self.assertEqual(store.version, 4)
+
+    def test_warm_up_from_running_checkpoints(self):
+        running, stopped = self.buggy_ids
+        BuggyLocation.objects.create(buggy_id=running, latitude=12.97, longitude=77.59)
+        BuggyLocation.objects.create(buggy_id=stopped, latitude=12.98, longitude=77.6)
+        Buggy.objects.filter(id=stopped).update(is_running=False)
+
+        store = LocalLiveStore()
+        store.warm_up()
+        # Newer live positions aren't overwritten by a late warm-up
+        store.set_default(running, self.entry(running, latitude=0))
+
+        (entry,) = store.all()
+        self.assertEqual((entry["buggy_id"], entry["latitude"], entry["driver_name"]), (running, 12.97, 'driver0'))
+        self.assertFalse(store.needs_warm_up)
+
+    def test_live_location_view(self):
+        buggy_id = self.buggy_ids[0]
+        get_live_store().set(buggy_id, self.entry(buggy_id))
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        response = client.get('/api/tracking/live-location/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry["buggy_id"] for entry in response.json()], [buggy_id])
+
+
+
+# ------------------ ETAs ------------------
+
+class EtaEngineTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = EtaEngine(default_speed=5.0, route_factor=1.0, turn_penalty=0.0, push_interval=5.0)
+        # About 1.1 km and 2.2 km north of the buggy
+        self.engine.set_stops([(1, 'Library', 12.98, 77.59), (2, 'Hostel', 12.99, 77.59)])
+        self.millis = round(NOW.timestamp() * 1000)
+
+    def test_etas_from_distance_and_speed(self):
+        pushed = self.engine.update(7, 12.97, 77.59, self.millis)
+
+        self.assertEqual([row["stop_id"] for row in pushed], [1, 2])
+        self.assertAlmostEqual(pushed[0]["distance"], 1112, delta=2)
+        self.assertAlmostEqual(pushed[0]["eta"], 1112 / 5.0, delta=1)
+
+        library, hostel = self.engine.stop_etas(now_millis=self.millis)
+        self.assertEqual(library["name"], 'Library')
+        self.assertEqual(library["etas"][0]["buggy_id"], 7)
+        self.assertAlmostEqual(hostel["etas"][0]["eta"], 2224 / 5.0, delta=1)
+
+    def test_etas_count_down_and_arrive(self):
+        self.engine.update(7, 12.97, 77.59, self.millis)
+        later = self.engine.stop_etas([1], now_millis=self.millis + 100_000)
+        self.assertAlmostEqual(later[0]["etas"][0]["eta"], 1112 / 5.0 - 100, delta=1)
+
+        # Within the arrival radius
+        self.engine.update(7, 12.9799, 77.59, self.millis + 200_000)
+        self.assertEqual(self.engine.stop_etas([1], now_millis=self.millis + 200_000)[0]["etas"][0]["eta"], 0)
+
+    def test_pushes_are_rate_limited(self):
+        self.assertIsNotNone(self.engine.update(7, 12.97, 77.59, self.millis))
+        self.assertIsNone(self.engine.update(7, 12.9701, 77.59, self.millis + 1000))
+        # Out-of-order pings are ignored
+        self.assertIsNone(self.engine.update(7, 12.9702, 77.59, self.millis))
+        self.assertIsNotNone(self.engine.update(7, 12.9703, 77.59, self.millis + 6000))
+
+    def test_far_buggies_are_left_out(self):
+        self.engine.update(7, 13.5, 77.59, self.millis)
+        self.assertEqual(self.engine.stop_etas(now_millis=self.millis)[0]["etas"], [])
+
+    def test_removed_buggies_are_left_out(self):
+        self.engine.update(7, 12.97, 77.59, self.millis)
+        self.engine.remove([7])
+        self.assertEqual(self.engine.stop_etas(now_millis=self.millis)[0]["etas"], [])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class BuggySignalTests(TestCase):
+    def setUp(self):
+        reset_tracking_state()
+        _, _, (self.buggy_id,) = make_fleet(1, 0)
+        get_live_store().set(self.buggy_id, live_entry(self.buggy_id, 'BUG0', 12.97, 77.59, None, 'driver0', NOW))
+
+    def tracked(self):
+        return [entry["buggy_id"] for entry in get_live_store().all()]
+
+    def test_stopping_drops_the_buggy_on_commit(self):
+        buggy = Buggy.objects.get(id=self.buggy_id)
+        with mock.patch('tracking.signals.publish_etas') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                buggy.is_running = False
+                buggy.save()
+                self.assertEqual(self.tracked(), [self.buggy_id])
+
+                # Saving it again while stopped has nothing left to withdraw
+                buggy.save()
+
+        self.assertEqual(self.tracked(), [])
+        publish.assert_called_once_with(self.buggy_id, [])
+
+    def test_saves_that_keep_the_status_do_nothing(self):
+        with mock.patch('tracking.signals.publish_etas') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                Buggy.objects.create(number_plate='NEW', capacity=6, is_running=False)
+                buggy = Buggy.objects.get(id=self.buggy_id)
+                buggy.capacity = 8
+                buggy.save()
+
+        publish.assert_not_called()
+        self.assertEqual(self.tracked(), [self.buggy_id])
+
+    def test_channel_layer_errors_are_logged(self):
+        with mock.patch('tracking.signals.publish_etas', side_effect=ConnectionError):
+            with self.assertLogs('tracking.signals', 'ERROR'):
+                with self.captureOnCommitCallbacks(execute=True):
+                    Buggy.objects.get(id=self.buggy_id).delete()
+
+        self.assertEqual(self.tracked(), [])
+
+
+# ------------------ Snapping ------------------
+
+class RouteIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = RouteIndex(max_distance=25.0)
+        self.index.build([
+            # Route 1 runs east along a road, route 2 north across it
+            (1, 12.97, 77.59, 12.97, 77.592),
+            (1, 12.97, 77.592, 12.97, 77.594),
+            (2, 12.969, 77.593, 12.971, 77.593),
+        ])
+
+    def test_snaps_onto_the_nearest_road(self):
+        snap = self.index.snap(12.97008, 77.5925)
+
+        self.assertEqual(snap.route_id, 1)
+        self.assertAlmostEqual(snap.latitude, 12.97, places=6)
+        self.assertAlmostEqual(snap.longitude, 77.5925, places=6)
+        self.assertAlmostEqual(snap.moved, 8.9, delta=0.5)
+        # Distance along the route, across both segments
+        self.assertAlmostEqual(snap.route_distance, 271, delta=2)
+
+    def test_heading_picks_the_road_at_a_crossing(self):
+        self.assertEqual(self.index.snap(12.97005, 77.59305, direction=90).route_id, 1)
+        self.assertEqual(self.index.snap(12.97005, 77.59305, direction=0).route_id, 2)
+
+    def test_off_road_fixes_are_left_alone(self):
+        self.assertIsNone(self.index.snap(12.9705, 77.5905))
+        self.assertIsNone(self.index.snap(13.5, 77.59))
+
+    def test_empty_index(self):
+        index = RouteIndex()
+        index.build([])
+        self.assertIsNone(index.snap(12.97, 77.59))
+
+
+# ------------------ Trails ------------------
+
+class LocalTrailStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.store = LocalTrailStore(max_points=3, min_interval=5.0, max_age=600)
+        self.start = now_millis() - 60_000
+
+    def positions(self, *seconds):
+        return [(12.97 + second * 1e-5, 77.59, self.start + second * 1000) for second in seconds]
+
+    def test_ring_keeps_the_newest_points_in_order(self):
+        self.store.extend(1, self.positions(0, 10, 20, 30, 40))
+
+        latitudes, _, millis = self.store.get()[1]
+        self.assertEqual((millis - self.start).tolist(), [20_000, 30_000, 40_000])
+        self.assertAlmostEqual(latitudes[-1], 12.9704)
+
+    def test_newest_point_is_replaced_within_min_interval(self):
+        self.store.extend(1, self.positions(0, 10, 12, 14))
+        # Older or repeated positions are dropped
+        self.store.append(1, 0.0, 0.0, self.start + 14_000)
+        self.store.append(1, 0.0, 0.0, self.start + 5_000)
+
+        _, _, millis = self.store.get([1])[1]
+        self.assertEqual((millis - self.start).tolist(), [0, 10_000, 14_000])
+
+    def test_old_points_and_since(self):
+        self.store.append(1, 12.97, 77.59, now_millis() - 700_000)
+        self.store.extend(2, self.positions(0, 30))
+
+        trails = self.store.get()
+        self.assertEqual(list(trails), [2])
+        _, _, millis = self.store.get(since_millis=self.start + 10_000)[2]
+        self.assertEqual((millis - self.start).tolist(), [30_000])
+
+    def test_delete(self):
+        self.store.extend(1, self.positions(0, 10))
+        self.store.delete([1])
+        self.assertEqual(self.store.get(), {})
+
+        # A deleted buggy starts a new trail with earlier positions too
+        self.store.extend(1, self.positions(5))
+        self.assertEqual(len(self.store.get()[1][2]), 1)
+
+    def test_encode_trails(self):
+        self.store.extend(1, self.positions(0, 10))
+
+        (trail,) = encode_trails(self.store.get())
+        self.assertEqual(trail["buggy_id"], 1)
+        self.assertEqual([point["latitude"] for point in trail["points"]], [12.97, 12.9701])
+        (encoded,) = encode_trails(self.store.get(), 'polyline')
+        self.assertEqual(encoded["format"], 'polyline')
+
+
+# ------------------ Heatmap ------------------
+
+class DwellSamplesTests(SimpleTestCase):
+    def test_intervals_are_resampled_with_their_duration(self):
+        latitudes, longitudes, seconds, weights = dwell_samples(
+            [1, 1, 1, 2], [12.97, 12.973, 12.98, 12.96], [77.59] * 4, [0, 30, 2000, 10], step=10, max_gap=600,
+        )
+        # Only 0-30 s: 30-2000 s is over max_gap, and buggy 2 has a single point
+        self.assertEqual(seconds.tolist(), [5, 15, 25])
+        self.assertEqual(weights.tolist(), [10, 10, 10])
+        np.testing.assert_allclose(latitudes, [12.9705, 12.9715, 12.9725])
+        self.assertEqual(longitudes.tolist(), [77.59] * 3)
+
+
+class HeatmapTests(TestCase):
+    def setUp(self):
+        reset_tracking_state()
+        _, _, (self.buggy_id,) = make_fleet(1, 0)
+        self.driver_id = Buggy.objects.get(id=self.buggy_id).assigned_driver_id
+        self.grid = HeatmapGrid.from_settings()
+
+    def pings(self, day, count=30):
+        start = timezone.make_aware(datetime.combine(day, time(10)))
+        return [
+            Ping(buggy_id=self.buggy_id, driver_id=self.driver_id, latitude=12.96 + index * 4e-4,
+                 longitude=77.59, direction=None, timestamp=start + timedelta(seconds=20 * index))
+            for index in range(count)
+        ]
+
+    def stored(self, day):
+        row = HeatmapDay.objects.get(date=day, grid=self.grid.key)
+        return row.total, self.grid.decode(bytes(row.counts))
+
+    def test_accumulator_counts_across_batches(self):
+        day = timezone.localdate() - timedelta(days=5)
+        pings = self.pings(day)
+        accumulator = HeatmapAccumulator(self.grid, flush_interval=3600)
+        accumulator.add(pings[:10])
+        accumulator.add(pings[10:])
+        # Late points from before the newest one are left out
+        accumulator.add(pings[:5])
+
+        accumulator.flush()
+        self.assertFalse(HeatmapDay.objects.exists())
+        accumulator.flush(force=True)
+        total, counts = self.stored(day)
+        self.assertEqual(total, 20 * 29)
+        self.assertEqual(counts[10].sum(), total)
+
+    def test_rebuild_matches_the_live_counts(self):
+        day = timezone.localdate() - timedelta(days=5)
+        pings = self.pings(day)
+        accumulator = HeatmapAccumulator(self.grid)
+        accumulator.add(pings)
+        accumulator.flush(force=True)
+        live_total, live_counts = self.stored(day)
+
+        Location.objects.bulk_create(
+            Location(buggy_id=item.buggy_id, driver_id=item.driver_id, latitude=item.latitude,
+                     longitude=item.longitude, timestamp=item.timestamp)
+            for item in pings
+        )
+        call_command('rebuild_heatmap', '--since', '7d', stdout=StringIO())
+
+        total, counts = self.stored(day)
+        self.assertEqual(total, live_total)
+        np.testing.assert_array_equal(counts, live_counts)
+
+    def test_rebuild_leaves_live_days_alone(self):
+        yesterday = timezone.localdate() - timedelta(days=1)
+        accumulator = HeatmapAccumulator(self.grid)
+        accumulator.add(self.pings(yesterday, count=10))
+        accumulator.flush(force=True)
+        # History that would rebuild yesterday with different counts
+        Location.objects.bulk_create(
+            Location(buggy_id=item.buggy_id, driver_id=item.driver_id, latitude=item.latitude,
+                     longitude=item.longitude, timestamp=item.timestamp)
+            for item in self.pings(yesterday, count=30)
+        )
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_heatmap', '--since', '1d', stdout=StringIO())
+        call_command('rebuild_heatmap', '--since', '7d', stdout=StringIO())
+        self.assertEqual(self.stored(yesterday)[0], 20 * 9)
+
+
+# ------------------ Encoders ------------------
+
+class TrailEncodingTests(SimpleTestCase):
+    def setUp(self):
+        self.latitudes = np.array([12.97, 12.97012, 12.96995, 12.971])
+        self.longitudes = np.array([77.59, 77.59003, 77.58991, 77.5902])
+        self.timestamps = [NOW + timedelta(milliseconds=ms) for ms in (0, 1500, 3000, 61000)]
+
+    def test_polyline_round_trip(self):
+        encoded = encode_trail('polyline', self.latitudes, self.longitudes, self.timestamps)
+
+        self.assertEqual((encoded["format"], encoded["precision"], encoded["count"]), ('polyline', 5, 4))
+        coordinates = np.cumsum(np.array(decode_varints(encoded["polyline"])).reshape(-1, 2), axis=0) / 1e5
+        np.testing.assert_allclose(coordinates[:, 0], self.latitudes, atol=1e-5)
+        np.testing.assert_allclose(coordinates[:, 1], self.longitudes, atol=1e-5)
+        self.assertEqual(np.cumsum(decode_varints(encoded["times"])).tolist(), [0, 1500, 3000, 61000])
+
+    def test_known_polyline(self):
+        # The example from Google's encoded polyline documentation
+        encoded = encode_trail(
+            'polyline', np.array([38.5, 40.7, 43.252]), np.array([-120.2, -120.95, -126.453]),
+            self.timestamps[:3],
+        )
+        self.assertEqual(encoded["polyline"], "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+
+    def test_columnar(self):
+        encoded = encode_trail('columnar', self.latitudes, self.longitudes, self.timestamps)
+
+        self.assertEqual((encoded["format"], encoded["precision"], encoded["count"]), ('columnar', 6, 4))
+        np.testing.assert_allclose(np.cumsum(encoded["latitude"]) / 1e6, self.latitudes)
+        np.testing.assert_allclose(np.cumsum(encoded["longitude"]) / 1e6, self.longitudes)
+        self.assertEqual(np.cumsum(encoded["time"]).tolist(), [0, 1500, 3000, 61000])
+
+    def test_empty_trail(self):
+        latitudes, longitudes, timestamps = columns_from_rows([])
+        encoded = encode_trail('polyline', latitudes, longitudes, timestamps)
+        self.assertEqual((encoded["count"], encoded["start"], encoded["polyline"]), (0, None, ""))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            encode_trail('geojson', self.latitudes, self.longitudes, self.timestamps)
+
+
+
+
+# ------------------ Conditional requests ------------------
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ConditionalRequestTests(TestCase):
+    def setUp(self):
+        reset_tracking_state()
+        _, (self.token,), (self.buggy_id,) = make_fleet()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def test_unchanged_fleet_is_not_modified(self):
+        response = self.client.get('/api/tracking/available-buggies/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([buggy["id"] for buggy in response.json()], [self.buggy_id])
+        etag = response["ETag"]
+
+        again = self.client.get('/api/tracking/available-buggies/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again["ETag"], etag)
+        self.assertEqual(again.content, b'')
+
+        # Any of several listed tags matches
+        listed = self.client.get('/api/tracking/available-buggies/', HTTP_IF_NONE_MATCH=f'"other", {etag}')
+        self.assertEqual(listed.status_code, 304)
+        self.assertEqual(
+            self.client.get('/api/tracking/available-buggies/', HTTP_IF_NONE_MATCH='"other"').status_code, 200
+        )
+
+    def test_fleet_change_changes_etag_on_commit(self):
+        etag = self.client.get('/api/tracking/available-buggies/')["ETag"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            buggy = Buggy.objects.get(id=self.buggy_id)
+            buggy.is_running = False
+            buggy.save()
+            # Polls before the commit keep the old version
+            self.assertEqual(get_live_store().etag('fleet'), etag)
+
+        response = self.client.get('/api/tracking/available-buggies/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json(), [])
+
+    def test_live_location_etag(self):
+        response = self.client.get('/api/tracking/live-location/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.client.get('/api/tracking/live-location/', HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304
+        )
+
+        get_live_store().set(self.buggy_id, live_entry(self.buggy_id, 'BUG0', 12.97, 77.59, None, 'driver0', NOW))
+        moved = self.client.get('/api/tracking/live-location/', HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(moved.status_code, 200)
+        self.assertEqual([entry["buggy_id"] for entry in moved.json()], [self.buggy_id])
+
+    def test_rendered_bodies_are_reused_per_version(self):
+        hits = rendered_cache.stats()["hits"]
+        first = self.client.get('/api/tracking/available-buggies/')
+        second = self.client.get('/api/tracking/available-buggies/')
+        self.assertEqual(rendered_cache.stats()["hits"], hits + 1)
+        self.assertEqual(second.content, first.content)
+
+
+
+# ------------------ Read model cache ------------------
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ReadModelCacheTests(TestCase):
+    def setUp(self):
+        reset_tracking_state()
+        (self.driver_token, _), _, self.buggy_ids = make_fleet(2, 0)
+        self.drivers = dict(Buggy.objects.values_list('id', 'assigned_driver_id'))
+
+    def test_first_miss_warms_up_every_key(self):
+        cache = get_read_cache()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                [buggy["id"] for buggy in cache.get_or_load(AVAILABLE_BUGGIES_KEY, available_buggies)],
+                self.buggy_ids,
+            )
+            for buggy_id, driver_id in self.drivers.items():
+                key = assigned_buggy_key(driver_id)
+                self.assertEqual(cache.get_or_load(key, lambda: assigned_buggy(driver_id))["id"], buggy_id)
+        self.assertFalse(cache.needs_warm_up)
+
+    def test_saves_invalidate_affected_keys_on_commit(self):
+        cache = get_read_cache()
+        cache.get_or_load(AVAILABLE_BUGGIES_KEY, available_buggies)
+        first, second = self.buggy_ids
+        old_driver = self.drivers[first]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            buggy = Buggy.objects.get(id=first)
+            buggy.is_running = False
+            buggy.assigned_driver = None
+            buggy.save()
+            # Reads inside the transaction still get the committed state
+            self.assertEqual(len(cache.get_or_load(AVAILABLE_BUGGIES_KEY, available_buggies)), 2)
+
+        self.assertEqual(
+            [buggy["id"] for buggy in cache.get_or_load(AVAILABLE_BUGGIES_KEY, available_buggies)], [second]
+        )
+        # The previous driver's assignment is dropped too
+        self.assertIsNone(cache.get_or_load(assigned_buggy_key(old_driver), lambda: assigned_buggy(old_driver)))
+        self.assertEqual(cache.stats()["views"]["assigned-buggy"]["invalidations"], 1)
+
+    def test_loads_racing_an_invalidation_are_not_cached(self):
+        cache = ReadModelCache()
+        cache.needs_warm_up = False
+
+        def stale_loader():
+            cache.invalidate('key')
+            return 'stale'
+
+        self.assertEqual(cache.get_or_load('key', stale_loader), 'stale')
+        self.assertEqual(cache.get_or_load('key', lambda: 'fresh'), 'fresh')
+        self.assertEqual(cache.get_or_load('key', lambda: 'other'), 'fresh')
+
+    def test_assigned_buggy_view(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + self.driver_token)
+        self.assertEqual(client.get('/api/tracking/assigned-buggy/').data["id"], self.buggy_ids[0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Buggy.objects.get(id=self.buggy_ids[0]).delete()
+        self.assertEqual(client.get('/api/tracking/assigned-buggy/').status_code, 404)
+
+
+# ------------------ DB executor ------------------
+
+class DatabaseExecutorTests(SimpleTestCase):
+    def test_default_workers(self):
+        self.assertEqual(settings.DATABASES["default"]["ENGINE"], "django.db.backends.sqlite3")
+        self.assertEqual(default_max_workers(), 1)
+        with mock.patch.dict(settings.DATABASES["default"], ENGINE="django.db.backends.postgresql"):
+            self.assertEqual(default_max_workers(), MAX_WORKERS)
+
+    def test_from_settings(self):
+        with override_settings(TRACKING_DB_EXECUTOR={}):
+            self.assertEqual(DatabaseExecutor.from_settings().max_workers, 1)
+        with override_settings(TRACKING_DB_EXECUTOR={'MAX_WORKERS': 3}):
+            self.assertEqual(DatabaseExecutor.from_settings().max_workers, 3)
+        with override_settings(TRACKING_DB_EXECUTOR={'MAX_WORKERS': 0}):
+            self.assertIsNone(DatabaseExecutor.from_settings()._pool)
+
+    async def test_calls_run_on_the_pool(self):
+        executor = DatabaseExecutor(max_workers=2)
+        name = await executor.run(lambda: threading.current_thread().name, helper="test")
+        self.assertTrue(name.startswith("tracking-db"))
+        self.assertEqual(executor.stats(), {"max_workers": 2, "calls": 1, "running": 0, "queued": 0})
+
+    async def test_zero_workers_fall_back_to_the_shared_thread(self):
+        executor = DatabaseExecutor(max_workers=0)
+        name = await executor.run(lambda: threading.current_thread().name, helper="test")
+        self.assertFalse(name.startswith("tracking-db"))
+        self.assertEqual(executor.stats()["calls"], 1)
+
+
+# ------------------ Metrics ------------------
+
+class MetricsEndpointTests(SimpleTestCase):
+    def test_loopback_is_refused_by_default(self):
+        # Tunnelled requests arrive from 127.0.0.1 too
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+    @override_settings(METRICS={'ALLOWED_IPS': [], 'TOKEN': 'scrape-secret'})
+    def test_bearer_token(self):
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    @override_settings(METRICS={'ALLOWED_IPS': ['10.0.0.5'], 'TOKEN': None})
+    def test_opt_in_ip_allowlist(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.5').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+
+# ------------------ Nearby buggies ------------------
+
+class NearbyIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = NearbyIndex(cell_size=250)
+        # About 110 m, 550 m and 2.2 km north
+        for buggy_id, offset in ((1, 0.001), (2, 0.005), (3, 0.02)):
+            self.index.update(buggy_id, 12.97 + offset, 77.59)
+
+    def test_nearest_within_radius(self):
+        matches = self.index.nearest(12.97, 77.59, 1000, 5)
+        self.assertEqual([buggy_id for _, buggy_id in matches], [1, 2])
+        self.assertAlmostEqual(matches[0][0], 111.2, delta=0.5)
+
+        self.assertEqual([buggy_id for _, buggy_id in self.index.nearest(12.97, 77.59, 5000, 1)], [1])
+
+    def test_moves_and_removals(self):
+        self.index.update(3, 12.9701, 77.59)
+        self.index.remove([1])
+        self.assertEqual([buggy_id for _, buggy_id in self.index.nearest(12.97, 77.59, 1000, 5)], [3, 2])
+        self.assertEqual(len(self.index), 2)
+
+    def test_visits_only_nearby_cells(self):
+        # Enough buggies far away that the grid is searched cell by cell
+        for buggy_id in range(100, 200):
+            self.index.update(buggy_id, 13.5 + buggy_id * 0.01, 78.0)
+        self.assertEqual([buggy_id for _, buggy_id in self.index.nearest(12.97, 77.59, 1000, 5)], [1, 2])
+
+    def test_parse_query(self):
+        self.assertEqual(
+            parse_nearby_query({"latitude": "12.97", "longitude": "77.59", "radius": "20000", "limit": "100"}),
+            (12.97, 77.59, 5000, 50),
+        )
+        for bad in (
+            {"latitude": "12.97"},
+            {"latitude": "x", "longitude": "77.59"},
+            {"latitude": "95", "longitude": "77.59"},
+            {"latitude": "12.97", "longitude": "77.59", "radius": "-1"},
+            {"latitude": "12.97", "longitude": "77.59", "radius": "nan"},
+            {"latitude": "12.97", "longitude": "77.59", "radius": "inf"},
+            {"latitude": "nan", "longitude": "77.59"},
+            {"latitude": "12.97", "longitude": "-inf"},
+        ):
+            with self.assertRaises(ValueError):
+                parse_nearby_query(bad)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class NearbyBuggiesViewTests(TestCase):
+    def setUp(self):
+        reset_tracking_state()
+        _, (token,), self.buggy_ids = make_fleet(2, 1)
+        for buggy_id, latitude in zip(self.buggy_ids, (12.971, 12.99)):
+            get_live_store().set(buggy_id, live_entry(buggy_id, 'BUG', latitude, 77.59, None, 'driver', NOW))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+
+    def nearby(self, **params):
+        return self.client.get('/api/tracking/nearby-buggies/', {"latitude": 12.97, "longitude": 77.59, **params})
+
+    def test_closest_running_buggies(self):
+        response = self.nearby(radius=5000)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry["buggy_id"] for entry in response.data], self.buggy_ids)
+        self.assertAlmostEqual(response.data[0]["distance"], 111.2, delta=0.5)
+
+        self.assertEqual([entry["buggy_id"] for entry in self.nearby(radius=500).data], self.buggy_ids[:1])
+
+    def test_invalid_queries(self):
+        self.assertEqual(self.nearby(radius='nan').status_code, 400)
+        self.assertEqual(self.nearby(latitude='inf').status_code, 400)
+        self.assertEqual(self.client.get('/api/tracking/nearby-buggies/').status_code, 400)
+
+
+# ------------------ History API ------------------
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class LocationHistoryTests(TestCase):
+    def setUp(self):
+        reset_tracking_state()
+        _, (self.token,), (self.buggy_id,) = make_fleet()
+        buggy = Buggy.objects.get(id=self.buggy_id)
+        now = timezone.now()
+        # Equal timestamps in pairs, so pages must break ties on id
+        Location.objects.bulk_create(
+            Location(
+                buggy=buggy, driver=buggy.assigned_driver, latitude=12.97 + index * 1e-4,
+                longitude=77.59, timestamp=now - timedelta(seconds=100 - index // 2),
+            )
+            for index in range(25)
+        )
+        self.expected = list(Location.objects.order_by('timestamp', 'id').values_list('latitude', flat=True))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def history(self, **params):
+        return self.client.get('/api/tracking/location-history/', {"buggy_id": self.buggy_id, **params})
+
+    async def stream(self, kind):
+        response = await self.async_client.get(
+            '/api/tracking/location-history/', {"buggy_id": self.buggy_id, "stream": kind},
+            headers={"Authorization": 'Token ' + self.token},
+        )
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join([chunk async for chunk in response.streaming_content]).decode()
+
+    def test_full_history(self):
+        response = self.history(since='1d')
+        self.assertEqual([row["latitude"] for row in response.data], self.expected)
+        self.assertEqual(set(response.data[0]), {"latitude", "longitude", "timestamp"})
+
+    def test_keyset_pages_cover_history_once(self):
+        seen, cursor, pages = [], None, 0
+        while True:
+            response = self.history(limit=10, **({"cursor": cursor} if cursor else {}))
+            self.assertEqual(response.status_code, 200)
+            seen += response.data["results"]
+            pages += 1
+            if not response.data["next"]:
+                break
+            cursor = parse_qs(urlparse(response.data["next"]).query)["cursor"][0]
+
+        self.assertEqual(pages, 3)
+        self.assertEqual([row["latitude"] for row in seen], self.expected)
+
+    def test_invalid_queries(self):
+        self.assertEqual(self.history(cursor='not-a-cursor').status_code, 400)
+        self.assertEqual(self.history(limit=0).status_code, 400)
+        self.assertEqual(self.history(since='soon').status_code, 400)
+        self.assertEqual(self.history(stream='csv').status_code, 400)
+        self.assertEqual(self.client.get('/api/tracking/location-history/').status_code, 400)
+
+    @override_settings(TRACKING_HISTORY={**settings.TRACKING_HISTORY, 'STREAM_CHUNK_SIZE': 10})
+    async def test_ndjson_stream(self):
+        response, body = await self.stream('ndjson')
+        self.assertEqual(response["Content-Type"], 'application/x-ndjson')
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([row["latitude"] for row in rows], self.expected)
+
+    @override_settings(TRACKING_HISTORY={**settings.TRACKING_HISTORY, 'STREAM_CHUNK_SIZE': 10})
+    async def test_json_array_stream(self):
+        _, body = await self.stream('json')
+        self.assertEqual([row["latitude"] for row in json.loads(body)], self.expected)
+
+    def test_encoded_formats(self):
+        polyline = self.history(format='polyline')
+        self.assertEqual(polyline.status_code, 200)
+        self.assertEqual(polyline.data["count"], 25)
+        latitudes = np.cumsum(decode_varints(polyline.data["polyline"])[0::2]) / 1e5
+        np.testing.assert_allclose(latitudes, self.expected, atol=1e-5)
+
+        columnar = self.history(format='columnar', limit=10)
+        self.assertEqual(columnar.data["results"]["count"], 10)
+        np.testing.assert_allclose(np.cumsum(columnar.data["results"]["latitude"]) / 1e6, self.expected[:10])
+        self.assertIsNotNone(columnar.data["next"])
+
+
+
+# ------------------ History partitions ------------------
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    TRACKING_HISTORY={**settings.TRACKING_HISTORY, 'PARTITIONING': 'tables'},
+)
+class TablePerPeriodTests(TransactionTestCase):
+    # The schema editor can't run inside TestCase's transaction on SQLite
+
+    def setUp(self):
+        reset_tracking_state()
+        _, _, (self.buggy_id,) = make_fleet(1, 0)
+        driver_id = Buggy.objects.get(id=self.buggy_id).assigned_driver_id
+
+        self.current = month_start(timezone.now())
+        self.previous = month_start(self.current - timedelta(days=1))
+        self.oldest = month_start(self.previous - timedelta(days=1))
+        self.times = [
+            # Two fixes in one minute, rolled up together
+            self.oldest + timedelta(days=5), self.oldest + timedelta(days=5, seconds=30),
+            self.oldest + timedelta(days=6),
+            self.previous + timedelta(days=5), self.previous + timedelta(days=6),
+            self.current,
+        ]
+        Location.objects.bulk_create(
+            Location(buggy_id=self.buggy_id, driver_id=driver_id, latitude=10 + index, longitude=77, timestamp=at)
+            for index, at in enumerate(self.times)
+        )
+
+    def tearDown(self):
+        # Archive tables aren't flushed with the test models
+        get_history_storage().drop_before(self.current + timedelta(days=400))
+        reset_tracking_state()
+
+    def test_archive_closed_months(self):
+        call_command('history_partitions', stdout=StringIO())
+
+        self.assertEqual(
+            get_history_storage().archived_months(refresh=True), [self.oldest, self.previous]
+        )
+        self.assertEqual(Location.objects.count(), 1)
+        # Reads span the archive tables and the live table, in order
+        rows = history_rows(self.buggy_id, self.oldest)
+        self.assertEqual([row[3] for row in rows], self.times)
+        self.assertEqual([row[3] for row in history_rows(self.buggy_id, self.previous)], self.times[3:])
+
+        paged, cursor = [], None
+        while True:
+            page, cursor = history_page(self.buggy_id, self.oldest, 4, cursor)
+            paged += page
+            if cursor is None:
+                break
+        self.assertEqual(paged, rows)
+
+    def test_rollup_and_prune(self):
+        call_command('history_partitions', stdout=StringIO())
+        # Keeps the previous month onwards
+        days = (timezone.now() - self.previous).days
+        call_command('prune_history', days=days, stdout=StringIO())
+
+        self.assertEqual(get_history_storage().archived_months(refresh=True), [self.previous])
+        self.assertEqual([row[3] for row in history_rows(self.buggy_id, self.oldest)], self.times[3:])
+        self.assertEqual(
+            list(LocationRollup.objects.order_by('minute').values_list('minute', 'samples', 'latitude')),
+            [(self.times[0], 2, 10.5), (self.times[2], 1, 12.0)],
+        )
+
+        # Rolling up the same rows again rewrites the same values
+        cutoff = self.previous + timedelta(days=5, minutes=1)
+        self.assertEqual(rollup_before(cutoff), 1)
+        self.assertEqual(rollup_before(cutoff), 1)
+        self.assertEqual(LocationRollup.objects.count(), 3)
+
+
+# ------------------ WebSocket protocol ------------------
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ConsumerTestCase(TransactionTestCase):
+    """Two drivers with running buggies and a student, talking to ``LocationConsumer``."""
+    # Seconds between broadcast ticks, 0 to publish every update right away
+    tick_interval = 0
+
+    def setUp(self):
+        reset_tracking_state()
+        (self.driver_token, self.other_driver_token), (self.student_token,), self.buggy_ids = make_fleet(2, 1)
+        self.sockets = []
+
+    def tearDown(self):
+        # Pings still buffered would otherwise be flushed at exit
+        if ingest._buffer is not None:
+            ingest._buffer.flush()
+        reset_tracking_state()
+
+    async def connect(self, token, subprotocols=None):
+        get_broadcaster().tick_interval = self.tick_interval
+        communicator = WebsocketCommunicator(
+            application, f"ws/location/updates?token={token}", subprotocols=subprotocols
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.sockets.append(communicator)
+        return communicator, subprotocol
+
+    async def close_all(self):
+        for communicator in self.sockets:
+            await communicator.disconnect()
+
+    async def receive_all(self, communicator, timeout=0.3):
+        frames = []
+        while not await communicator.receive_nothing(timeout):
+            output = await communicator.receive_output()
+            if output.get("bytes") is not None:
+                frames.append(msgpack.unpackb(output["bytes"]))
+            else:
+                frames.append(json.loads(output["text"]))
+        return frames
+
+    async def send_ping(self, driver, buggy_id, latitude, longitude, direction=None):
+        await driver.send_json_to({
+            "type": "location_update", "buggy_id": buggy_id,
+            "latitude": latitude, "longitude": longitude, "direction": direction,
+        })
+        # Lets the update reach subscribers before the next one
+        await asyncio.sleep(0.05)
+
+
+class SubscriptionTests(ConsumerTestCase):
+    async def test_rejects_unknown_tokens(self):
+        communicator = WebsocketCommunicator(application, "ws/location/updates?token=nope")
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_subscribe_to_buggies(self):
+        buggy_id, other_id = self.buggy_ids
+        driver, _ = await self.connect(self.driver_token)
+        other_driver, _ = await self.connect(self.other_driver_token)
+        student, _ = await self.connect(self.student_token)
+        await self.receive_all(student)
+
+        await student.send_json_to({"type": "subscribe", "buggy_ids": [buggy_id]})
+        confirmed = (await self.receive_all(student))[0]
+        self.assertEqual(confirmed, {
+            "type": "subscription_confirmed", "buggy_ids": [buggy_id], "all": False, "delta": False,
+        })
+
+        await self.send_ping(driver, buggy_id, 12.9716, 77.5946, 45.5)
+        await self.send_ping(other_driver, other_id, 12.98, 77.6)
+        (update,) = await self.receive_all(student)
+        self.assertEqual(update["type"], "location_update")
+        self.assertEqual(
+            (update["buggy_id"], update["latitude"], update["longitude"], update["direction"], update["driver_name"]),
+            (buggy_id, 12.9716, 77.5946, 45.5, 'driver0'),
+        )
+
+        # A new subscription replaces the old one
+        await student.send_json_to({"type": "subscribe", "buggy_ids": [other_id]})
+        await self.receive_all(student)
+        await self.send_ping(driver, buggy_id, 12.9720, 77.5946)
+        await self.send_ping(other_driver, other_id, 12.9810, 77.6)
+        self.assertEqual([update["buggy_id"] for update in await self.receive_all(student)], [other_id])
+        await self.close_all()
+
+    async def test_subscribe_to_all(self):
+        buggy_id, other_id = self.buggy_ids
+        driver, _ = await self.connect(self.driver_token)
+        other_driver, _ = await self.connect(self.other_driver_token)
+        student, _ = await self.connect(self.student_token)
+        await student.send_json_to({"type": "subscribe", "all": True})
+        await self.receive_all(student)
+
+        await self.send_ping(driver, buggy_id, 12.9716, 77.5946)
+        await self.send_ping(other_driver, other_id, 12.98, 77.6)
+        batches = await self.receive_all(student)
+        self.assertEqual({batch["type"] for batch in batches}, {"location_batch"})
+        self.assertEqual(
+            [(u["buggy_id"], u["latitude"]) for batch in batches for u in batch["updates"]],
+            [(buggy_id, 12.9716), (other_id, 12.98)],
+        )
+        await self.close_all()
+
+    async def test_drivers_only_move_their_own_buggy(self):
+        buggy_id, other_id = self.buggy_ids
+        driver, _ = await self.connect(self.driver_token)
+        student, _ = await self.connect(self.student_token)
+        await student.send_json_to({"type": "subscribe", "all": True})
+        await self.receive_all(student)
+
+        await self.send_ping(driver, other_id, 12.9716, 77.5946)
+        self.assertEqual(await self.receive_all(student), [])
+        await self.close_all()
+
+
+class BroadcastTickTests(ConsumerTestCase):
+    tick_interval = 0.2
+
+    async def test_updates_coalesce_per_tick(self):
+        buggy_id, _ = self.buggy_ids
+        driver, _ = await self.connect(self.driver_token)
+        student, _ = await self.connect(self.student_token)
+        await student.send_json_to({"type": "subscribe", "buggy_ids": [buggy_id]})
+        await self.receive_all(student)
+
+        for latitude in (12.9716, 12.9717, 12.9718):
+            await driver.send_json_to({
+                "type": "location_update", "buggy_id": buggy_id, "latitude": latitude, "longitude": 77.5946,
+            })
+            await asyncio.sleep(0.01)
+
+        # Only the latest update of the tick is sent
+        (update,) = await self.receive_all(student, timeout=0.5)
+        self.assertEqual(update["latitude"], 12.9718)
+        self.assertEqual(get_broadcaster().stats()["frames_saved"], 2)
+        await self.close_all()
+
+
+
+class SnapshotTests(ConsumerTestCase):
+    async def test_snapshot_on_connect_and_subscribe(self):
+        buggy_id, other_id = self.buggy_ids
+        student, _ = await self.connect(self.student_token)
+        self.assertEqual(await self.receive_all(student), [{"type": "snapshot", "buggies": []}])
+
+        await student.send_json_to({"type": "subscribe", "all": True})
+        await self.receive_all(student)
+        driver, _ = await self.connect(self.driver_token)
+        other_driver, _ = await self.connect(self.other_driver_token)
+        await self.send_ping(driver, buggy_id, 12.9716, 77.5946)
+        await self.send_ping(other_driver, other_id, 12.98, 77.6)
+        self.assertEqual(len(await self.receive_all(student)), 2)
+
+        # New sockets see every running buggy in their first frame
+        late, _ = await self.connect(self.student_token)
+        (snapshot_frame,) = await self.receive_all(late)
+        self.assertEqual(sorted(entry["buggy_id"] for entry in snapshot_frame["buggies"]), [buggy_id, other_id])
+
+        # Subscribing sends the current state of just the subscribed buggies
+        await late.send_json_to({"type": "subscribe", "buggy_ids": [other_id]})
+        confirmed, snapshot_frame = await self.receive_all(late)
+        self.assertEqual(confirmed["type"], "subscription_confirmed")
+        self.assertEqual([(entry["buggy_id"], entry["latitude"]) for entry in snapshot_frame["buggies"]],
+                         [(other_id, 12.98)])
+        await self.close_all()
+
+
+class DriverUploadTests(ConsumerTestCase):
+    async def test_invalid_pings_get_an_error(self):
+        buggy_id, _ = self.buggy_ids
+        driver, _ = await self.connect(self.driver_token)
+
+        for bad in ({"latitude": "12.97", "longitude": 77.59}, {"latitude": 95, "longitude": 77.59},
+                    {"latitude": 12.97, "longitude": 77.59, "direction": "north"}):
+            await driver.send_json_to({"type": "location_update", "buggy_id": buggy_id, **bad})
+            (error,) = await self.receive_all(driver)
+            self.assertEqual(error["type"], "error")
+        await self.close_all()
+
+    async def test_batch_upload(self):
+        buggy_id, other_id = self.buggy_ids
+        driver, _ = await self.connect(self.driver_token)
+        student, _ = await self.connect(self.student_token)
+        await student.send_json_to({"type": "subscribe", "buggy_ids": [buggy_id]})
+        await self.receive_all(student)
+
+        now = timezone.now()
+        fixes = [
+            {"latitude": 12.97 + index * 3e-4, "longitude": 77.59,
+             "timestamp": (now - timedelta(seconds=30 - index)).isoformat()}
+            for index in range(10)
+        ]
+        fixes += [{"latitude": 200, "longitude": 77.59, "timestamp": now.isoformat()}, "x"]
+        await driver.send_json_to({"type": "location_batch", "buggy_id": buggy_id, "fixes": fixes})
+
+        (ack,) = await self.receive_all(driver)
+        self.assertEqual(ack, {"type": "location_batch_ack", "buggy_id": buggy_id, "accepted": 10, "rejected": 2})
+        # Only the newest fix moves the buggy
+        (update,) = await self.receive_all(student)
+        self.assertAlmostEqual(update["latitude"], 12.9727, places=5)
+
+        # Other drivers' buggies are refused
+        await driver.send_json_to({"type": "location_batch", "buggy_id": other_id, "fixes": fixes[:2]})
+        (ack,) = await self.receive_all(driver)
+        self.assertEqual((ack["accepted"], ack["rejected"]), (0, 2))
+
+        await driver.send_json_to({"type": "location_batch", "buggy_id": buggy_id, "fixes": "nope"})
+        (error,) = await self.receive_all(driver)
+        self.assertEqual(error["type"], "error")
+        await self.close_all()
+
+        # The simplifier keeps at least the ends of the straight run
+        await database_sync_to_async(ingest._buffer.flush)()
+        stored = await database_sync_to_async(list)(
+            Location.objects.order_by('timestamp').values_list('latitude', flat=True)
+        )
+        self.assertEqual((stored[0], stored[-1]), (fixes[0]["latitude"], fixes[9]["latitude"]))
+
+
+class DeltaFrameTests(ConsumerTestCase):
+    async def test_delta_frames(self):
+        buggy_id, _ = self.buggy_ids
+        driver, _ = await self.connect(self.driver_token)
+        student, _ = await self.connect(self.student_token)
+        await student.send_json_to({"type": "subscribe", "buggy_ids": [buggy_id], "delta": True})
+        confirmed = (await self.receive_all(student))[1]
+        self.assertTrue(confirmed["delta"])
+
+        await self.send_ping(driver, buggy_id, 12.971601, 77.5946, 10)
+        # Below the precision of delta frames
+        await self.send_ping(driver, buggy_id, 12.971602, 77.5946, 10.2)
+        await self.send_ping(driver, buggy_id, 12.97171, 77.5946, 10.2)
+        await self.send_ping(driver, buggy_id, 12.97171, 77.5947, 45)
+
+        full, latitude_only, moved = await self.receive_all(student)
+        self.assertEqual(
+            (full["latitude"], full["longitude"], full["direction"], full["driver_name"]),
+            (12.9716, 77.5946, 10, 'driver0'),
+        )
+        self.assertEqual(set(latitude_only), {"type", "buggy_id", "dt", "latitude"})
+        self.assertEqual(latitude_only["latitude"], 12.97171)
+        self.assertGreater(latitude_only["dt"], 0)
+        self.assertEqual((moved["longitude"], moved["direction"]), (77.5947, 45))
+        self.assertNotIn("latitude", moved)
+        await self.close_all()
+
+
+class MessagePackTests(ConsumerTestCase):
+    async def test_msgpack_subprotocol(self):
+        buggy_id, _ = self.buggy_ids
+        driver, subprotocol = await self.connect(self.driver_token, subprotocols=["campusbuggy.msgpack.v1"])
+        self.assertEqual(subprotocol, "campusbuggy.msgpack.v1")
+        student, subprotocol = await self.connect(self.student_token, subprotocols=["other", "campusbuggy.msgpack.v1"])
+        self.assertEqual(subprotocol, "campusbuggy.msgpack.v1")
+        json_student, subprotocol = await self.connect(self.student_token)
+        self.assertIsNone(subprotocol)
+
+        await student.send_to(bytes_data=msgpack.packb({"type": "subscribe", "buggy_ids": [buggy_id]}))
+        await json_student.send_json_to({"type": "subscribe", "all": True})
+        frames = await self.receive_all(student)
+        self.assertEqual(frames[1]["type"], "subscription_confirmed")
+        await self.receive_all(json_student)
+
+        await driver.send_to(bytes_data=MSGPACK_CODEC.driver_update_frame(buggy_id, 12.9716, 77.5946, 45.5))
+        await asyncio.sleep(0.05)
+        (update,) = await self.receive_all(student)
+        self.assertEqual(update[:6], [1, buggy_id, 12971600, 77594600, 455, 'driver0'])
+        # JSON sockets get the same update as JSON
+        (batch,) = await self.receive_all(json_student)
+        self.assertEqual(batch["updates"][0]["direction"], 45.5)
+
+        # Text frames are refused on a MessagePack socket
+        await driver.send_to(text_data="{}")
+        (error,) = await self.receive_all(driver)
+        self.assertEqual(error["type"], "error")
+        await self.close_all()
+
+
+class NearbyQueryTests(ConsumerTestCase):
+    async def test_nearby_over_websocket(self):
+        buggy_id, _ = self.buggy_ids
+        driver, _ = await self.connect(self.driver_token)
+        student, _ = await self.connect(self.student_token)
+        await self.receive_all(student)
+        await self.send_ping(driver, buggy_id, 12.971, 77.59)
+
+        await student.send_json_to({"type": "nearby", "latitude": 12.97, "longitude": 77.59})
+        (response,) = await self.receive_all(student)
+        self.assertEqual(response["type"], "nearby_buggies")
+        self.assertEqual([entry["buggy_id"] for entry in response["buggies"]], [buggy_id])
+
+        await student.send_json_to({"type": "nearby", "latitude": 12.97, "longitude": 77.59, "radius": "nan"})
+        (error,) = await self.receive_all(student)
+        self.assertEqual(error["type"], "error")
+        await self.close_all()
@@ -0,0 +1,343 @@
+"""
+Recent positions of every buggy, for the short tail the map draws behind it.
+
+``LocationConsumer`` appends every accepted ping here, so trails show the
+path driven in the last few minutes even though ``Location`` history keeps
+far fewer fixes. Each buggy keeps at most ``TRACKING_TRAILS['MAX_POINTS']``
+positions at least ``MIN_INTERVAL`` seconds apart. The newest position is
+replaced rather than appended until that interval has passed, so a trail
+always ends where the buggy is now. Positions older than ``MAX_AGE`` seconds
+are never returned.
+
+The backend is chosen with ``TRACKING_TRAILS['BACKEND']``:
+``LocalTrailStore`` keeps a fixed-size numpy ring per buggy in the worker
+process; ``RedisTrailStore`` keeps a capped Redis list per buggy shared by
+all workers. ``TrailsView`` and the ``trails`` WebSocket message return the
+trails of all running buggies in one response.
+"""
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .encoding import TRAIL_FORMATS, encode_millis_trail
+from .history import format_timestamp, parse_since
+
+DEFAULTS = {
+    "BACKEND": "tracking.trails.LocalTrailStore",
+    "OPTIONS": {},
+    "MAX_POINTS": 120,
+    "MIN_INTERVAL": 5.0,
+    "MAX_AGE": 600,
+}
+
+APPEND, REPLACE = "append", "replace"
+
+
+def trails_setting(name):
+    return getattr(settings, "TRACKING_TRAILS", {}).get(name, DEFAULTS[name])
+
+
+def now_millis():
+    return round(time.time() * 1000)
+
+
+class TrailStore:
+    """
+    Base class for trail backends. Positions are ``(latitude, longitude,
+    epoch millis)``; trails are read as ``{buggy_id: (latitudes, longitudes,
+    millis)}`` numpy columns, oldest first. The ``a``-prefixed methods are
+    used from consumers; backends with blocking I/O override them.
+    """
+    # Whether other worker processes write to the same trails
+    shared = False
+
+    def __init__(self, max_points=120, min_interval=5.0, max_age=600):
+        self.max_points = max_points
+        self.min_interval = round(min_interval * 1000)
+        self.max_age = max_age
+        # buggy_id -> (millis of the last settled position, millis of the newest)
+        self._marks = {}
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_points=trails_setting("MAX_POINTS"),
+            min_interval=trails_setting("MIN_INTERVAL"),
+            max_age=trails_setting("MAX_AGE"),
+            **trails_setting("OPTIONS"),
+        )
+
+    def _place(self, buggy_id, millis):
+        """Whether a position at ``millis`` is appended, replaces the newest, or is dropped."""
+        settled, newest = self._marks.get(buggy_id, (None, None))
+        if newest is not None and millis <= newest:
+            return None
+        # The newest position is settled once it is MIN_INTERVAL past the
+        # previous settled one; until then each new position replaces it
+        if settled is not None and newest - settled < self.min_interval:
+            self._marks[buggy_id] = (settled, millis)
+            return REPLACE
+        self._marks[buggy_id] = (newest, millis)
+        return APPEND
+
+    def oldest_millis(self, since_millis=None):
+        oldest = now_millis() - self.max_age * 1000
+        return oldest if since_millis is None else max(oldest, since_millis)
+
+    def append(self, buggy_id, latitude, longitude, millis):
+        self.extend(buggy_id, [(latitude, longitude, millis)])
+
+    def extend(self, buggy_id, positions):
+        """Add ``positions`` of one buggy, oldest first."""
+        raise NotImplementedError
+
+    def get(self, buggy_ids=None, since_millis=None):
+        """Trails of ``buggy_ids``, or of every buggy with one; empty ones are left out."""
+        raise NotImplementedError
+
+    def delete(self, buggy_ids):
+        raise NotImplementedError
+
+    async def aappend(self, buggy_id, latitude, longitude, millis):
+        await self.aextend(buggy_id, [(latitude, longitude, millis)])
+
+    async def aextend(self, buggy_id, positions):
+        self.extend(buggy_id, positions)
+
+    async def aget(self, buggy_ids=None, since_millis=None):
+        return self.get(buggy_ids, since_millis)
+
+    async def adelete(self, buggy_ids):
+        self.delete(buggy_ids)
+
+
+class _Ring:
+    """A fixed number of positions in preallocated columns."""
+    __slots__ = ("latitudes", "longitudes", "millis", "start", "count")
+
+    def __init__(self, capacity):
+        self.latitudes = np.empty(capacity, dtype=np.float64)
+        self.longitudes = np.empty(capacity, dtype=np.float64)
+        self.millis = np.empty(capacity, dtype=np.int64)
+        self.start = 0
+        self.count = 0
+
+    def put(self, latitude, longitude, millis, action):
+        capacity = len(self.millis)
+        if action == APPEND:
+            if self.count == capacity:
+                self.start = (self.start + 1) % capacity
+            else:
+                self.count += 1
+        index = (self.start + self.count - 1) % capacity
+        self.latitudes[index] = latitude
+        self.longitudes[index] = longitude
+        self.millis[index] = millis
+
+    def columns(self, oldest):
+        order = (self.start + np.arange(self.count)) % len(self.millis)
+        millis = self.millis[order]
+        keep = order[millis >= oldest]
+        return self.latitudes[keep], self.longitudes[keep], self.millis[keep]
+
+
+class LocalTrailStore(TrailStore):
+    def __init__(self, max_points=120, min_interval=5.0, max_age=600, **options):
+        super().__init__(max_points, min_interval, max_age)
+        self._lock = threading.Lock()
+        self._rings = {}
+
+    def extend(self, buggy_id, positions):
+        with self._lock:
+            ring = self._rings.get(buggy_id)
+            for latitude, longitude, millis in positions:
+                action = self._place(buggy_id, millis)
+                if action is None:
+                    continue
+                if ring is None:
+                    ring = self._rings[buggy_id] = _Ring(self.max_points)
+                ring.put(latitude, longitude, millis, action)
+
+    def get(self, buggy_ids=None, since_millis=None):
+        oldest = self.oldest_millis(since_millis)
+        with self._lock:
+            if buggy_ids is None:
+                buggy_ids = list(self._rings)
+            trails = {}
+            for buggy_id in buggy_ids:
+                ring = self._rings.get(buggy_id)
+                if ring is not None:
+                    columns = ring.columns(oldest)
+                    if len(columns[2]):
+                        trails[buggy_id] = columns
+            return trails
+
+    def delete(self, buggy_ids):
+        with self._lock:
+            for buggy_id in buggy_ids:
+                self._rings.pop(buggy_id, None)
+                self._marks.pop(buggy_id, None)
+
+
+class RedisTrailStore(TrailStore):
+    """
+    One Redis list of ``"latitude,longitude,millis"`` per buggy, trimmed to
+    ``MAX_POINTS`` and expiring ``MAX_AGE`` seconds after its last append,
+    plus a set of the buggies that have one.
+    """
+    shared = True
+
+    def __init__(self, max_points=120, min_interval=5.0, max_age=600,
+                 url="redis://127.0.0.1:6379/0", key="campusbuggy:trails", **options):
+        import redis
+        import redis.asyncio
+
+        super().__init__(max_points, min_interval, max_age)
+        self.key = key
+        self.buggies_key = f"{key}:buggies"
+        self._client = redis.Redis.from_url(url, **options)
+        self._async_client = redis.asyncio.Redis.from_url(url, **options)
+
+    def trail_key(self, buggy_id):
+        return f"{self.key}:{buggy_id}"
+
+    def _queue_extend(self, pipe, buggy_id, positions):
+        # A buggy reports through one driver socket, so the worker holding it
+        # decides between appending and replacing on its own
+        key = self.trail_key(buggy_id)
+        appended = False
+        for latitude, longitude, millis in positions:
+            action = self._place(buggy_id, millis)
+            if action == APPEND:
+                pipe.rpush(key, f"{latitude},{longitude},{millis}")
+                appended = True
+            elif action == REPLACE:
+                pipe.lset(key, -1, f"{latitude},{longitude},{millis}")
+        if appended:
+            pipe.ltrim(key, -self.max_points, -1)
+            pipe.expire(key, self.max_age)
+            pipe.sadd(self.buggies_key, buggy_id)
+
+    def _parse(self, buggy_ids, values, oldest):
+        trails, expired = {}, []
+        for buggy_id, items in zip(buggy_ids, values):
+            if not items:
+                expired.append(buggy_id)
+                continue
+            positions = np.array(
+                [item.split(b",") for item in items], dtype=np.float64
+            ).reshape(-1, 3)
+            millis = positions[:, 2].astype(np.int64)
+            keep = millis >= oldest
+            if keep.any():
+                trails[buggy_id] = (positions[keep, 0], positions[keep, 1], millis[keep])
+        return trails, expired
+
+    def extend(self, buggy_id, positions):
+        pipe = self._client.pipeline(transaction=False)
+        self._queue_extend(pipe, buggy_id, positions)
+        # LSET fails on a trail that expired meanwhile; the next append restores it
+        pipe.execute(raise_on_error=False)
+
+    def get(self, buggy_ids=None, since_millis=None):
+        listed = buggy_ids is None
+        if listed:
+            buggy_ids = [int(member) for member in self._client.smembers(self.buggies_key)]
+        if not buggy_ids:
+            return {}
+        pipe = self._client.pipeline(transaction=False)
+        for buggy_id in buggy_ids:
+            pipe.lrange(self.trail_key(buggy_id), 0, -1)
+        trails, expired = self._parse(buggy_ids, pipe.execute(), self.oldest_millis(since_millis))
+        if listed and expired:
+            self._client.srem(self.buggies_key, *expired)
+        return trails
+
+    def delete(self, buggy_ids):
+        if buggy_ids:
+            pipe = self._client.pipeline()
+            pipe.delete(*[self.trail_key(buggy_id) for buggy_id in buggy_ids])
+            pipe.srem(self.buggies_key, *buggy_ids)
+            pipe.execute()
+        for buggy_id in buggy_ids:
+            self._marks.pop(buggy_id, None)
+
+    async def aextend(self, buggy_id, positions):
+        pipe = self._async_client.pipeline(transaction=False)
+        self._queue_extend(pipe, buggy_id, positions)
+        await pipe.execute(raise_on_error=False)
+
+    async def aget(self, buggy_ids=None, since_millis=None):
+        listed = buggy_ids is None
+        if listed:
+            buggy_ids = [int(member) for member in await self._async_client.smembers(self.buggies_key)]
+        if not buggy_ids:
+            return {}
+        pipe = self._async_client.pipeline(transaction=False)
+        for buggy_id in buggy_ids:
+            pipe.lrange(self.trail_key(buggy_id), 0, -1)
+        trails, expired = self._parse(buggy_ids, await pipe.execute(), self.oldest_millis(since_millis))
+        if listed and expired:
+            await self._async_client.srem(self.buggies_key, *expired)
+        return trails
+
+    async def adelete(self, buggy_ids):
+        if buggy_ids:
+            pipe = self._async_client.pipeline()
+            pipe.delete(*[self.trail_key(buggy_id) for buggy_id in buggy_ids])
+            pipe.srem(self.buggies_key, *buggy_ids)
+            await pipe.execute()
+        for buggy_id in buggy_ids:
+            self._marks.pop(buggy_id, None)
+
+
+def parse_trail_since(since):
+    """Epoch millis of a range such as ``5m``, or None for the whole ``MAX_AGE``. Raises ValueError."""
+    if since is None:
+        return None
+    try:
+        return round(parse_since(since).timestamp() * 1000)
+    except (ValueError, IndexError, TypeError):
+        raise ValueError("Invalid 'since' parameter format. Use {number}{unit} where unit is h, m, or d")
+
+
+def encode_trails(trails, fmt=None):
+    """
+    ``[{"buggy_id", ...}]`` from ``TrailStore.get``: each trail encoded as
+    ``fmt`` (one of TRAIL_FORMATS) or, by default, as a list of points.
+    """
+    encoded = []
+    for buggy_id, (latitudes, longitudes, millis) in sorted(trails.items()):
+        if fmt in TRAIL_FORMATS:
+            start = format_timestamp(datetime.fromtimestamp(millis[0] / 1000, tz=dt_timezone.utc))
+            encoded.append({
+                "buggy_id": buggy_id,
+                **encode_millis_trail(fmt, latitudes, longitudes, millis, start),
+            })
+        else:
+            encoded.append({
+                "buggy_id": buggy_id,
+                "points": [
+                    {
+                        "latitude": latitude,
+                        "longitude": longitude,
+                        "timestamp": format_timestamp(datetime.fromtimestamp(ms / 1000, tz=dt_timezone.utc)),
+                    }
+                    for latitude, longitude, ms in zip(latitudes.tolist(), longitudes.tolist(), millis.tolist())
+                ],
+            })
+    return encoded
+
+
+_store = None
+
+
+def get_trail_store():
+    global _store
+    if _store is None:
+        _store = import_string(trails_setting("BACKEND")).from_settings()
+    return _store
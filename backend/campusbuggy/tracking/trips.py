@@ -0,0 +1,240 @@
+"""
+Trips: a buggy's runs, segmented from its location history.
+
+A trip is a run of one buggy's history fixes with the same driver and no gap
+longer than ``TRACKING_TRIPS['MAX_GAP']`` seconds. Starting or stopping a
+buggy (``UpdateBuggyStatusView``, the admin) also closes its open trip. Each
+``Trip`` row holds its summary and its path already encoded in the
+``polyline`` trail format, so listing trips and drawing one are single-row
+reads however long the run was.
+
+Trips are built incrementally: after every ingest flush ``TripBuilder.add``
+extends each buggy's open trip with the history rows just written, appending
+to its encoded path in place. Fixes older than the end of the open trip
+(offline uploads that arrive late) are only placed by
+``manage.py backfill_trips``, which rebuilds trips from stored history.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .encoding import POLYLINE_PRECISION, encode_varints
+from .geo import haversine
+from .history import format_timestamp, parse_since
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "MAX_GAP": 600,
+}
+
+# Everything extend_trip changes, for in-place updates of an open trip
+TRIP_UPDATE_FIELDS = (
+    "ended_at", "is_open", "point_count", "distance",
+    "min_latitude", "min_longitude", "max_latitude", "max_longitude",
+    "end_latitude", "end_longitude", "polyline", "times",
+)
+
+
+def trips_setting(name):
+    return getattr(settings, "TRACKING_TRIPS", {}).get(name, DEFAULTS[name])
+
+
+def _millis(timestamp):
+    return round(timestamp.timestamp() * 1000)
+
+
+def extend_trip(trip, pings):
+    """Append ``pings`` (in time order) to ``trip``'s summary and encoded path."""
+    if not pings:
+        return
+
+    scale = 10 ** POLYLINE_PRECISION
+    latitudes = np.fromiter((ping.latitude for ping in pings), dtype=np.float64, count=len(pings))
+    longitudes = np.fromiter((ping.longitude for ping in pings), dtype=np.float64, count=len(pings))
+    millis = np.fromiter((_millis(ping.timestamp) for ping in pings), dtype=np.int64, count=len(pings))
+
+    if trip.point_count:
+        # Deltas continue from the trip's last fix
+        previous = (trip.end_latitude, trip.end_longitude)
+        prepend = (round(trip.end_latitude * scale), round(trip.end_longitude * scale), _millis(trip.ended_at))
+    else:
+        previous = None
+        prepend = (0, 0, millis[0])
+        trip.started_at = pings[0].timestamp
+        trip.min_latitude = trip.max_latitude = pings[0].latitude
+        trip.min_longitude = trip.max_longitude = pings[0].longitude
+
+    coordinates = np.empty(len(pings) * 2, dtype=np.int64)
+    coordinates[0::2] = np.diff(np.round(latitudes * scale).astype(np.int64), prepend=prepend[0])
+    coordinates[1::2] = np.diff(np.round(longitudes * scale).astype(np.int64), prepend=prepend[1])
+    trip.polyline += encode_varints(coordinates)
+    trip.times += encode_varints(np.diff(millis, prepend=prepend[2]))
+
+    distance = 0.0
+    for ping in pings:
+        if previous is not None:
+            distance += haversine(previous[0], previous[1], ping.latitude, ping.longitude)
+        previous = (ping.latitude, ping.longitude)
+
+    trip.distance += distance
+    trip.point_count += len(pings)
+    trip.min_latitude = min(trip.min_latitude, float(latitudes.min()))
+    trip.max_latitude = max(trip.max_latitude, float(latitudes.max()))
+    trip.min_longitude = min(trip.min_longitude, float(longitudes.min()))
+    trip.max_longitude = max(trip.max_longitude, float(longitudes.max()))
+    trip.end_latitude = pings[-1].latitude
+    trip.end_longitude = pings[-1].longitude
+    trip.ended_at = pings[-1].timestamp
+
+
+def segment_pings(trip, buggy_id, pings, max_gap):
+    """
+    Split one buggy's ``pings`` (in time order) into trips, continuing the
+    open ``trip`` (or None) as long as they belong to it. Returns the trips
+    touched, in order; all but the last are closed.
+    """
+    from .models import Trip
+
+    touched = []
+    current, run = trip, []
+    last = trip.ended_at if trip is not None else None
+    for ping in pings:
+        if current is None or ping.driver_id != current.driver_id or ping.timestamp - last > max_gap:
+            if current is not None:
+                extend_trip(current, run)
+                current.is_open = False
+                touched.append(current)
+            current, run = Trip(buggy_id=buggy_id, driver_id=ping.driver_id, is_open=True), []
+        run.append(ping)
+        last = ping.timestamp
+
+    if current is not None and (run or current is not trip):
+        extend_trip(current, run)
+        touched.append(current)
+    return touched
+
+
+def save_trips(trips):
+    """
+    Write trips from ``segment_pings``: existing ones are updated only while
+    still open. Returns False if an existing trip had been closed meanwhile.
+    """
+    from .models import Trip
+
+    for trip in trips:
+        if trip.pk is None:
+            trip.save()
+            continue
+        updated = Trip.objects.filter(pk=trip.pk, is_open=True).update(
+            **{field: getattr(trip, field) for field in TRIP_UPDATE_FIELDS}
+        )
+        if not updated:
+            return False
+    return True
+
+
+class TripBuilder:
+    """Extends each buggy's open trip with history as the ingest buffer writes it."""
+
+    def __init__(self, max_gap=600):
+        self.max_gap = timedelta(seconds=max_gap)
+        # buggy_id -> its open Trip, or None when it has none
+        self._open = {}
+
+    @classmethod
+    def from_settings(cls):
+        return cls(max_gap=trips_setting("MAX_GAP"))
+
+    def add(self, pings):
+        by_buggy = defaultdict(list)
+        for ping in pings:
+            by_buggy[ping.buggy_id].append(ping)
+        for buggy_id, buggy_pings in by_buggy.items():
+            buggy_pings.sort(key=lambda ping: ping.timestamp)
+            self._extend(buggy_id, buggy_pings)
+
+    def forget(self, buggy_id):
+        """Reload the buggy's open trip next time, e.g. after it was closed."""
+        self._open.pop(buggy_id, None)
+
+    def _open_trip(self, buggy_id):
+        from .models import Trip
+
+        if buggy_id not in self._open:
+            self._open[buggy_id] = Trip.objects.filter(buggy_id=buggy_id, is_open=True).first()
+        return self._open[buggy_id]
+
+    def _extend(self, buggy_id, pings):
+        for _ in range(2):
+            trip = self._open_trip(buggy_id)
+            if trip is not None:
+                pings = [ping for ping in pings if ping.timestamp > trip.ended_at]
+                if not pings:
+                    return
+
+            trips = segment_pings(trip, buggy_id, pings, self.max_gap)
+            if save_trips(trips):
+                self._open[buggy_id] = trips[-1] if trips and trips[-1].is_open else None
+                return
+            # Closed by a status change or a backfill in another process;
+            # start over from what is in the database now
+            self.forget(buggy_id)
+        logger.warning("Gave up extending trips of buggy %s", buggy_id)
+
+
+def _parse_time(value):
+    try:
+        parsed = parse_datetime(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValueError(f"Invalid time {value!r}")
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+def parse_trip_range(params):
+    """
+    ``(start, end)`` from ``start``/``end`` ISO times (``end`` defaults to
+    now) or else a ``since`` range such as ``1d``. Raises ValueError.
+    """
+    if 'start' in params:
+        start = _parse_time(params['start'])
+        end = _parse_time(params['end']) if 'end' in params else timezone.now()
+    else:
+        start, end = parse_since(params.get('since', '1d')), timezone.now()
+    if end < start:
+        raise ValueError("'end' is before 'start'")
+    return start, end
+
+
+def trips_between(buggy_id, start, end):
+    """Trips of a buggy overlapping ``[start, end]``, without their paths."""
+    from .models import Trip
+
+    return Trip.objects.filter(
+        buggy_id=buggy_id, started_at__lte=end, ended_at__gte=start
+    ).select_related('driver').defer('polyline', 'times').order_by('started_at')
+
+
+def close_open_trips(buggy_id):
+    from .models import Trip
+
+    Trip.objects.filter(buggy_id=buggy_id, is_open=True).update(is_open=False)
+
+
+def trip_path(trip):
+    """A trip's stored path, in the same shape as ``encode_trail('polyline', ...)``."""
+    return {
+        "format": "polyline",
+        "precision": POLYLINE_PRECISION,
+        "count": trip["point_count"],
+        "start": format_timestamp(trip["started_at"]),
+        "polyline": trip["polyline"],
+        "times": trip["times"],
+    }
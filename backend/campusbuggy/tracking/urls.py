@@ -1,10 +1,21 @@
 from django.urls import path
-from .views import LiveLocationView, LocationHistoryView, AvailableBuggiesView, AssignedBuggyView, UpdateBuggyStatusView
+from .views import (
+    LiveLocationView, LocationHistoryView, NearbyBuggiesView, AvailableBuggiesView, AssignedBuggyView,
+    UpdateBuggyStatusView, TripListView, TripPathView, TrailsView, StopListView, StopEtaView,
+    HeatmapView,
+)
 
 urlpatterns = [
     path('live-location/', LiveLocationView.as_view(), name='live-location'),
     path('location-history/', LocationHistoryView.as_view(), name='location-history'),
+    path('trails/', TrailsView.as_view(), name='trails'),
+    path('nearby-buggies/', NearbyBuggiesView.as_view(), name='nearby-buggies'),
     path('available-buggies/', AvailableBuggiesView.as_view(), name='available-buggies'),
     path('assigned-buggy/', AssignedBuggyView.as_view(), name='assigned-buggy'),
     path('update-buggy-status/', UpdateBuggyStatusView.as_view(), name='update-buggy-status'),
+    path('trips/', TripListView.as_view(), name='trips'),
+    path('trips/<int:trip_id>/path/', TripPathView.as_view(), name='trip-path'),
+    path('stops/', StopListView.as_view(), name='stops'),
+    path('stops/etas/', StopEtaView.as_view(), name='stop-etas'),
+    path('heatmap/', HeatmapView.as_view(), name='heatmap'),
 ]
\ No newline at end of file
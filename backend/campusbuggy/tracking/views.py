@@ -1,32 +1,52 @@
-from django.utils import timezone
+from django.http import StreamingHttpResponse
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated
-from .models import Buggy, BuggyLocation, Location
-from .serializers import BuggyLocationSerializer, LocationHistorySerializer, BuggySerializer
-import datetime
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.utils.urls import replace_query_param
+from .encoding import TRAIL_FORMATS, columns_from_rows, encode_trail
+from .eta import stop_etas
+from .groups import parse_buggy_ids
+from .heatmap import heatmap, parse_heatmap_range, parse_hours
+from .history import (
+    history_page, history_rows, history_setting, parse_since, row_to_dict,
+    stream_json_array, stream_ndjson,
+)
+from .conditional import versioned_response
+from .live import get_live_store
+from .models import Buggy, Stop, Trip
+from .nearby import nearby_buggies, parse_nearby_query
+from .readcache import (
+    AVAILABLE_BUGGIES_KEY, assigned_buggy, assigned_buggy_key, available_buggies, get_read_cache,
+)
+from .renderers import TRACKING_RENDERERS, TRAIL_RENDERERS
+from .serializers import (
+    BuggyLocationSerializer, LocationHistorySerializer, BuggySerializer, StopSerializer, TripSerializer,
+)
+from .trails import encode_trails, get_trail_store, parse_trail_since
+from .trips import parse_trip_range, trip_path, trips_between
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
 class LiveLocationView(APIView):
     permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS
     @swagger_auto_schema(
         responses={200: BuggyLocationSerializer(many=True)}
     ) 
     def get(self, request):
-        # Get all currently running buggies
-        running_locations = BuggyLocation.objects.filter(
-            buggy__is_running=True
-        ).select_related('buggy', 'buggy__assigned_driver')
-        
-        serializer = BuggyLocationSerializer(running_locations, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        # Live positions of running buggies come from the live store, not SQL
+        store = get_live_store()
+        if store.needs_warm_up:
+            store.warm_up()
+
+        return versioned_response(request, 'live-location', store.etag('live'), store.all)
     
 
 
 class LocationHistoryView(APIView):
     permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS + TRAIL_RENDERERS
     @swagger_auto_schema(
         manual_parameters=[
             openapi.Parameter(
@@ -37,6 +57,25 @@ class LocationHistoryView(APIView):
                 'since', openapi.IN_QUERY,
                 description="Time range (e.g., 1h, 30m, 1d)", type=openapi.TYPE_STRING, required=False
             ),
+            openapi.Parameter(
+                'limit', openapi.IN_QUERY,
+                description="Page size; returns {\"next\", \"results\"} with a keyset cursor",
+                type=openapi.TYPE_INTEGER, required=False
+            ),
+            openapi.Parameter(
+                'cursor', openapi.IN_QUERY,
+                description="Cursor from the previous page's \"next\" link", type=openapi.TYPE_STRING, required=False
+            ),
+            openapi.Parameter(
+                'format', openapi.IN_QUERY,
+                description="Compact trail encoding instead of a list of points",
+                type=openapi.TYPE_STRING, enum=list(TRAIL_FORMATS), required=False
+            ),
+            openapi.Parameter(
+                'stream', openapi.IN_QUERY,
+                description="Stream the whole range as 'ndjson' or a chunked 'json' array",
+                type=openapi.TYPE_STRING, enum=['ndjson', 'json'], required=False
+            ),
         ],
         responses={200: LocationHistorySerializer(many=True)}
     )
@@ -53,49 +92,151 @@ class LocationHistoryView(APIView):
         
         # Parse time interval
         try:
-            time_value = int(since[:-1])
-            time_unit = since[-1].lower()
-            
-            if time_unit == 'h':
-                delta = datetime.timedelta(hours=time_value)
-            elif time_unit == 'm':
-                delta = datetime.timedelta(minutes=time_value)
-            elif time_unit == 'd':
-                delta = datetime.timedelta(days=time_value)
-            else:
-                raise ValueError("Invalid time unit")
-                
-            start_time = timezone.now() - delta
-            
+            start_time = parse_since(since)
         except (ValueError, IndexError):
             return Response(
                 {"error": "Invalid 'since' parameter format. Use {number}{unit} where unit is h, m, or d"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
+
+        stream = request.query_params.get('stream')
+        if stream == 'ndjson':
+            return StreamingHttpResponse(
+                stream_ndjson(buggy_id, start_time),
+                content_type='application/x-ndjson'
+            )
+        if stream == 'json':
+            return StreamingHttpResponse(
+                stream_json_array(buggy_id, start_time),
+                content_type='application/json'
+            )
+        if stream is not None:
+            return Response(
+                {"error": "Invalid 'stream' parameter. Use 'ndjson' or 'json'"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if 'limit' in request.query_params or 'cursor' in request.query_params:
+            return self.get_page(request, buggy_id, start_time)
+
         # Get location history
-        locations = Location.objects.filter(
-            buggy_id=buggy_id,
-            timestamp__gte=start_time
-        ).order_by('timestamp')
-        
-        serializer = LocationHistorySerializer(locations, many=True)
-        return Response(serializer.data)
+        return Response(self.encode(request, history_rows(buggy_id, start_time)))
+
+    def encode(self, request, rows):
+        fmt = request.accepted_renderer.format
+        if fmt in TRAIL_FORMATS:
+            return encode_trail(fmt, *columns_from_rows(rows))
+        return [row_to_dict(row) for row in rows]
+
+    def get_page(self, request, buggy_id, start_time):
+        try:
+            limit = int(request.query_params.get('limit', history_setting('PAGE_SIZE')))
+            if limit < 1:
+                raise ValueError("limit must be positive")
+            limit = min(limit, history_setting('MAX_PAGE_SIZE'))
+            rows, next_cursor = history_page(
+                buggy_id, start_time, limit, request.query_params.get('cursor')
+            )
+        except ValueError:
+            return Response(
+                {"error": "Invalid 'limit' or 'cursor' parameter"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        next_url = None
+        if next_cursor:
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', next_cursor)
+
+        return Response({
+            "next": next_url,
+            "results": self.encode(request, rows),
+        })
+
+class TrailsView(APIView):
+    permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS + TRAIL_RENDERERS
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'buggy_ids', openapi.IN_QUERY,
+                description="Comma-separated buggy IDs; default every running buggy",
+                type=openapi.TYPE_STRING, required=False
+            ),
+            openapi.Parameter(
+                'since', openapi.IN_QUERY,
+                description="Time range (e.g., 5m), at most TRACKING_TRAILS['MAX_AGE']",
+                type=openapi.TYPE_STRING, required=False
+            ),
+            openapi.Parameter(
+                'format', openapi.IN_QUERY,
+                description="Compact trail encoding instead of a list of points",
+                type=openapi.TYPE_STRING, enum=list(TRAIL_FORMATS), required=False
+            ),
+        ],
+        responses={200: openapi.Response(description="Recent positions of each buggy, oldest first")}
+    )
+    def get(self, request):
+        # Served from the trail store, one response for the whole fleet
+        try:
+            since = parse_trail_since(request.query_params.get('since'))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        buggy_ids = None
+        if 'buggy_ids' in request.query_params:
+            buggy_ids = parse_buggy_ids(request.query_params['buggy_ids'].split(','))
+
+        trails = get_trail_store().get(buggy_ids, since)
+        return Response(encode_trails(trails, request.accepted_renderer.format))
+
+class NearbyBuggiesView(APIView):
+    permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'latitude', openapi.IN_QUERY, type=openapi.TYPE_NUMBER, required=True
+            ),
+            openapi.Parameter(
+                'longitude', openapi.IN_QUERY, type=openapi.TYPE_NUMBER, required=True
+            ),
+            openapi.Parameter(
+                'radius', openapi.IN_QUERY,
+                description="Search radius in metres", type=openapi.TYPE_NUMBER, required=False
+            ),
+            openapi.Parameter(
+                'limit', openapi.IN_QUERY,
+                description="Maximum number of buggies", type=openapi.TYPE_INTEGER, required=False
+            ),
+        ],
+        responses={200: "Closest running buggies, nearest first, each with 'distance' in metres"}
+    )
+    def get(self, request):
+        try:
+            query = parse_nearby_query(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(nearby_buggies(*query), status=status.HTTP_200_OK)
 
 class AvailableBuggiesView(APIView):
     permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS
     @swagger_auto_schema(
         responses={200: BuggySerializer(many=True)}
     )
     
     def get(self, request):
-        # Get all running buggies
-        running_buggies = Buggy.objects.filter(is_running=True)
-        serializer = BuggySerializer(running_buggies, many=True)
-        return Response(serializer.data)
+        # Unchanged fleets are answered from the ETag without a query
+        def running_buggies():
+            return get_read_cache().get_or_load(AVAILABLE_BUGGIES_KEY, available_buggies)
+
+        etag = get_live_store().etag('fleet')
+        return versioned_response(request, 'available-buggies', etag, running_buggies)
 
 class AssignedBuggyView(APIView):
     permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS
 
     @swagger_auto_schema(
         operation_description="Get the buggy assigned to the authenticated driver",
@@ -114,19 +255,20 @@ class AssignedBuggyView(APIView):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        try:
-            # Get the buggy assigned to this driver
-            buggy = Buggy.objects.get(assigned_driver=request.user)
-            serializer = BuggySerializer(buggy)
-            return Response(serializer.data)
-        except Buggy.DoesNotExist:
+        # Cached per driver, including "none assigned"
+        data = get_read_cache().get_or_load(
+            assigned_buggy_key(request.user.id), lambda: assigned_buggy(request.user.id)
+        )
+        if data is None:
             return Response(
                 {"detail": "No buggy is currently assigned to you"}, 
                 status=status.HTTP_404_NOT_FOUND
             )
+        return Response(data)
 
 class UpdateBuggyStatusView(APIView):
     permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS
 
     @swagger_auto_schema(
         operation_description="Update the is_running status of a driver's assigned buggy",
@@ -174,4 +316,136 @@ class UpdateBuggyStatusView(APIView):
             return Response(
                 {"detail": "No buggy is currently assigned to you"}, 
                 status=status.HTTP_404_NOT_FOUND
-            )
\ No newline at end of file
+            )
+
+class TripListView(APIView):
+    permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'buggy_id', openapi.IN_QUERY,
+                description="ID of the buggy", type=openapi.TYPE_INTEGER, required=True
+            ),
+            openapi.Parameter(
+                'start', openapi.IN_QUERY,
+                description="Start of the range (ISO 8601); trips overlapping it are listed",
+                type=openapi.TYPE_STRING, required=False
+            ),
+            openapi.Parameter(
+                'end', openapi.IN_QUERY,
+                description="End of the range (ISO 8601), default now", type=openapi.TYPE_STRING, required=False
+            ),
+            openapi.Parameter(
+                'since', openapi.IN_QUERY,
+                description="Range up to now when no 'start' is given (e.g., 1h, 30m, 1d)",
+                type=openapi.TYPE_STRING, required=False
+            ),
+        ],
+        responses={200: TripSerializer(many=True)}
+    )
+    def get(self, request):
+        buggy_id = request.query_params.get('buggy_id')
+        if not buggy_id:
+            return Response(
+                {"error": "buggy_id parameter is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            start, end = parse_trip_range(request.query_params)
+        except (ValueError, IndexError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(TripSerializer(trips_between(buggy_id, start, end), many=True).data)
+
+class TripPathView(APIView):
+    permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS
+    @swagger_auto_schema(
+        responses={
+            200: openapi.Response(description="The trip's path in the 'polyline' trail format"),
+            404: openapi.Response(description="No such trip"),
+        }
+    )
+    def get(self, request, trip_id):
+        # Stored pre-encoded, so this is one row however long the trip
+        trip = Trip.objects.filter(pk=trip_id).values(
+            'point_count', 'started_at', 'polyline', 'times'
+        ).first()
+        if trip is None:
+            return Response({"detail": "Trip not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(trip_path(trip))
+
+class StopListView(APIView):
+    permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS
+    @swagger_auto_schema(
+        responses={200: StopSerializer(many=True)}
+    )
+    def get(self, request):
+        stops = Stop.objects.filter(is_active=True).order_by('name')
+        return Response(StopSerializer(stops, many=True).data)
+
+class StopEtaView(APIView):
+    permission_classes = [IsAuthenticated]
+    renderer_classes = TRACKING_RENDERERS
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'stop_ids', openapi.IN_QUERY,
+                description="Comma-separated stop IDs; default every active stop",
+                type=openapi.TYPE_STRING, required=False
+            ),
+        ],
+        responses={200: openapi.Response(
+            description="Per stop, the running buggies due within TRACKING_ETA['MAX_ETA'], soonest first"
+        )}
+    )
+    def get(self, request):
+        # Cached per (buggy, stop) by the ETA engine; no queries once stops are loaded
+        stop_ids = None
+        if 'stop_ids' in request.query_params:
+            stop_ids = parse_buggy_ids(request.query_params['stop_ids'].split(','))
+        return Response(stop_etas(stop_ids))
+
+class HeatmapView(APIView):
+    # Usage patterns are for the transport office, not riders
+    permission_classes = [IsAdminUser]
+    renderer_classes = TRACKING_RENDERERS
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'start', openapi.IN_QUERY,
+                description="First local date (YYYY-MM-DD)", type=openapi.TYPE_STRING, required=False
+            ),
+            openapi.Parameter(
+                'end', openapi.IN_QUERY,
+                description="Last local date (YYYY-MM-DD), default today", type=openapi.TYPE_STRING, required=False
+            ),
+            openapi.Parameter(
+                'days', openapi.IN_QUERY,
+                description="Number of days up to today when no 'start' is given (default 7)",
+                type=openapi.TYPE_INTEGER, required=False
+            ),
+            openapi.Parameter(
+                'hours', openapi.IN_QUERY,
+                description="Local hours of day to include in 'cells' (e.g., 7-9,17-19); default all",
+                type=openapi.TYPE_STRING, required=False
+            ),
+        ],
+        responses={200: openapi.Response(
+            description="Grid, buggy-seconds per hour of day and non-empty cells as [row, col, seconds]"
+        )}
+    )
+    def get(self, request):
+        try:
+            first, last = parse_heatmap_range(request.query_params)
+            hours = None
+            if 'hours' in request.query_params:
+                hours = parse_hours(request.query_params['hours'])
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # One precomputed blob per day, added up as arrays
+        return Response(heatmap(first, last, hours))
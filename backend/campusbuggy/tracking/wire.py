@@ -0,0 +1,195 @@
+"""
+Wire formats of the location WebSocket.
+
+Clients pick one when connecting, through ``Sec-WebSocket-Protocol``:
+
+no subprotocol, or ``campusbuggy.json``
+    JSON text frames, unchanged for existing clients.
+
+``campusbuggy.msgpack.v1``
+    Binary MessagePack frames. Location updates, the hot frames in both
+    directions, are positional arrays with coordinates quantized to
+    ``10**-COORDINATE_PRECISION`` degrees (~11 cm), the direction in tenths
+    of a degree and timestamps in epoch milliseconds::
+
+        driver -> server  [1, buggy_id, latitude, longitude, direction]
+        server -> client  [1, buggy_id, latitude, longitude, direction, driver_name, timestamp]
+                          [2, [[buggy_id, latitude, longitude, direction, driver_name, timestamp], ...]]
+
+    ``direction`` may be nil. Every other message (subscribe, snapshot,
+    nearby, errors, delta-mode updates) is the same map as its JSON form.
+
+The broadcaster encodes each fan-out frame once per codec and sends all of
+them through the channel layer; consumers forward the one their socket
+speaks (``Codec.event_key``).
+"""
+import json
+from datetime import datetime
+
+import msgpack
+
+from .fastjson import dumps
+
+COORDINATE_PRECISION = 6
+COORDINATE_SCALE = 10 ** COORDINATE_PRECISION
+DIRECTION_SCALE = 10
+
+LOCATION_UPDATE = 1
+LOCATION_BATCH = 2
+
+UPDATE_FIELDS = ("buggy_id", "latitude", "longitude", "direction", "driver_name", "timestamp")
+
+
+def update_fields(event):
+    return {field: event[field] for field in UPDATE_FIELDS}
+
+
+def quantize(value, scale):
+    return None if value is None else round(value * scale)
+
+
+def dequantize(value, scale):
+    if value is None:
+        return None
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError("Quantized values must be integers")
+    return value / scale
+
+
+def epoch_millis(timestamp):
+    return round(datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+
+class Codec:
+    # Subprotocol name, echoed back when the client offered it
+    name = None
+    # Key of this codec's pre-encoded frame in channel layer events
+    event_key = None
+
+    def encode(self, message):
+        raise NotImplementedError
+
+    def decode(self, text_data=None, bytes_data=None):
+        """Decode a client frame into the dict its JSON form would give."""
+        raise NotImplementedError
+
+    def location_update_frame(self, event):
+        raise NotImplementedError
+
+    def location_batch_frame(self, events):
+        raise NotImplementedError
+
+    def driver_update_frame(self, buggy_id, latitude, longitude, direction=None):
+        """A driver's ``location_update``, as clients of this codec send it."""
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    name = "campusbuggy.json"
+    event_key = "text"
+
+    def encode(self, message):
+        return dumps(message)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            raise ValueError("Expected a JSON text frame")
+        message = json.loads(text_data)
+        if not isinstance(message, dict):
+            raise ValueError("Expected a JSON object")
+        return message
+
+    def location_update_frame(self, event):
+        return dumps({"type": "location_update", **update_fields(event)})
+
+    def location_batch_frame(self, events):
+        return dumps({"type": "location_batch", "updates": [update_fields(event) for event in events]})
+
+    def driver_update_frame(self, buggy_id, latitude, longitude, direction=None):
+        return dumps({
+            "type": "location_update",
+            "buggy_id": buggy_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "direction": direction,
+        })
+
+
+class MsgpackCodec(Codec):
+    name = "campusbuggy.msgpack.v1"
+    event_key = "bytes"
+
+    def encode(self, message):
+        return msgpack.packb(message)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise ValueError("Expected a binary MessagePack frame")
+        try:
+            message = msgpack.unpackb(bytes_data)
+        except (msgpack.UnpackException, ValueError):
+            raise ValueError("Invalid MessagePack frame") from None
+
+        if isinstance(message, dict):
+            return message
+        if isinstance(message, list) and len(message) == 5 and message[0] == LOCATION_UPDATE:
+            _, buggy_id, latitude, longitude, direction = message
+            if latitude is None or longitude is None:
+                raise ValueError("latitude and longitude are required")
+            return {
+                "type": "location_update",
+                "buggy_id": buggy_id,
+                "latitude": dequantize(latitude, COORDINATE_SCALE),
+                "longitude": dequantize(longitude, COORDINATE_SCALE),
+                "direction": dequantize(direction, DIRECTION_SCALE),
+            }
+        raise ValueError("Expected a map or a location_update array")
+
+    def _update_row(self, event):
+        return [
+            event["buggy_id"],
+            quantize(event["latitude"], COORDINATE_SCALE),
+            quantize(event["longitude"], COORDINATE_SCALE),
+            quantize(event["direction"], DIRECTION_SCALE),
+            event["driver_name"],
+            epoch_millis(event["timestamp"]),
+        ]
+
+    def location_update_frame(self, event):
+        return msgpack.packb([LOCATION_UPDATE, *self._update_row(event)])
+
+    def location_batch_frame(self, events):
+        return msgpack.packb([LOCATION_BATCH, [self._update_row(event) for event in events]])
+
+    def driver_update_frame(self, buggy_id, latitude, longitude, direction=None):
+        return msgpack.packb([
+            LOCATION_UPDATE,
+            buggy_id,
+            quantize(latitude, COORDINATE_SCALE),
+            quantize(longitude, COORDINATE_SCALE),
+            quantize(direction, DIRECTION_SCALE),
+        ])
+
+
+JSON_CODEC = JSONCodec()
+MSGPACK_CODEC = MsgpackCodec()
+
+CODECS = (JSON_CODEC, MSGPACK_CODEC)
+SUBPROTOCOLS = {codec.name: codec for codec in CODECS}
+
+
+def negotiate(offered):
+    """
+    Return ``(codec, subprotocol)`` for the subprotocols a client offered, in
+    the client's order of preference. Clients offering none we know get JSON
+    and no subprotocol, as before.
+    """
+    for name in offered:
+        if name in SUBPROTOCOLS:
+            return SUBPROTOCOLS[name], name
+    return JSON_CODEC, None
+
+
+def encode_frames(build):
+    """``{event_key: frame}`` with ``build(codec)`` encoded by every codec."""
+    return {codec.event_key: build(codec) for codec in CODECS}
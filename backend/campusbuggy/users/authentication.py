@@ -0,0 +1,184 @@
+"""
+Cached token -> user resolution shared by REST and WebSocket auth.
+
+Every REST call and every WebSocket connect resolves a token to a user. The
+``TokenUserCache`` keeps recent resolutions in a process-local TTL + LRU
+tier, optionally backed by a shared Django cache (e.g. Redis) so other
+workers can reuse them. Entries are invalidated by ``users.signals`` when a
+token is deleted (logout) or its user is changed or deactivated.
+
+The local tier of *other* workers is not notified, so its TTL bounds how long
+they may keep accepting a token that was just revoked; keep it short.
+
+Both tiers hold field values, not the instance: every lookup builds a fresh
+``User``, so nothing a request sets on its user (``last_login``, cached
+attributes, ``refresh_from_db``) leaks into another request. Only the fields
+authentication and permission checks read are cached (never the password
+hash); the others are deferred and loaded on first access.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+
+# What auth, permissions and the consumers read on every request
+CACHED_USER_FIELDS = ('id', 'username', 'user_type', 'is_active', 'is_staff', 'is_superuser')
+
+
+def cached_attnames(model):
+    # In model field order, as from_db expects
+    return [field.attname for field in model._meta.concrete_fields if field.attname in CACHED_USER_FIELDS]
+
+
+def user_values(user):
+    return tuple(getattr(user, attname) for attname in cached_attnames(type(user)))
+
+
+def build_user(values):
+    """A fresh ``User`` from ``user_values``, as if loaded with ``only(*CACHED_USER_FIELDS)``."""
+    model = get_user_model()
+    return model.from_db(DEFAULT_DB_ALIAS, cached_attnames(model), values)
+
+
+class TokenUserCache:
+    def __init__(self, local_ttl=30, max_entries=10000, shared_cache=None, shared_ttl=300):
+        self.local_ttl = local_ttl
+        self.max_entries = max_entries
+        self.shared_cache = caches[shared_cache] if shared_cache else None
+        self.shared_ttl = shared_ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_settings(cls):
+        config = getattr(settings, "TOKEN_CACHE", {})
+        return cls(
+            local_ttl=config.get("LOCAL_TTL", 30),
+            max_entries=config.get("MAX_ENTRIES", 10000),
+            shared_cache=config.get("SHARED_CACHE"),
+            shared_ttl=config.get("SHARED_TTL", 300),
+        )
+
+    def stats(self):
+        with self._lock:
+            lookups = self.local_hits + self.shared_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "local_hits": self.local_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+            }
+
+    @staticmethod
+    def shared_key(key):
+        # Never put raw tokens into the shared cache's key space; "v3" entries
+        # hold CACHED_USER_FIELDS values rather than pickled users
+        return "authtoken:v3:" + hashlib.sha256(key.encode()).hexdigest()
+
+    def get_local(self, key):
+        """Look up the local tier only; safe to call from the event loop."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, values = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.local_hits += 1
+        return build_user(values)
+
+    def get(self, key):
+        user = self.get_local(key)
+        if user is not None:
+            return user
+
+        if self.shared_cache is not None:
+            values = self.shared_cache.get(self.shared_key(key))
+            if values is not None:
+                self._set_local(key, values, shared_hit=True)
+                return build_user(values)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, user):
+        values = user_values(user)
+        self._set_local(key, values)
+        if self.shared_cache is not None:
+            self.shared_cache.set(self.shared_key(key), values, self.shared_ttl)
+
+    def _set_local(self, key, values, shared_hit=False):
+        with self._lock:
+            if shared_hit:
+                self.shared_hits += 1
+            self._entries[key] = (time.monotonic() + self.local_ttl, values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.invalidations += 1
+            self._entries.pop(key, None)
+        if self.shared_cache is not None:
+            self.shared_cache.delete(self.shared_key(key))
+
+
+_cache = None
+
+
+def get_token_cache():
+    global _cache
+    if _cache is None:
+        _cache = TokenUserCache.from_settings()
+    return _cache
+
+
+def get_token_user(key):
+    """Return the active user owning token ``key``, or None."""
+    cache = get_token_cache()
+    user = cache.get(key)
+    if user is not None:
+        return user
+
+    try:
+        token = Token.objects.select_related('user').get(key=key)
+    except Token.DoesNotExist:
+        return None
+
+    if not token.user.is_active:
+        return None
+
+    cache.set(key, token.user)
+    return token.user
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """``TokenAuthentication`` that resolves tokens through ``TokenUserCache``."""
+
+    def authenticate_credentials(self, key):
+        user = get_token_user(key)
+        if user is None:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        return (user, key)
@@ -0,0 +1,34 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import get_token_cache
+from .models import User
+
+
+def invalidate_tokens_on_commit(keys):
+    # Only once committed: a request in between would cache the old row again
+    def invalidate():
+        cache = get_token_cache()
+        for key in keys:
+            cache.invalidate(key)
+
+    if keys:
+        transaction.on_commit(invalidate)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    # Logout deletes the token
+    invalidate_tokens_on_commit([instance.key])
+
+
+@receiver(post_save, sender=User)
+def invalidate_changed_user(sender, instance, update_fields=None, **kwargs):
+    # Cached users must not outlive deactivation or other profile changes.
+    # last_login-only saves don't affect authentication.
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+
+    invalidate_tokens_on_commit(list(Token.objects.filter(user=instance).values_list('key', flat=True)))
@@ -1,3 +1,112 @@
+from django.core.cache import cache
 from django.test import TestCase
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from . import authentication
+from .authentication import TokenUserCache, get_token_cache, get_token_user
+from .models import User
+
+
+def make_user(username, user_type='student', phone_number='9000000000'):
+    return User.objects.create_user(
+        username, password='secret', user_type=user_type, phone_number=phone_number,
+        first_name='Test', last_name='User',
+    )
+
+
+class TokenUserCacheTests(TestCase):
+    def setUp(self):
+        authentication._cache = None
+        self.user = make_user('student1')
+        self.token = Token.objects.create(user=self.user)
+
+    def tearDown(self):
+        authentication._cache = None
+
+    def test_cached_lookups_return_fresh_instances(self):
+        first = get_token_user(self.token.key)
+        second = get_token_user(self.token.key)
+
+        self.assertEqual(first, self.user)
+        self.assertEqual(second, self.user)
+        self.assertIsNot(first, second)
+        self.assertEqual(get_token_cache().stats()["local_hits"], 1)
+
+        # A request mutating its user must not leak into the next one
+        first.username = 'changed'
+        self.assertEqual(get_token_user(self.token.key).username, 'student1')
+
+    def test_only_auth_fields_are_cached(self):
+        get_token_user(self.token.key)
+        user = get_token_user(self.token.key)
+
+        self.assertEqual((user.user_type, user.is_active), ('student', True))
+        self.assertIn('password', user.get_deferred_fields())
+        self.assertNotIn(self.user.password, get_token_cache()._entries[self.token.key][1])
+        # Other fields still load on access
+        self.assertEqual(user.phone_number, '9000000000')
+
+    def test_unknown_token(self):
+        self.assertIsNone(get_token_user('0' * 40))
+        self.assertEqual(get_token_cache().stats()["misses"], 1)
+
+    def test_deleting_token_invalidates_it_on_commit(self):
+        key = self.token.key
+        self.assertIsNotNone(get_token_user(key))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+            self.assertIsNotNone(get_token_cache().get_local(key))
+
+        self.assertIsNone(get_token_cache().get_local(key))
+        self.assertIsNone(get_token_user(key))
+
+    def test_deactivating_user_invalidates_their_tokens_on_commit(self):
+        self.assertIsNotNone(get_token_user(self.token.key))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.user.is_active = False
+            self.user.save()
+
+        self.assertEqual(len(callbacks), 1)
+        self.assertIsNone(get_token_user(self.token.key))
+
+    def test_last_login_saves_keep_the_entry(self):
+        get_token_user(self.token.key)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.user.save(update_fields=['last_login'])
+
+        self.assertEqual(callbacks, [])
+        self.assertIsNotNone(get_token_cache().get_local(self.token.key))
+
+    def test_logout_rejects_the_token(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.assertEqual(client.get('/api/user/profile/').status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(client.post('/api/user/logout/').status_code, 200)
+        self.assertEqual(client.get('/api/user/profile/').status_code, 401)
+
+    def test_shared_tier(self):
+        cache.clear()
+        worker = TokenUserCache(shared_cache='default')
+        worker.set(self.token.key, self.user)
+        self.assertNotIn(self.user.password, cache.get(TokenUserCache.shared_key(self.token.key)))
+
+        # Another worker finds the entry in the shared tier only
+        other = TokenUserCache(shared_cache='default')
+        user = other.get(self.token.key)
+        self.assertEqual(user, self.user)
+        self.assertEqual(other.stats()["shared_hits"], 1)
+        self.assertIsNotNone(other.get_local(self.token.key))
+
+        worker.invalidate(self.token.key)
+        self.assertIsNone(TokenUserCache(shared_cache='default').get(self.token.key))
+
+    def test_max_entries(self):
+        small = TokenUserCache(max_entries=1)
+        small.set('a', self.user)
+        small.set('b', self.user)
+
+        self.assertIsNone(small.get_local('a'))
+        self.assertEqual(small.get_local('b'), self.user)
@@ -3,8 +3,7 @@ import { WEBSOCKET_URL } from "@/config";
 import { BuggyLocation } from "./trackingService";
 
 // Types
-interface LocationUpdate {
-  type: "location_update";
+interface LocationFields {
   buggy_id: number;
   latitude: number;
   longitude: number;
@@ -13,12 +12,58 @@ interface LocationUpdate {
   timestamp: string;
 }
 
+interface LocationUpdate extends LocationFields {
+  type: "location_update";
+}
+
+// Sent to clients subscribed to all buggies: every update of one broadcast tick
+interface LocationBatch {
+  type: "location_batch";
+  updates: LocationFields[];
+}
+
 interface SubscriptionConfirmed {
   type: "subscription_confirmed";
   buggy_ids: number[];
 }
 
-type WebSocketMessage = LocationUpdate | SubscriptionConfirmed;
+type WebSocketMessage = LocationUpdate | LocationBatch | SubscriptionConfirmed;
+
+// Merge location updates into the list, replacing earlier entries of the same buggy
+const applyLocationUpdates = (
+  prevLocations: BuggyLocation[],
+  updates: LocationFields[]
+): BuggyLocation[] => {
+  const newLocations = [...prevLocations];
+
+  updates.forEach(update => {
+    // Find if we already have this buggy in our locations
+    const existingIndex = newLocations.findIndex(
+      loc => loc.buggy_number === update.buggy_id.toString()
+    );
+
+    // Create new location object from the update
+    const newLocation: BuggyLocation = {
+      buggy_number: update.buggy_id.toString(),
+      latitude: update.latitude,
+      longitude: update.longitude,
+      direction: update.direction,
+      driver_name: update.driver_name,
+      last_updated: update.timestamp,
+      // Derive status (customize as needed)
+      status: "available",
+    };
+
+    // If we already have this buggy, update it, otherwise add it
+    if (existingIndex >= 0) {
+      newLocations[existingIndex] = newLocation;
+    } else {
+      newLocations.push(newLocation);
+    }
+  });
+
+  return newLocations;
+};
 
 // WebSocket service for real-time updates
 export const createWebSocketConnection = (token: string | null) => {
@@ -125,33 +170,13 @@ export const useWebSocketLocations = (initialBuggyIds: number[] = []) => {
             setSubscribedBuggyIds(message.buggy_ids);
           } else if (message.type === "location_update") {
             // Update locations with new data
-            setLocations(prevLocations => {
-              // Find if we already have this buggy in our locations
-              const existingIndex = prevLocations.findIndex(
-                loc => loc.buggy_number === message.buggy_id.toString()
-              );
-
-              // Create new location object from the message
-              const newLocation: BuggyLocation = {
-                buggy_number: message.buggy_id.toString(),
-                latitude: message.latitude,
-                longitude: message.longitude,
-                direction: message.direction,
-                driver_name: message.driver_name,
-                last_updated: message.timestamp,
-                // Derive status (customize as needed)
-                status: "available",
-              };
-
-              // If we already have this buggy, update it, otherwise add it
-              if (existingIndex >= 0) {
-                const newLocations = [...prevLocations];
-                newLocations[existingIndex] = newLocation;
-                return newLocations;
-              } else {
-                return [...prevLocations, newLocation];
-              }
-            });
+            setLocations(prevLocations =>
+              applyLocationUpdates(prevLocations, [message])
+            );
+          } else if (message.type === "location_batch") {
+            setLocations(prevLocations =>
+              applyLocationUpdates(prevLocations, message.updates)
+            );
           }
         } catch (error) {
           console.error("Error parsing WebSocket message:", error);